@@ -0,0 +1,78 @@
+from deblurring_diffusion_pytorch import GaussianDiffusion
+import argparse
+import time
+import torch
+
+# q_sample with sequential convs vs compose_blur (one FFT multiply per sample),
+# checks both give the same blurred images and times them for every blur_routine.
+# python benchmark_q_sample.py --image_size 128 --time_steps 200
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--time_steps', default=50, type=int)
+parser.add_argument('--blur_std', default=0.1, type=float)
+parser.add_argument('--blur_size', default=3, type=int)
+parser.add_argument('--image_size', default=32, type=int)
+parser.add_argument('--batch_size', default=32, type=int)
+parser.add_argument('--n_repeat', default=5, type=int)
+parser.add_argument('--discrete', action="store_true")
+parser.add_argument('--tolerance', default=1e-4, type=float)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+
+args = parser.parse_args()
+print(args)
+
+device = torch.device(args.device)
+blur_routines = ['Incremental', 'Constant', 'Constant_reflect', 'Exponential', 'Exponential_reflect',
+                 'Individual_Incremental', 'Special_6_routine']
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timing(func, x, t):
+    func(x, t)
+    sync()
+    start_time = time.time()
+    for _ in range(args.n_repeat):
+        out = func(x, t)
+    sync()
+    return out, (time.time() - start_time) / args.n_repeat
+
+
+for blur_routine in blur_routines:
+    time_steps = args.time_steps
+    if blur_routine == 'Individual_Incremental':
+        # kernel size 2t+1 has to fit the padding of the image
+        time_steps = min(time_steps, args.image_size // 2)
+    if blur_routine == 'Exponential' or blur_routine == 'Exponential_reflect':
+        # exp(std*t) overflows for long schedules
+        time_steps = min(time_steps, 50)
+
+    diffusion = GaussianDiffusion(
+        None,
+        image_size=args.image_size,
+        device_of_kernel=args.device,
+        timesteps=time_steps,
+        kernel_std=args.blur_std,
+        kernel_size=args.blur_size,
+        blur_routine=blur_routine,
+        discrete=args.discrete,
+    ).to(device)
+
+    x = torch.rand((args.batch_size, 3, args.image_size, args.image_size), device=device) * 2 - 1
+    t = torch.randint(0, time_steps, (args.batch_size,), device=device).long()
+    t[0] = time_steps - 1
+
+    diffusion.compose_blur = False
+    seq_out, seq_time = timing(diffusion.q_sample, x, t)
+    diffusion.compose_blur = True
+    comp_out, comp_time = timing(diffusion.q_sample, x, t)
+
+    diff = (seq_out - comp_out).abs().max().item()
+    print('%s (T=%d): max diff = %.2e, sequential %.2f ms, composed %.2f ms, speed up %.2fx'%(
+        blur_routine, time_steps, diff, seq_time * 1000, comp_time * 1000, seq_time / comp_time))
+    if not args.discrete:
+        # discrete rounds to 1/255, a float difference can flip one level
+        assert diff < args.tolerance, '%s composed blur differs by %.2e'%(blur_routine, diff)
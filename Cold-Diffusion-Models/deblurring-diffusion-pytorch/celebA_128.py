@@ -69,6 +69,7 @@ parser.add_argument('--remove_time_embed', action="store_true")
 parser.add_argument('--residual', action="store_true")
 parser.add_argument('--loss_type', default='l1', type=str)
 parser.add_argument('--discrete', action="store_true")
+parser.add_argument('--compose_blur', action="store_true")
 
 
 args = parser.parse_args()
@@ -95,7 +96,8 @@ diffusion = GaussianDiffusion(
     blur_routine=args.blur_routine,
     train_routine = args.train_routine,
     sampling_routine = args.sampling_routine,
-    discrete=args.discrete
+    discrete=args.discrete,
+    compose_blur=args.compose_blur
 ).cuda()
 
 import torch
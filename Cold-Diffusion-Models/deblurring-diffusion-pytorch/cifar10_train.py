@@ -61,6 +61,7 @@ parser.add_argument('--sampling_routine', default='x0_step_down', type=str,
 parser.add_argument('--remove_time_embed', action="store_true")
 parser.add_argument('--residual', action="store_true")
 parser.add_argument('--discrete', action="store_true")
+parser.add_argument('--compose_blur', action="store_true")
 parser.add_argument('--da', default='cifar10', type=str)
 
 
@@ -89,7 +90,8 @@ diffusion = GaussianDiffusion(
     blur_routine=args.blur_routine,
     train_routine = args.train_routine,
     sampling_routine = args.sampling_routine,
-    discrete=args.discrete
+    discrete=args.discrete,
+    compose_blur=args.compose_blur
 ).cuda()
 
 import torch
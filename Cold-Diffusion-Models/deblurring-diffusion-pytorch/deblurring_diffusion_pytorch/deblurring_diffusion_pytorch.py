@@ -323,7 +323,8 @@ class GaussianDiffusion(nn.Module):
         blur_routine = 'Incremental',
         train_routine = 'Final',
         sampling_routine='default',
-        discrete=False
+        discrete=False,
+        compose_blur=False
     ):
         super().__init__()
         self.channels = channels
@@ -342,6 +343,8 @@ class GaussianDiffusion(nn.Module):
         self.train_routine = train_routine
         self.sampling_routine = sampling_routine
         self.discrete=discrete
+        self.compose_blur=compose_blur
+        self.composed_blurs = {}
 
 
 
@@ -924,7 +927,62 @@ class GaussianDiffusion(nn.Module):
 
         return xt, direct_recons, img
 
+    def get_composed_blur(self, size, mode, device):
+        # Frequency response of gaussian_kernels[0], ..., gaussian_kernels[t] chained, for every t.
+        # The kernels are separable, so one 1-D response per axis is enough.
+        # 'circular' padding is a circular conv on the image, 'reflect' padding of a symmetric
+        # kernel is a circular conv on the mirrored image of length 2*size-2, so both are exact.
+        key = (size, mode, str(device))
+        if key in self.composed_blurs:
+            return self.composed_blurs[key]
+
+        length = size if mode == 'circular' else 2 * size - 2
+        responses = []
+        for conv in self.gaussian_kernels:
+            kernel = conv.weight[0, 0].detach().double().cpu()
+            kernel = kernel.sum(0) # 1-D kernel, the 2-D kernel is an outer product of two normalised ones
+            center = (kernel.shape[0] - 1) // 2
+            # conv2d is a cross-correlation, so the kernel is flipped when moved to the circle
+            index = (center - torch.arange(kernel.shape[0])) % length
+            kernel_circle = torch.zeros(length, dtype=torch.float64).index_add_(0, index, kernel)
+            responses.append(torch.fft.fft(kernel_circle))
+        responses = torch.cumprod(torch.stack(responses), dim=0).to(device=device, dtype=torch.complex64)
+
+        self.composed_blurs[key] = responses
+        return responses
+
+    def q_sample_composed(self, x_start, t):
+        # same as q_sample, but each sample is blurred to t with one FFT multiply instead of t convs
+        b, c, h, w = x_start.shape
+        mode = self.gaussian_kernels[0].padding_mode
+        if mode not in ['circular', 'reflect']:
+            print('compose_blur not support padding_mode = %s'%mode)
+            noSupportPaddingMode
+
+        x = x_start
+        if mode == 'reflect':
+            # mirror without repeating the edge, period 2h-2 x 2w-2
+            x = torch.cat([x, x[:, :, 1:-1].flip(2)], 2)
+            x = torch.cat([x, x[:, :, :, 1:-1].flip(3)], 3)
+        response_h = self.get_composed_blur(h, mode, x.device)[t]
+        response_w = self.get_composed_blur(w, mode, x.device)[t]
+        response = response_h[:, None, :, None] * response_w[:, None, None, :]
+
+        with torch.no_grad():
+            x = torch.fft.ifft2(torch.fft.fft2(x.float()) * response).real
+            x = x[:, :, :h, :w].to(x_start.dtype)
+            if self.discrete:
+                last = t == (self.num_timesteps-1)
+                x[last] = torch.mean(x[last], [2, 3], keepdim=True).expand(-1, c, h, w)
+                x = (x + 1) * 0.5
+                x = (x * 255)
+                x = x.int().float() / 255
+                x = x * 2 - 1
+        return x
+
     def q_sample(self, x_start, t):
+        if self.compose_blur:
+            return self.q_sample_composed(x_start, t)
         # So at present we will for each batch blur it till the max in t.
         # And save it. And then use t to pull what I need. It is nothing but series of convolutions anyway.
         # Remember to do convs without torch.grad
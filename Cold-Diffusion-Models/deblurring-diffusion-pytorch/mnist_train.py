@@ -56,6 +56,7 @@ parser.add_argument('--train_routine', default='Final', type=str)
 parser.add_argument('--sampling_routine', default='x0_step_down', type=str,
                     help='The choice of sampling routine for reversing the diffusion process, when set as default it corresponds to Alg. 1 while when set as x0_step_down it stands for Alg. 2')
 parser.add_argument('--discrete', action="store_true")
+parser.add_argument('--compose_blur', action="store_true")
 
 args = parser.parse_args()
 print(args)
@@ -80,7 +81,8 @@ diffusion = GaussianDiffusion(
     blur_routine=args.blur_routine,
     train_routine = args.train_routine,
     sampling_routine = args.sampling_routine,
-    discrete=args.discrete
+    discrete=args.discrete,
+    compose_blur=args.compose_blur
 ).cuda()
 
 import torch
@@ -7,6 +7,73 @@ from scipy.stats import norm
 from matplotlib import pyplot as plt
 import torch
 
+
+class DegradationPlan(object):
+    """
+    Step independent part of one mix_augmentaion.random_parameter() draw for (h, w) images.
+    Built once, then every step is only a mask compare, a blend, a LUT and a resize. Only worth it when
+    the draw degrades several images / steps (q_sample, random=False), mix_aug(random=True) skips it.
+    Args:
+        aug: mix_augmentaion holding the drawn parameters
+        h, w: image size
+    apply(img, step) returns the image of the step by step mix_aug for the drawn rain drops.
+    """
+    def __init__(self, aug, h, w):
+        self.shape = (h, w)
+        self.pixelate_cv2 = aug.pixelate_cv2
+        self.pixelate_blocks = aug.pixelate_blocks
+
+        if not (h, w) == tuple(aug.imshape):
+            # add_rain_step drew new drops on every call here, now once per draw and image size
+            aug.rain_drops, aug.rain_width = aug.generate_random_lines(aug.imshape, aug.rain_slant)
+        self.len_rain = len(aug.rain_drops)
+        # index of the first drop covering each pixel, draw backward so the smallest index stays
+        self.rain_index = np.full((h, w), self.len_rain, dtype=np.float32)
+        for idx in range(self.len_rain - 1, -1, -1):
+            rain_drop = aug.rain_drops[idx]
+            cv2.line(self.rain_index, (rain_drop[0], rain_drop[1]), (rain_drop[2], rain_drop[3]), float(idx), aug.rain_width[idx])
+
+        self.spotlight_transparency = aug.spotlight_transparency
+        pos = [(aug.spotlignt_position[0][0]*w,aug.spotlignt_position[0][1]*h)]
+        self.spot_light_mask = aug.generate_spot_light_mask(mask_size=(w, h), position=pos, reverse=aug.spotlight_reverse)
+
+        self.gamma = aug.gamma
+        self.gamma_tables = {}  # built on first use of a step
+
+    def gamma_table(self, gamma, max_tables=256):
+        # same table as mix_augmentaion.adjust_gamma, kept per gamma rounded to 1e-9 (one per step value),
+        # at most max_tables of them, continuous steps past that are built and not kept
+        key = round(gamma, 9)
+        if key in self.gamma_tables:
+            return self.gamma_tables[key]
+        table = (((np.arange(0, 256) / 255.0) ** (1.0 / gamma)) * 255).astype("uint8")
+        if len(self.gamma_tables) < max_tables:
+            self.gamma_tables[key] = table
+        return table
+
+    def add_rain(self, img, step, drop_color=(200,200,200)):
+        img = img.copy()
+        img[self.rain_index < int(step*self.len_rain)] = drop_color
+        return img
+
+    def add_spot_light(self, img, step):
+        transparency = 1-(1-self.spotlight_transparency)*step
+        hsv = cv2.cvtColor(np.asarray(img, dtype=np.float32), cv2.COLOR_BGR2HSV)
+        hsv[:, :, 2] = hsv[:, :, 2] * transparency + self.spot_light_mask * (1 - transparency)
+        frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+        frame[frame > 255] = 255
+        frame[frame < 0] = 0
+        return np.asarray(frame, dtype=np.uint8)
+
+    def apply(self, img, step):
+        # img = uint8 [h, w, 3], step = 0~1
+        img = self.add_rain(img, step)
+        img = self.add_spot_light(img, step)
+        img = cv2.LUT(img, self.gamma_table(1-(1-self.gamma)*step))
+        img = self.pixelate_cv2(img, blocks=self.pixelate_blocks, step_ratio=step)
+        return img
+
+
 class mix_augmentaion(object):
     def __init__(self):
         self.random_parameter()
@@ -44,6 +111,9 @@ class mix_augmentaion(object):
         self.spotlignt_position = spotlignt_position
         self.gamma = gamma
         self.pixelate_blocks = pixelate_blocks
+
+        # new parameters, rebuild the DegradationPlan on next mix_aug
+        self.degradation_plan = None
     
 
         
@@ -331,20 +401,31 @@ class mix_augmentaion(object):
         #print(np.min(img))
         img = img.astype(np.uint8)
         height, width, _ = img.shape
+        if random:
+            # one image of this draw, a DegradationPlan would not be reused
+            return self.mix_aug_once(img, step)
+
+        # rain layer, spot light mask and gamma LUTs only depend on the parameter draw
+        plan = self.get_degradation_plan(height, width)
+        return plan.apply(img, step)
+
+    def mix_aug_once(self, img, step):
+        # step by step degradation without a DegradationPlan, only the rain drops of the step are drawn
+        height, width, _ = img.shape
+        if not (height, width) == tuple(self.imshape):
+            self.rain_drops, self.rain_width = self.generate_random_lines(self.imshape, self.rain_slant)
+        n = int(step*len(self.rain_drops))
+        img = self.rain_process(img, self.rain_drops[:n], (200,200,200), self.rain_width[:n])
         pos = [(self.spotlignt_position[0][0]*width,self.spotlignt_position[0][1]*height)]
-        #self.pixelate_blocks=60
-        img = self.add_rain_step(img,step_ratio=step,slant = self.rain_slant)
         img = self.add_spot_light_step(img,step_ratio=step,light_position=pos,transparency=self.spotlight_transparency,reverse=self.spotlight_reverse)
-        #print(1-(1-self.gamma)*step)
-        #print('dsadsada')
         img = self.adjust_gamma(img,gamma=1-(1-self.gamma)*step)
-        #img = self.pixelate(img,blocks=self.pixelate_blocks,step_ratio=step)
-
         img = self.pixelate_cv2(img,blocks=self.pixelate_blocks,step_ratio=step)
-
-        #img = self.pixelate_cv2(img,blocks=self.pixelate_blocks,step_ratio=step)
-
         return img
+
+    def get_degradation_plan(self, h, w):
+        if self.degradation_plan is None or not self.degradation_plan.shape == (h, w):
+            self.degradation_plan = DegradationPlan(self, h, w)
+        return self.degradation_plan
     
     def torchcuda2npy(self, x):    
         return (x.detach().cpu().numpy().transpose([1,2,0])+1)*0.5
@@ -0,0 +1,90 @@
+from licenceplate_deaug_pytorch.augmentations import mix_augmentaion
+from licenceplate_deaug_pytorch.augmentations_torch import mix_augmentaion_torch
+import argparse
+import glob
+import time
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# parity of mix_augmentaion_torch against the cv2 mix_augmentaion + speed of both.
+# python benchmark_augmentations_torch.py --image_size 512 --batch_size 16
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--image_size', default=512, type=int)
+parser.add_argument('--batch_size', default=16, type=int)
+parser.add_argument('--n_param', default=5, type=int)
+parser.add_argument('--n_repeat', default=10, type=int)
+parser.add_argument('--data_path', default='', type=str)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+parser.add_argument('--max_mean_error', default=0.5, type=float)#uint8 levels
+parser.add_argument('--max_error', default=2, type=float)#uint8 levels
+parser.add_argument('--min_ratio_in_max_error', default=0.99, type=float)
+
+args = parser.parse_args()
+print(args)
+
+size = args.image_size
+device = torch.device(args.device)
+
+
+def load_batch():
+    if args.data_path:
+        paths = sorted(glob.glob(args.data_path + '/*.jpg') + glob.glob(args.data_path + '/*.png'))[:args.batch_size]
+        imgs = [cv2.resize(cv2.imread(p), (size, size)) for p in paths]
+        imgs = np.stack(imgs).astype(np.float32) / 255
+        return torch.from_numpy(imgs).permute(0, 3, 1, 2).to(device)
+    # smooth random images, closer to plates than white noise
+    imgs = torch.rand((args.batch_size, 3, size // 16, size // 16))
+    return F.interpolate(imgs, size=(size, size), mode='bilinear', align_corners=False).to(device)
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+aug_torch = mix_augmentaion_torch(imshape=(size, size))
+aug_cv2 = mix_augmentaion(imshape=(size, size))
+imgbf = load_batch()
+steps = torch.linspace(0, 1, args.batch_size, device=device)
+
+all_diff = []
+for n in range(args.n_param):
+    aug_torch.random_parameter()
+    aug_cv2.__dict__.update({k: v for k, v in aug_torch.__dict__.items() if not k.startswith('_')})
+
+    out_torch = aug_torch.batch_data_add_licence_aug(imgbf, steps)
+    out_cv2 = torch.cat([aug_cv2.batch_data_add_licence_aug(imgbf[i:i+1], steps[i].item()) for i in range(args.batch_size)], 0)
+    diff = (out_torch - out_cv2).abs() * 255
+    all_diff.append(diff.flatten().cpu())
+    print('param %d: mean error = %.4f, max error = %.1f'%(n, diff.mean().item(), diff.max().item()))
+
+all_diff = torch.cat(all_diff)
+mean_error = all_diff.mean().item()
+ratio_in_max_error = (all_diff <= args.max_error + 1e-3).float().mean().item()
+print('mean error = %.4f (uint8 levels)'%mean_error)
+print('pixels within %.1f levels = %.4f'%(args.max_error, ratio_in_max_error))
+assert mean_error < args.max_mean_error, 'mean error %.4f over %.4f'%(mean_error, args.max_mean_error)
+assert ratio_in_max_error >= args.min_ratio_in_max_error, 'only %.4f pixels within %.1f levels'%(ratio_in_max_error, args.max_error)
+
+# speed, fixed parameters so the torch caches are used as in training
+aug_torch.batch_data_add_licence_aug(imgbf, steps)
+sync()
+start_time = time.time()
+for _ in range(args.n_repeat):
+    aug_torch.batch_data_add_licence_aug(imgbf, steps)
+sync()
+torch_time = (time.time() - start_time) / args.n_repeat
+
+start_time = time.time()
+for _ in range(args.n_repeat):
+    aug_cv2.batch_data_add_licence_aug(imgbf, 0.5)
+sync()
+cv2_time = (time.time() - start_time) / args.n_repeat
+
+print('batch %d x %d^2 on %s'%(args.batch_size, size, args.device))
+print('mix_augmentaion       : %.2f ms / batch'%(cv2_time * 1000))
+print('mix_augmentaion_torch : %.2f ms / batch'%(torch_time * 1000))
+print('speed up = %.2fx'%(cv2_time / torch_time))
@@ -0,0 +1,119 @@
+from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader_2noise import Unet_2timeEmb, GaussianDiffusion
+import argparse
+import sys
+import time
+import torch
+import yaml
+
+# training step of GaussianDiffusion.p_losses_pair (encoder once on 2b, U-Net once on 3b, head once on 4b)
+# against the old version with separate encoder / U-Net / head calls, same loss, steps per second.
+# python benchmark_p_losses_pair.py --batch_size 16 --loss_type l1_with_last_layer
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', default=16, type=int)
+parser.add_argument('--image_size', default=512, type=int)
+parser.add_argument('--time_steps', default=100, type=int)
+parser.add_argument('--g_steps', default=10, type=int)
+parser.add_argument('--n_repeat', default=10, type=int)
+parser.add_argument('--loss_type', default='l1_with_last_layer', type=str)#l1,l1_with_last_layer
+parser.add_argument('--yolo_path', default='/data/licence_plate/_yolo/yolov7/', type=str)
+parser.add_argument('--yolohyperparam', default='/data/licence_plate/_yolo/yolov7/cfg/deploy/hyp.scratch.tiny.yaml', type=str)
+parser.add_argument('--yolocfg', default='/data/licence_plate/_yolo/yolov7/cfg/training/yolov7-tiny.yaml', type=str)
+parser.add_argument('--yoloclass', default=35, type=int)
+parser.add_argument('--tolerance', default=1e-4, type=float)
+
+args = parser.parse_args()
+print(args)
+
+sys.path.append(args.yolo_path)
+from models.yolo_with_diffusion import Model_with_diffusion
+
+
+def p_losses_pair_sequential(self, x_start, x_blur, t):
+    # GaussianDiffusion.p_losses_pair before batching
+    b, c, h, w = x_start.shape
+    x_start_latent,y_start = self.yolomodel.forward_submodel(x_start,self.yolomodel.before_diffusion_model,output_y=True)
+    x_blur_latent,y = self.yolomodel.forward_submodel(x_blur,self.yolomodel.before_diffusion_model,output_y=True)
+
+    gaussian_latent= torch.randn_like(x_start_latent).to(t.device)
+    g_step = torch.randint(0, self.g_steps, (b,), device=t.device).long()
+    zero_step = torch.zeros((b,)).to(t.device)
+
+    x0_mix_gaussian = self.q_sample_gaussian(x_start=x_start_latent, x_end=gaussian_latent, t=g_step)
+    xtg_latent = self.q_sample_gaussian(x_start=x_blur_latent, x_end=gaussian_latent, t=g_step)
+
+    x_recon_g = self.denoise_fn(x0_mix_gaussian, zero_step,g_step)
+    x_recon_t = self.denoise_fn(x_blur_latent, t,zero_step)
+    x_recon_tg = self.denoise_fn(xtg_latent, t,g_step)
+
+    loss = (x_start_latent - x_recon_g).abs().mean() + (x_start_latent - x_recon_t).abs().mean() + (x_start_latent - x_recon_tg).abs().mean()
+    if self.loss_type == 'l1_with_last_layer':
+        x_start_yolo = self.yolomodel.forward_submodel(x_start_latent,self.yolomodel.after_diffusion_model,init_y=y_start)
+        x_start_yolo_1d = self.change_yolo_detect_to_1d(x_start_yolo,b)
+        for x_recon in [x_recon_t, x_recon_g, x_recon_tg]:
+            y[-1]=x_recon
+            x_recon_yolo = self.yolomodel.forward_submodel(x_recon,self.yolomodel.after_diffusion_model,init_y=y)
+            loss = loss + (x_start_yolo_1d - self.change_yolo_detect_to_1d(x_recon_yolo,b)).abs().mean()
+    return loss
+
+
+with open(args.yolohyperparam) as f:
+    hyp = yaml.load(f, Loader=yaml.SafeLoader)  # load hyps
+
+yolomodel = Model_with_diffusion(args.yolocfg, ch=3, nc=args.yoloclass, anchors=hyp.get('anchors')).cuda() # create
+yolomodel.eval()
+yolomodel.create_subnetwork()
+
+model = Unet_2timeEmb(
+    dim = 64,
+    dim_mults = (1, 2, 4, 8),
+    channels=128,
+    residual=True,
+).cuda()
+
+diffusion = GaussianDiffusion(
+    model,
+    image_size = args.image_size // 8,
+    device_of_kernel = 'cuda',
+    channels = 128,
+    timesteps = args.time_steps,
+    t_steps = args.time_steps,
+    g_steps = args.g_steps,
+    loss_type = args.loss_type,
+    yolomodel=yolomodel
+).cuda()
+
+x_start = torch.rand((args.batch_size, 3, args.image_size, args.image_size)).cuda()
+x_blur = torch.rand((args.batch_size, 3, args.image_size, args.image_size)).cuda()
+t = torch.randint(0, args.time_steps, (args.batch_size,)).long().cuda()
+
+torch.manual_seed(0)
+loss_sequential = p_losses_pair_sequential(diffusion, x_start, x_blur, t)
+torch.manual_seed(0)
+loss_batched = diffusion.p_losses_pair(x_start, x_blur, t)
+diff = abs(loss_sequential.item() - loss_batched.item())
+print('loss sequential = %.6f, batched = %.6f, diff = %.2e'%(loss_sequential.item(), loss_batched.item(), diff))
+assert diff < args.tolerance * max(1.0, abs(loss_sequential.item())), 'batched p_losses_pair changed the loss'
+
+opt = torch.optim.Adam(model.parameters(), lr=2e-5)
+
+
+def train_step(loss_func):
+    opt.zero_grad()
+    loss = loss_func(x_start, x_blur, t)
+    loss.backward()
+    opt.step()
+
+
+for name, loss_func in [('sequential', lambda x, xb, t: p_losses_pair_sequential(diffusion, x, xb, t)),
+                        ('batched', diffusion.p_losses_pair)]:
+    train_step(loss_func)
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    for _ in range(args.n_repeat):
+        train_step(loss_func)
+    torch.cuda.synchronize()
+    step_time = (time.time() - start_time) / args.n_repeat
+    print('%-10s: %.1f ms / step, %.1f images / s, peak %.0f MB'%(
+        name, step_time * 1000, args.batch_size / step_time, torch.cuda.max_memory_allocated() / 2**20))
@@ -0,0 +1,84 @@
+from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader_2noise import GaussianDiffusion
+import argparse
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# time / peak memory of GaussianDiffusion.q_sample against the old version which
+# materialised func[0..max(t)] for the whole batch.
+# python benchmark_q_sample.py --batch_size 16 --time_steps 100 --image_size 512
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--image_size', default=512, type=int)
+parser.add_argument('--batch_size', default=16, type=int)
+parser.add_argument('--time_steps', default=100, type=int)
+parser.add_argument('--n_repeat', default=3, type=int)
+parser.add_argument('--aug_routine', default='Default', type=str)#Default,Torch
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+
+args = parser.parse_args()
+print(args)
+
+device = torch.device(args.device)
+
+
+def q_sample_all_steps(diffusion, x_start, t):
+    # q_sample before per sample degradation
+    max_iters = torch.max(t)
+    all_blurs = []
+    for i in range(max_iters+1):
+        with torch.no_grad():
+            x = diffusion.func[i](x_start)
+            all_blurs.append(x)
+
+    all_blurs = torch.stack(all_blurs)
+
+    choose_blur = []
+    for step in range(t.shape[0]):
+        choose_blur.append(all_blurs[t[step], step])
+    return torch.stack(choose_blur)
+
+
+def run(func, x_start, t):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    for _ in range(args.n_repeat):
+        out = func(x_start, t)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2**20
+    else:
+        peak = float('nan')
+    return out, (time.time() - start_time) / args.n_repeat, peak
+
+
+diffusion = GaussianDiffusion(
+    None,
+    image_size=args.image_size,
+    device_of_kernel=args.device,
+    timesteps=args.time_steps,
+    aug_routine=args.aug_routine,
+    yolomodel=nn.Identity(),
+).to(device)
+# keep rain drops fixed between the two runs
+diffusion.aug_licence.imshape = (args.image_size, args.image_size)
+diffusion.aug_licence.random_parameter()
+
+imgs = torch.rand((args.batch_size, 3, args.image_size // 16, args.image_size // 16))
+x_start = F.interpolate(imgs, size=(args.image_size, args.image_size), mode='bilinear', align_corners=False).to(device)
+t = torch.randint(0, args.time_steps, (args.batch_size,), device=device).long()
+t[0] = args.time_steps - 1 # worst case for the old version
+
+old_out, old_time, old_peak = run(lambda x, t: q_sample_all_steps(diffusion, x, t), x_start, t)
+new_out, new_time, new_peak = run(diffusion.q_sample, x_start, t)
+
+diff = (old_out - new_out).abs().max().item() * 255
+print('max diff = %.2f (uint8 levels)'%diff)
+print('old q_sample : %.1f ms, peak %.1f MB'%(old_time * 1000, old_peak))
+print('new q_sample : %.1f ms, peak %.1f MB'%(new_time * 1000, new_peak))
+print('speed up = %.2fx'%(old_time / new_time))
+if args.aug_routine == 'Default':
+    assert diff == 0, 'q_sample changed the degraded images'
@@ -0,0 +1,80 @@
+from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader_2noise import Unet, LayerNorm, LinearAttention, ConvNextBlock
+import argparse
+import copy
+import time
+import torch
+
+# Unet.fused_mode (one layer_norm kernel, batched matmul LinearAttention, in place adds, channels_last
+# with --channels_last) against the plain modules, per block (LayerNorm, LinearAttention, ConvNextBlock)
+# and the whole Unet, same output, same state_dict keys, ms per call.
+# python benchmark_unet_blocks.py --channels 128 --size 64 128 --batch_size 4 --channels_last
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--dim', default=64, type=int)
+parser.add_argument('--channels', default=128, type=int)#128 latent of yolov7-tiny, 3 image
+parser.add_argument('--size', nargs='+', default=[64, 128], type=int)#latent of 512 / 1024 at stride 8
+parser.add_argument('--batch_size', default=4, type=int)
+parser.add_argument('--n_repeat', default=10, type=int)
+parser.add_argument('--tolerance', default=1e-4, type=float)
+parser.add_argument('--channels_last', action='store_true')#GPU, slower on CPU
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+
+args = parser.parse_args()
+print(args)
+
+device = torch.device(args.device)
+memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timing(func, *inputs):
+    with torch.no_grad():
+        out = func(*inputs)
+        sync()
+        start_time = time.time()
+        for _ in range(args.n_repeat):
+            func(*inputs)
+        sync()
+    return out, (time.time() - start_time) / args.n_repeat
+
+
+def fused(module):
+    module = copy.deepcopy(module)
+    for m in module.modules():
+        if isinstance(m, (LayerNorm, LinearAttention, ConvNextBlock)):
+            m.fused = True
+    return module.to(memory_format=memory_format)
+
+
+def compare(name, plain, fast, x, *extra):
+    out, t_plain = timing(plain, x, *extra)
+    out_fast, t_fast = timing(fast, x.contiguous(memory_format=memory_format), *extra)
+    diff = ((out - out_fast).abs().max() / out.abs().max().clamp(min=1e-9)).item()
+    print('%-28s plain %8.2f ms, fused %8.2f ms (x%.2f), relative max diff %.2e'%(name, t_plain * 1000, t_fast * 1000, t_plain / max(t_fast, 1e-9), diff))
+    assert diff < args.tolerance, '%s changed the output'%name
+
+
+unet = Unet(dim=args.dim, dim_mults=(1, 2, 4, 8), channels=args.channels, with_time_emb=True, residual=False).to(device).eval()
+fast_unet = copy.deepcopy(unet).fused_mode(channels_last=args.channels_last)
+assert list(unet.state_dict().keys()) == list(fast_unet.state_dict().keys())
+fast_unet.load_state_dict(unet.state_dict())  # checkpoints of the plain Unet load unchanged
+
+for size in args.size:
+    print('---- %d x %d, batch %d'%(size, size, args.batch_size))
+    x = torch.randn((args.batch_size, args.channels, size, size), device=device)
+    t = torch.randint(0, 100, (args.batch_size,), device=device)
+    emb = unet.time_mlp(t).detach()
+    # first level blocks (dim channels at full resolution), mid blocks at 1 / 8
+    h = torch.randn((args.batch_size, args.dim, size, size), device=device)
+    mid = torch.randn((args.batch_size, args.dim * 8, size // 8, size // 8), device=device)
+    compare('LayerNorm %d'%args.dim, unet.downs[0][2].fn.norm, fused(unet.downs[0][2].fn.norm), h)
+    compare('LinearAttention %d'%args.dim, unet.downs[0][2].fn.fn, fused(unet.downs[0][2].fn.fn), h)
+    compare('ConvNextBlock %d->%d'%(args.channels, args.dim), unet.downs[0][0], fused(unet.downs[0][0]), x, emb)
+    compare('ConvNextBlock %d'%args.dim, unet.downs[0][1], fused(unet.downs[0][1]), h, emb)
+    compare('LinearAttention mid %d'%(args.dim * 8), unet.mid_attn.fn.fn, fused(unet.mid_attn.fn.fn), mid)
+    compare('ConvNextBlock mid %d'%(args.dim * 8), unet.mid_block1, fused(unet.mid_block1), mid, emb)
+    compare('Unet', unet, fast_unet, x, t)
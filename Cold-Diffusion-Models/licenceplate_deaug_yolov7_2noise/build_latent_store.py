@@ -0,0 +1,56 @@
+from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader_2noise import GaussianDiffusion, Dataset_cv2_aug_step, LatentStore
+from licenceplate_deaug_pytorch.augmentations import mix_augmentaion
+import argparse
+import sys
+import torch
+import yaml
+
+# clean image latents + yolo head outputs of the training folders for Trainer(latent_store=...),
+# the yolomodel has to be the one used for training (its weights are frozen).
+# about (c*h*w + head) * 2 bytes per row, ~2.3 MB for yolov7-tiny at 512.
+# python build_latent_store.py --store_folder './latent_store_genbg_79' --data_path_1 '/data/licence_plate/_plate/synthesis/result_350k/' --data_path_2 '/data/licence_plate/_plate/cityscapes/leftImg8bit/all/' --yolomodel '/data/licence_plate/_yolo/yolov7/static_model/last_genbg_79_state_dict.pt'
+# python licenceplate_yolov7_512_aug_from_dataloader_t100g10.py ... --latent_store './latent_store_genbg_79'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--store_folder', default='./latent_store', type=str)
+parser.add_argument('--image_size', default=512, type=int)
+parser.add_argument('--batch_size', default=32, type=int)
+parser.add_argument('--n_crops', default=4, type=int)#random crops per cityscapes image
+parser.add_argument('--data_path_1', default='/data/licence_plate/_plate/generated_data/result2/img/', type=str)
+parser.add_argument('--data_path_2', default='/data/licence_plate/_plate/generated_data/result3/img/', type=str)
+parser.add_argument('--data_path_3', default='', type=str)
+parser.add_argument('--yolomodel', default='/data/licence_plate/_yolo/yolov7/runs/train/exp2/weights/best_288_state_dict.pt', type=str)
+parser.add_argument('--yolohyperparam', default='/data/licence_plate/_yolo/yolov7/cfg/deploy/hyp.scratch.tiny.yaml', type=str)
+parser.add_argument('--yolocfg', default='/data/licence_plate/_yolo/yolov7/cfg/training/yolov7-tiny.yaml', type=str)
+parser.add_argument('--yoloclass', default=35, type=int)
+parser.add_argument('--split', default='14', type=str)#last yolo layer before diffusion, index or stage name like P3
+
+args = parser.parse_args()
+print(args)
+
+sys.path.append('/data/licence_plate/_yolo/yolov7/')
+from models.yolo_with_diffusion import Model_with_diffusion
+
+with open(args.yolohyperparam) as f:
+    hyp = yaml.load(f, Loader=yaml.SafeLoader)  # load hyps
+
+yolomodel = Model_with_diffusion(args.yolocfg, ch=3, nc=args.yoloclass, anchors=hyp.get('anchors')).cuda() # create
+yolomodel.load_state_dict(torch.load(args.yolomodel))
+yolomodel.eval()
+yolomodel.create_subnetwork(split=int(args.split) if args.split.lstrip('-').isdigit() else args.split)
+
+diffusion = GaussianDiffusion(
+    None,
+    image_size = args.image_size // yolomodel.latent_stride,
+    device_of_kernel = 'cuda',
+    channels = yolomodel.latent_channels,
+    yolomodel=yolomodel
+).cuda()
+
+if not args.data_path_3 == '':
+    datasets=[args.data_path_1,args.data_path_2,args.data_path_3]
+else:
+    datasets=[args.data_path_1,args.data_path_2]
+
+ds = Dataset_cv2_aug_step(datasets, mix_augmentaion(), args.image_size)
+LatentStore.build(args.store_folder, diffusion, ds, n_crops=args.n_crops, batch_size=args.batch_size)
@@ -0,0 +1,243 @@
+import math
+from functools import lru_cache
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from licenceplate_deaug_pytorch.augmentations import mix_augmentaion
+
+
+@lru_cache(maxsize=None)
+def _area_down_weights(src, dst):
+    '''
+    Row weights of cv2.resize(INTER_AREA) when shrinking src -> dst pixels
+    (same table as cv2 computeResizeAreaTab).
+    Return: float64 tensor [dst, src]
+    '''
+    weights = torch.zeros((dst, src), dtype=torch.float64)
+    if src == dst:
+        return torch.eye(src, dtype=torch.float64)
+    scale = src / dst
+    for dx in range(dst):
+        fsx1 = dx * scale
+        fsx2 = fsx1 + scale
+        cell_width = min(scale, src - fsx1)
+        sx1 = math.ceil(fsx1)
+        sx2 = min(math.floor(fsx2), src - 1)
+        sx1 = min(sx1, sx2)
+        if sx1 - fsx1 > 1e-3:
+            weights[dx, sx1 - 1] = (sx1 - fsx1) / cell_width
+        for sx in range(sx1, sx2):
+            weights[dx, sx] = 1.0 / cell_width
+        if fsx2 - sx2 > 1e-3:
+            weights[dx, sx2] = min(min(fsx2 - sx2, 1.0), cell_width) / cell_width
+    return weights
+
+
+@lru_cache(maxsize=None)
+def _area_up_weights(src, dst):
+    '''
+    Row weights of cv2.resize(INTER_AREA) when enlarging src -> dst pixels
+    (cv2 falls back to its "area mode" bilinear coefficients).
+    Return: float64 tensor [dst, src]
+    '''
+    weights = torch.zeros((dst, src), dtype=torch.float64)
+    if src == dst:
+        return torch.eye(src, dtype=torch.float64)
+    scale = src / dst
+    inv_scale = dst / src
+    for dx in range(dst):
+        sx = math.floor(dx * scale)
+        fx = (dx + 1) - (sx + 1) * inv_scale
+        fx = 0. if fx <= 0 else fx - math.floor(fx)
+        if sx >= src - 1:
+            fx = 0.
+            sx = src - 1
+        weights[dx, sx] += 1. - fx
+        if fx > 0:
+            weights[dx, sx + 1] += fx
+    return weights
+
+
+class mix_augmentaion_torch(mix_augmentaion):
+    '''
+    Batched torch version of mix_augmentaion.batch_data_add_licence_aug.
+    Rain, spot light, gamma and deresolution run on the device of the batch and
+    every sample may have its own step, so the whole batch is degraded without
+    leaving the GPU.
+
+    The step independent parts (rain drop raster, spot light mask) are built once
+    per random_parameter() draw and cached per (h, w, device):
+        rain: drops are drawn with cv2.line into a map holding the smallest drop
+              index of every pixel, so step_ratio only thresholds that map.
+        spot light: gaussian mask + 5x5 median (replicate border) in torch.
+
+    Tolerance against mix_augmentaion (uint8 levels, same parameters):
+        rain, gamma: exact.
+        spot light: +-1 where cv2 float HSV round trip truncates differently.
+        deresolution: +-1 from cv2 fixed point bilinear coefficients.
+    so |torch - cv2| <= 2/255 on >= 99% of pixels and the mean error stays below
+    0.5/255 (see benchmark_augmentations_torch.py).
+    '''
+
+    def random_parameter(self, *args, **kwargs):
+        self._torch_cache = {}
+        super().random_parameter(*args, **kwargs)
+
+    def _step_tensor(self, t, batch_size, device):
+        if isinstance(t, torch.Tensor):
+            step = t.detach().to(device=device, dtype=torch.float64).reshape(-1)
+            if step.numel() == 1:
+                step = step.expand(batch_size)
+        else:
+            step = torch.full((batch_size,), float(t), dtype=torch.float64, device=device)
+        if self.noiseStepMode == 'exp':
+            step = self.multi_base * torch.pow(torch.full_like(step, self.exp_base), step * 100)
+        return step
+
+    def rain_drop_map(self, h, w, device):
+        '''
+        Return: float32 tensor [h, w], index of the first rain drop covering each
+                pixel (len(rain_drops) if no drop covers it).
+        '''
+        key = ('rain', h, w, str(device))
+        if not (h, w) == tuple(self.imshape):
+            # same behaviour as add_rain_step: new drops every call
+            self.rain_drops, self.rain_width = self.generate_random_lines(self.imshape, self.rain_slant)
+            print('self.imshape = %s, imshape = %s.'%(str(self.imshape),str((h, w))))
+        elif key in self._torch_cache:
+            return self._torch_cache[key]
+
+        len_rain = len(self.rain_drops)
+        drop_map = np.full((h, w), len_rain, dtype=np.float32)
+        # draw from last to first drop, so the smallest index wins on overlap
+        for idx in range(len_rain - 1, -1, -1):
+            x1, y1, x2, y2 = [int(v) for v in self.rain_drops[idx]]
+            cv2.line(drop_map, (x1, y1), (x2, y2), float(idx), int(self.rain_width[idx]))
+        drop_map = torch.from_numpy(drop_map).to(device)
+        if (h, w) == tuple(self.imshape):
+            self._torch_cache[key] = drop_map
+        return drop_map
+
+    def spot_light_mask(self, h, w, device):
+        '''
+        Torch version of generate_spot_light_mask(mode='gaussian') at the fixed
+        spot light position / reverse of the current parameter draw.
+        Return: float32 tensor [h, w] in [0, 255]
+        '''
+        key = ('spot_light', h, w, str(device))
+        if key in self._torch_cache:
+            return self._torch_cache[key]
+
+        center_x = self.spotlignt_position[0][0] * w
+        center_y = self.spotlignt_position[0][1] * h
+        dev = math.sqrt(h ** 2 + w ** 2) / 3.5
+        yv, xv = torch.meshgrid(torch.arange(h, dtype=torch.float64, device=device),
+                                torch.arange(w, dtype=torch.float64, device=device))
+        dist2 = (xv - center_x) ** 2 + (yv - center_y) ** 2
+        # norm.pdf(dist, 0, dev) / norm.pdf(0, 0, dev)
+        mask = torch.exp(-dist2 / (2 * dev ** 2)) * 255
+        mask = torch.clamp(mask, max=255).floor().float()
+
+        # cv2.medianBlur(mask, 5), BORDER_REPLICATE
+        mask = F.pad(mask[None, None], (2, 2, 2, 2), mode='replicate')
+        mask = F.unfold(mask, kernel_size=5).median(dim=1).values.view(h, w)
+        if self.spotlight_reverse:
+            mask = 255 - mask
+
+        self._torch_cache[key] = mask
+        return mask
+
+    def add_rain_batch(self, img, step, drop_color=200.):
+        b, c, h, w = img.shape
+        drop_map = self.rain_drop_map(h, w, img.device)
+        n_drops = torch.floor(step * len(self.rain_drops)).to(img.dtype).view(b, 1, 1, 1)
+        return torch.where(drop_map[None, None] < n_drops, torch.full_like(img, drop_color), img)
+
+    def add_spot_light_batch(self, img, step):
+        b, c, h, w = img.shape
+        mask = self.spot_light_mask(h, w, img.device)
+        transparency = (1 - (1 - self.spotlight_transparency) * step).float().view(b, 1, 1, 1)
+
+        # only V of HSV changes, so BGR scales with V_new / V (grey when V == 0)
+        v = img.max(dim=1, keepdim=True).values
+        v_new = v * transparency + mask[None, None] * (1 - transparency)
+        ratio = v_new / torch.where(v > 0, v, torch.ones_like(v))
+        frame = torch.where(v > 0, img * ratio, v_new.expand_as(img))
+        return torch.clamp(frame, 0, 255).floor()
+
+    def adjust_gamma_batch(self, img, step):
+        b = img.shape[0]
+        gamma = 1 - (1 - self.gamma) * step
+        lut = torch.arange(256, dtype=torch.float64, device=img.device) / 255.0
+        lut = torch.floor((lut[None] ** (1.0 / gamma[:, None])) * 255)
+        out = torch.gather(lut, 1, img.long().view(b, -1))
+        return out.view(img.shape).to(img.dtype)
+
+    def deresolution_batch(self, img, step):
+        b, c, h, w = img.shape
+        blocks = self.pixelate_blocks
+        sizes = []
+        for s in step.tolist():
+            st_ratio = 0 if s == 0 else 0.5 + s * 0.5
+            sizes.append((int(blocks * st_ratio + (1 - st_ratio) * h),
+                          int(blocks * st_ratio + (1 - st_ratio) * w)))
+        max_h = max(s[0] for s in sizes)
+        max_w = max(s[1] for s in sizes)
+
+        # per sample resize matrices, zero padded to the largest small size
+        down_y = torch.zeros((b, max_h, h), dtype=torch.float64)
+        down_x = torch.zeros((b, max_w, w), dtype=torch.float64)
+        up_y = torch.zeros((b, h, max_h), dtype=torch.float64)
+        up_x = torch.zeros((b, w, max_w), dtype=torch.float64)
+        for i, (nh, nw) in enumerate(sizes):
+            down_y[i, :nh] = _area_down_weights(h, nh)
+            down_x[i, :nw] = _area_down_weights(w, nw)
+            up_y[i, :, :nh] = _area_up_weights(nh, h)
+            up_x[i, :, :nw] = _area_up_weights(nw, w)
+        down_y, down_x, up_y, up_x = [m.to(device=img.device, dtype=torch.float32) for m in (down_y, down_x, up_y, up_x)]
+
+        small = torch.einsum('bph,bchw,bqw->bcpq', down_y, img, down_x)
+        small = torch.clamp(torch.round(small), 0, 255)
+        out = torch.einsum('bhp,bcpq,bwq->bchw', up_y, small, up_x)
+        return torch.clamp(torch.round(out), 0, 255)
+
+    def mix_aug_batch(self, img, step):
+        '''
+        Input:
+            img: float tensor [b, 3, h, w] in [0, 255]
+            step: float or tensor [b] in [0, 1]
+        Return:
+            float tensor [b, 3, h, w] holding uint8 values
+        '''
+        step = self._step_tensor(step, img.shape[0], img.device)
+        img = torch.clamp(img.float(), 0, 255).floor()
+        if self.flags_rain:
+            img = self.add_rain_batch(img, step)
+        if self.flags_spot_light:
+            img = self.add_spot_light_batch(img, step)
+        if self.flags_gamma:
+            img = self.adjust_gamma_batch(img, step)
+        if self.flags_pixelate:
+            img = self.deresolution_batch(img, step)
+        return img
+
+    def batch_data_add_licence_aug(self, imgbf, t, random=False, clamp=False):
+        if random:
+            # every sample draws its own parameters, as in the cv2 version
+            after_img = []
+            for idx in range(imgbf.shape[0]):
+                self.random_parameter()
+                t_idx = t[idx] if isinstance(t, torch.Tensor) and t.numel() > 1 else t
+                after_img.append(self.mix_aug_batch(imgbf[idx:idx+1] * 255, t_idx))
+            after_img = torch.cat(after_img, 0)
+        else:
+            with torch.no_grad():
+                after_img = self.mix_aug_batch(imgbf * 255, t)
+
+        after_img = (after_img / 255).to(imgbf.dtype)
+        if clamp:
+            after_img = torch.clamp(after_img, min=0.0, max=1.0)
+        return after_img
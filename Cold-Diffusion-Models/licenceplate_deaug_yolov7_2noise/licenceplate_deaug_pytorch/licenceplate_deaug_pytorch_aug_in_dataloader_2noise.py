@@ -19,12 +19,15 @@ from einops import rearrange
 import torchgeometry as tgm
 import glob
 import os
+import json
 from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 from torch import linalg as LA
 from licenceplate_deaug_pytorch.augmentations import mix_augmentaion
-from licenceplate_deaug_pytorch.yolo_utils import eval_dataset, non_max_suppression, affine_transform
+from licenceplate_deaug_pytorch.augmentations_torch import mix_augmentaion_torch
+from licenceplate_deaug_pytorch.yolo_utils import eval_dataset, non_max_suppression, non_max_suppression_batch, affine_transform, affine_transform_batch
+from licenceplate_deaug_pytorch.plate_metrics import PlateLabels
 
 import cv2
 from random import randint
@@ -138,11 +141,20 @@ class LayerNorm(nn.Module):
         self.eps = eps
         self.g = nn.Parameter(torch.ones(1, dim, 1, 1))
         self.b = nn.Parameter(torch.zeros(1, dim, 1, 1))
+        self.fused = False
 
     def forward(self, x):
-        var = torch.var(x, dim = 1, unbiased = False, keepdim = True)
-        mean = torch.mean(x, dim = 1, keepdim = True)
-        return (x - mean) / (var + self.eps).sqrt() * self.g + self.b
+        if self.fused:
+            # one layer_norm kernel over the channels of the NHWC view (no copy for channels_last x),
+            # the output keeps the memory format of x for the next conv
+            y = F.layer_norm(x.permute(0, 2, 3, 1).float(), (x.shape[1],), self.g.view(-1).float(), self.b.view(-1).float(), self.eps)
+            memory_format = torch.channels_last if x.is_contiguous(memory_format = torch.channels_last) else torch.contiguous_format
+            return y.permute(0, 3, 1, 2).to(x.dtype).contiguous(memory_format = memory_format)
+        # statistics in float32, var of fp16 / bf16 activations under autocast overflows
+        x32 = x.float()
+        var = torch.var(x32, dim = 1, unbiased = False, keepdim = True)
+        mean = torch.mean(x32, dim = 1, keepdim = True)
+        return ((x32 - mean) / (var + self.eps).sqrt() * self.g + self.b).to(x.dtype)
 
 class PreNorm(nn.Module):
     def __init__(self, dim, fn):
@@ -176,16 +188,32 @@ class ConvNextBlock(nn.Module):
         )
 
         self.res_conv = nn.Conv2d(dim, dim_out, 1) if dim != dim_out else nn.Identity()
+        # Unet.inference_mode: mlp(time embedding) of every t, and ds_conv bias + condition of a fixed t
+        self.register_buffer('cond_table', None, persistent = False)
+        self.register_buffer('fixed_bias', None, persistent = False)
+        self.fused = False
 
     def forward(self, x, time_emb = None):
-        h = self.ds_conv(x)
+        if exists(self.fixed_bias):
+            h = F.conv2d(x, self.ds_conv.weight, self.fixed_bias, padding = 3, groups = self.ds_conv.groups)
+        else:
+            h = self.ds_conv(x)
 
-        if exists(self.mlp):
+        if exists(self.mlp) and not exists(self.fixed_bias):
             assert exists(time_emb), 'time emb must be passed in'
-            condition = self.mlp(time_emb)
-            h = h + rearrange(condition, 'b c -> b c 1 1')
+            if exists(self.cond_table) and not time_emb.is_floating_point():
+                condition = self.cond_table[time_emb]  # time_emb is the step
+            else:
+                condition = self.mlp(time_emb)
+            if self.fused:
+                h += condition[:, :, None, None].to(h.dtype)  # h is a fresh conv output
+            else:
+                h = h + rearrange(condition, 'b c -> b c 1 1')
 
         h = self.net(h)
+        if self.fused:
+            h += self.res_conv(x)
+            return h
         return h + self.res_conv(x)
     
 class ConvNextBlock_2timeEmb(nn.Module):
@@ -238,8 +266,20 @@ class LinearAttention(nn.Module):
         hidden_dim = dim_head * heads
         self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
         self.to_out = nn.Conv2d(hidden_dim, dim, 1)
+        self.fused = False
+
+    def forward_fused(self, x):
+        # same attention with one reshape of qkv (a view for NCHW x) and two batched matmuls, the scale
+        # is folded in the d x e context instead of q, the output comes out as b (h c) (x y)
+        b, c, h, w = x.shape
+        q, k, v = self.to_qkv(x).reshape(b, 3, self.heads, -1, h * w).unbind(1)
+        context = torch.matmul(k.softmax(dim = -1), v.transpose(-1, -2)) * self.scale
+        out = torch.matmul(context.transpose(-1, -2), q).reshape(b, -1, h, w)
+        return self.to_out(out)
 
     def forward(self, x):
+        if self.fused:
+            return self.forward_fused(x)
         b, c, h, w = x.shape
         qkv = self.to_qkv(x).chunk(3, dim = 1)
         q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
@@ -323,10 +363,75 @@ class Unet(nn.Module):
             ConvNextBlock(dim, dim),
             nn.Conv2d(dim, out_dim, 1)
         )
+        self.register_buffer('time_table', None, persistent = False)
+        self.fixed_time = None
+        self.amp_dtype = None
+        self.channels_last = False
+
+    def fused_mode(self, fused = True, channels_last = True):
+        '''
+        LayerNorm as one layer_norm kernel, LinearAttention with batched matmuls and in place adds in
+        ConvNextBlock, channels_last weights and activations (GPU, on CPU the attention reshapes cost
+        more than the convolutions gain). Parameters are unchanged, the state_dict of a checkpoint
+        loads with or without it.
+        '''
+        for m in self.modules():
+            if isinstance(m, (LayerNorm, LinearAttention, ConvNextBlock)):
+                m.fused = fused
+        self.channels_last = fused and channels_last
+        return self.to(memory_format = torch.channels_last if self.channels_last else torch.contiguous_format)
+
+    def inference_mode(self, timesteps = 100, amp_dtype = None, fixed_time = None):
+        '''
+        Precomputed time embedding for sampling, call again after the weights change (ema update, load).
+        Input:
+            timesteps: time_mlp of steps 0..timesteps-1 and the condition of every ConvNextBlock are
+                tabled, an int64 time indexes them, a float time still runs time_mlp.
+                None = back to the plain forward
+            amp_dtype: torch.float16 / torch.bfloat16, forward runs under autocast and returns the
+                input dtype (LayerNorm statistics stay float32)
+            fixed_time: step folded in the ds_conv bias of every block, forward then ignores time
+        '''
+        self.time_table = None
+        for m in self.modules():
+            if isinstance(m, ConvNextBlock):
+                m.cond_table = None
+        if exists(timesteps) and exists(self.time_mlp):
+            p = next(self.parameters())
+            with torch.no_grad():
+                self.time_table = self.time_mlp(torch.arange(timesteps, device = p.device))
+                for m in self.modules():
+                    if isinstance(m, ConvNextBlock) and exists(m.mlp):
+                        m.cond_table = m.mlp(self.time_table)
+        self.amp_dtype = amp_dtype
+        return self.fix_time(fixed_time if exists(self.time_table) else None)
+
+    def fix_time(self, time = None):
+        # fold the condition of step time in the ds_conv biases, None unfolds
+        self.fixed_time = time
+        for m in self.modules():
+            if isinstance(m, ConvNextBlock):
+                m.fixed_bias = None
+                if exists(time) and exists(m.cond_table):
+                    m.fixed_bias = (m.ds_conv.bias + m.cond_table[time]).detach()
+        return self
 
     def forward(self, x, time):
+        if self.channels_last:
+            x = x.contiguous(memory_format = torch.channels_last)
+        if exists(self.amp_dtype):
+            with torch.autocast(x.device.type, dtype = self.amp_dtype):
+                return self.forward_unet(x, time).to(x.dtype)
+        return self.forward_unet(x, time)
+
+    def forward_unet(self, x, time):
         orig_x = x
-        t = self.time_mlp(time) if exists(self.time_mlp) else None
+        if exists(self.fixed_time):
+            t = None  # folded in the block biases
+        elif exists(self.time_table) and not time.is_floating_point():
+            t = time  # index of the block condition tables
+        else:
+            t = self.time_mlp(time) if exists(self.time_mlp) else None
 
         h = []
 
@@ -348,11 +453,11 @@ class Unet(nn.Module):
             x = attn(x)
             x = upsample(x)
         if self.residual:
-            return self.final_conv(x) + orig_x
+            return (self.final_conv(x) + orig_x).contiguous()
         if self.predict_noise:
-            return orig_x-self.final_conv(x) 
+            return (orig_x-self.final_conv(x)).contiguous()
 
-        return self.final_conv(x)
+        return self.final_conv(x).contiguous()
     
     
 class Unet_2timeEmb(nn.Module):
@@ -467,6 +572,19 @@ class Unet_2timeEmb(nn.Module):
 
 # gaussian diffusion trainer class
 
+
+def quantize_dynamic_unet(unet):
+    '''
+    Post training dynamic int8 (CPU) copy of a Unet, weights of the nn.Linear layers (time_mlp and the
+    block mlp) in int8, torch dynamic quantization has no Conv2d, the convolutions stay float32.
+    Return: quantized copy on the cpu, inference_mode tables rebuilt from the int8 layers
+    '''
+    timesteps = unet.time_table.shape[0] if exists(unet.time_table) else None
+    q = torch.ao.quantization.quantize_dynamic(copy.deepcopy(unet).cpu().eval(), {nn.Linear}, dtype = torch.qint8)
+    if exists(timesteps):
+        q.inference_mode(timesteps, fixed_time = unet.fixed_time)
+    return q
+
 def extract(a, t, x_shape):
     b, *_ = t.shape
     out = a.gather(-1, t)
@@ -539,7 +657,11 @@ class GaussianDiffusion(nn.Module):
         self.sampling_routine = sampling_routine
         
         #self.aug_licence = mix_augmentaion(noiseStepMode='exp')
-        self.aug_licence = mix_augmentaion()
+        if self.aug_routine == 'Torch':
+            # batched degradation on the device of x_start
+            self.aug_licence = mix_augmentaion_torch()
+        else:
+            self.aug_licence = mix_augmentaion()
         
         if yolomodel is None:
             print('this code need base yolo model to encode latent space, please check.')
@@ -590,7 +712,7 @@ class GaussianDiffusion(nn.Module):
     def get_funcs(self):
         all_funcs = []
         for i in range(self.num_timesteps):
-            if self.aug_routine == 'Default':
+            if self.aug_routine in ['Default', 'Torch']:
                 step_multiple = 1.0/self.num_timesteps 
                 all_funcs.append((lambda img, d=i: self.aug_licence.batch_data_add_licence_aug(img, d*step_multiple)))
             '''
@@ -728,7 +850,7 @@ class GaussianDiffusion(nn.Module):
         y[-1]=x_recon
         x_recon_yolo = self.yolomodel.forward_submodel(x_recon,self.yolomodel.after_diffusion_model,init_y=y)
         #x_recon_yolo = self.yolomodel(x_recon,mode='after',init_y=y)
-        x_recon_yolo = non_max_suppression(x_recon_yolo[0], labels=[], multi_label=True)
+        x_recon_yolo = non_max_suppression_batch(x_recon_yolo[0], multi_label=True)
 
         return x_recon_yolo
     
@@ -739,7 +861,7 @@ class GaussianDiffusion(nn.Module):
 
         x_yolo = self.yolomodel.forward_submodel(x_latent,self.yolomodel.after_diffusion_model,init_y=y)
         #x_recon_yolo = self.yolomodel(x_recon,mode='after',init_y=y)
-        x_recon_yolo = non_max_suppression(x_yolo[0], labels=[], multi_label=True)
+        x_recon_yolo = non_max_suppression_batch(x_yolo[0], multi_label=True)
 
         return x_recon_yolo
     
@@ -766,7 +888,7 @@ class GaussianDiffusion(nn.Module):
         y[-1]=x_recon
         x_recon_yolo = self.yolomodel.forward_submodel(x_recon,self.yolomodel.after_diffusion_model,init_y=y)
         #x_recon_yolo = self.yolomodel(x_recon,mode='after',init_y=y)
-        x_recon_yolo = non_max_suppression(x_recon_yolo[0], labels=[], multi_label=True)
+        x_recon_yolo = non_max_suppression_batch(x_recon_yolo[0], multi_label=True)
 
         return x_recon_yolo
 
@@ -889,6 +1011,157 @@ class GaussianDiffusion(nn.Module):
         return X_0s, X_ts
 
 
+    def get_sample_schedule(self, schedule='uniform', n_steps=None, t=None):
+        '''
+        Timesteps visited by schedule_sample.
+        Input:
+            schedule: 'uniform' (same stride), 'quadratic' (denser near t=0) or a list of timesteps,
+                      i.e. [99, 60, 30, 10, 0]
+            n_steps: number of denoise_fn calls for 'uniform' and 'quadratic' (default t)
+            t: start from t-1 (default num_timesteps)
+        Return:
+            strictly decreasing list of int, i.e. [99, 74, 49, 24, 0]
+        '''
+        if t == None:
+            t = self.num_timesteps
+        if n_steps == None:
+            n_steps = t
+        n_steps = max(1, min(int(n_steps), t))
+
+        if isinstance(schedule, (list, tuple)):
+            timesteps = [int(x) for x in schedule]
+        elif schedule == 'uniform':
+            timesteps = np.round(np.linspace(t - 1, 0, n_steps)).astype(int).tolist()
+        elif schedule == 'quadratic':
+            timesteps = np.round(np.linspace(np.sqrt(t - 1), 0, n_steps) ** 2).astype(int).tolist()
+        else:
+            print('not support schedule = %s'%str(schedule))
+            noThisSchedule
+
+        timesteps = sorted(set(timesteps), reverse=True)
+        if timesteps[0] > self.num_timesteps - 1 or timesteps[-1] < 0:
+            print('schedule %s out of range [0, %d]'%(str(timesteps), self.num_timesteps - 1))
+            scheduleOutOfRange
+        return timesteps
+
+    @torch.no_grad()
+    def schedule_sample(self, batch_size=16, img=None, t=None, schedule='uniform', n_steps=None, wo_noise=False, clamp=False):
+        '''
+        all_sample with a timestep schedule, jumps from timesteps[i] to timesteps[i+1] in one
+        denoise_fn call. schedule=list(range(t-1, -1, -1)) gives the same X_0s, X_ts as all_sample.
+        Input:
+            schedule, n_steps, t: see get_sample_schedule
+            wo_noise: img is already degraded to timesteps[0]
+            clamp: clamp x0 predictions to [0, 1] like the image space test scripts
+        Return:
+            X_0s: x0 prediction of every visited timestep
+            X_ts: input of every visited timestep
+        '''
+        timesteps = self.get_sample_schedule(schedule, n_steps, t)
+
+        if not wo_noise:
+            with torch.no_grad():
+                img = self.func[timesteps[0]](img)
+
+        X_0s = []
+        X_ts = []
+        for idx, times in enumerate(timesteps):
+            step = torch.full((batch_size,), times, dtype=torch.long, device=img.device)
+            x = self.denoise_fn(img, step)
+            if clamp:
+                x = torch.clamp(x, min=0.0, max=1.0)
+            X_0s.append(x)
+            X_ts.append(img)
+
+            # next timestep, -1 = clean image
+            times_next = timesteps[idx + 1] if idx + 1 < len(timesteps) else -1
+            if self.train_routine == 'Final':
+                if times_next >= 0:
+                    x_times_next = self.func[times_next](x)
+                else:
+                    x_times_next = x
+
+                if self.sampling_routine == 'default':
+                    x = x_times_next
+
+                elif self.sampling_routine == 'x0_step_down':
+                    x_times = self.func[times](x)
+                    x = img - x_times + x_times_next
+                    if clamp:
+                        x = torch.clamp(x, min=0.0, max=1.0)
+
+            img = x
+
+        return X_0s, X_ts
+
+    @torch.no_grad()
+    def early_exit_sample(self, img=None, t=None, schedule='uniform', n_steps=None, threshold=1e-3, exit_space='image', min_steps=2, wo_noise=False, clamp=False):
+        '''
+        schedule_sample which retires a sample as soon as its x0 prediction stops changing,
+        mean |x0_i - x0_(i-1)| < threshold, the rest of the batch is compacted so later
+        denoise_fn calls run on fewer images.
+        Input:
+            schedule, n_steps, t: see get_sample_schedule
+            threshold: L1 change between two x0 predictions to retire a sample
+            exit_space: 'image' compares x0 itself, 'latent' compares yolomodel.before_diffusion_model(x0)
+            min_steps: denoise_fn calls before a sample may retire
+            wo_noise, clamp: see schedule_sample
+        Return:
+            x0: last x0 prediction of every sample
+            n_calls: long [b], denoise_fn calls spent on every sample
+        '''
+        timesteps = self.get_sample_schedule(schedule, n_steps, t)
+        if exit_space == 'latent' and getattr(self, 'yolomodel', None) is None:
+            print('exit_space = latent need yolomodel, please check.')
+            noyolomodel
+
+        if not wo_noise:
+            with torch.no_grad():
+                img = self.func[timesteps[0]](img)
+
+        x0 = torch.zeros_like(img)
+        n_calls = torch.zeros((img.shape[0],), dtype=torch.long, device=img.device)
+        active = torch.arange(img.shape[0], device=img.device)
+        feat_prev = None
+        for idx, times in enumerate(timesteps):
+            step = torch.full((img.shape[0],), times, dtype=torch.long, device=img.device)
+            x = self.denoise_fn(img, step)
+            if clamp:
+                x = torch.clamp(x, min=0.0, max=1.0)
+            x0[active] = x
+            n_calls[active] += 1
+
+            if idx + 1 == len(timesteps):
+                break
+
+            if exit_space == 'latent':
+                feat = self.yolomodel.forward_submodel(x, self.yolomodel.before_diffusion_model)
+            else:
+                feat = x
+            if feat_prev is not None and idx + 1 >= min_steps:
+                change = (feat - feat_prev).abs().flatten(1).mean(1)
+                keep = change >= threshold
+                if not keep.all():
+                    active, img, x, feat = active[keep], img[keep], x[keep], feat[keep]
+                    if active.shape[0] == 0:
+                        break
+            feat_prev = feat
+
+            times_next = timesteps[idx + 1]
+            if self.train_routine == 'Final':  # as schedule_sample, other routines feed x0 back
+                x_times_next = self.func[times_next](x)
+                if self.sampling_routine == 'default':
+                    x = x_times_next
+                elif self.sampling_routine == 'x0_step_down':
+                    x_times = self.func[times](x)
+                    x = img - x_times + x_times_next
+                    if clamp:
+                        x = torch.clamp(x, min=0.0, max=1.0)
+            img = x
+
+        return x0, n_calls
+
+
     @torch.no_grad()
     def forward_and_backward(self, batch_size=16, img=None, t=None, times=None, eval=True):
 
@@ -967,32 +1240,19 @@ class GaussianDiffusion(nn.Module):
         return img
 
     def q_sample(self, x_start, t):
-
-        max_iters = torch.max(t)
-        all_blurs = []
-        x = x_start
-        #for i in range(max_iters+1):
-        #    with torch.no_grad():
-        #        #print(x.shape)
-        #        x = self.func[i](x)
-        #        all_blurs.append(x)
-        for i in range(max_iters+1):
+        # func[i] always starts from x_start, so every sample only needs its own
+        # func[t[b]]; samples sharing a t are degraded together.
+        # (was: apply func[0..max(t)] to the whole batch and stack T x B images)
+        if self.aug_routine == 'Torch':
+            # per sample step in one batched call
             with torch.no_grad():
-                #print(x.shape)
-                x = self.func[i](x_start)
-                all_blurs.append(x)
-
-        all_blurs = torch.stack(all_blurs)
+                return self.aug_licence.batch_data_add_licence_aug(x_start, t.float()/self.num_timesteps)
 
-        choose_blur = []
-
-        for step in range(t.shape[0]):
-            if step != -1:
-                choose_blur.append(all_blurs[t[step], step])
-            else:
-                choose_blur.append(x_start[step])
-
-        choose_blur = torch.stack(choose_blur)
+        choose_blur = torch.empty_like(x_start)
+        for step in torch.unique(t).tolist():
+            idx = (t == step).nonzero(as_tuple=True)[0]
+            with torch.no_grad():
+                choose_blur[idx] = self.func[step](x_start[idx])
 
         return choose_blur
     
@@ -1005,12 +1265,14 @@ class GaussianDiffusion(nn.Module):
         )
 
     
-    def p_losses_pair(self, x_start, x_blur, t):
+    def p_losses_pair(self, x_start, x_blur, t, x_start_latent=None, x_start_yolo_1d=None):
+        # frozen yolo encoder once on 2b images, U-Net once on 3b latents (g, t, tg),
+        # yolo head once on 4b latents, same loss as running every part on its own
+        # x_start_latent / x_start_yolo_1d from LatentStore: encoder only on x_blur, head on 3b
         b, c, h, w = x_start.shape
         
         
-        x_start_latent,y_start = self.yolomodel.forward_submodel(x_start,self.yolomodel.before_diffusion_model,output_y=True)
-        x_blur_latent,y = self.yolomodel.forward_submodel(x_blur,self.yolomodel.before_diffusion_model,output_y=True)
+        x_start_latent, x_blur_latent, y_pair = self.forward_yolo_encoder_pair(x_start, x_blur, x_start_latent)
         
         gaussian_latent= torch.randn_like(x_start_latent).to(t.device) #need chage to latent space
         #print('torch.var_mean(x_start)',torch.var_mean(x_start_latent))
@@ -1026,15 +1288,10 @@ class GaussianDiffusion(nn.Module):
         xtg_latent = self.q_sample_gaussian(x_start=x_blur_latent, x_end=gaussian_latent, t=g_step)
         
         
-        x_recon_g = self.denoise_fn(x0_mix_gaussian, zero_step,g_step)
-        x_recon_t = self.denoise_fn(x_blur_latent, t,zero_step)
-        x_recon_tg = self.denoise_fn(xtg_latent, t,g_step)
-
-        
-        
-        
-        
-        
+        x_recon = self.denoise_fn(torch.cat([x0_mix_gaussian, x_blur_latent, xtg_latent], 0),
+                                  torch.cat([zero_step, t.float(), t.float()], 0),
+                                  torch.cat([g_step.float(), zero_step, g_step.float()], 0))
+        x_recon_g, x_recon_t, x_recon_tg = x_recon.chunk(3, 0)
 
         if self.loss_type == 'l1':
             loss = (x_start_latent - x_recon_g).abs().mean() + (x_start_latent - x_recon_t).abs().mean() + (x_start_latent - x_recon_tg).abs().mean()
@@ -1048,21 +1305,13 @@ class GaussianDiffusion(nn.Module):
             
             
             # noise from raining etc
-            x_start_yolo = self.yolomodel.forward_submodel(x_start_latent,self.yolomodel.after_diffusion_model,init_y=y_start)
-            x_start_yolo_1d = self.change_yolo_detect_to_1d(x_start_yolo,b)
-            
-            y[-1]=x_recon_t
-            x_recon_t_yolo = self.yolomodel.forward_submodel(x_recon_t,self.yolomodel.after_diffusion_model,init_y=y)
-            x_recon_t_yolo_1d = self.change_yolo_detect_to_1d(x_recon_t_yolo,b)
-
-            y[-1]=x_recon_g
-            x_recon_g_yolo = self.yolomodel.forward_submodel(x_recon_g,self.yolomodel.after_diffusion_model,init_y=y)
-            x_recon_g_yolo_1d = self.change_yolo_detect_to_1d(x_recon_g_yolo,b)
-
-            
-            y[-1]=x_recon_tg
-            x_recon_tg_yolo = self.yolomodel.forward_submodel(x_recon_tg,self.yolomodel.after_diffusion_model,init_y=y)
-            x_recon_tg_yolo_1d = self.change_yolo_detect_to_1d(x_recon_tg_yolo,b)
+            if x_start_yolo_1d is None:
+                x_start_yolo_1d, x_recon_t_yolo_1d, x_recon_g_yolo_1d, x_recon_tg_yolo_1d = self.forward_yolo_head_pair(
+                    [x_start_latent, x_recon_t, x_recon_g, x_recon_tg], y_pair, b)
+            else:
+                x_recon_t_yolo_1d, x_recon_g_yolo_1d, x_recon_tg_yolo_1d = self.forward_yolo_head_pair(
+                    [x_recon_t, x_recon_g, x_recon_tg], y_pair, b, start_cached=True)
+                x_start_yolo_1d = x_start_yolo_1d.type_as(x_recon_t_yolo_1d)
 
             
             loss_last_yolo =0
@@ -1082,6 +1331,41 @@ class GaussianDiffusion(nn.Module):
             raise NotImplementedError()
         return loss
     
+    def forward_yolo_encoder_pair(self, x_start, x_blur, x_start_latent=None):
+        '''
+        before_diffusion_model once on cat([x_start, x_blur]), or only on x_blur when
+        the clean latent comes from LatentStore.
+        Return:
+            x_start_latent, x_blur_latent, y_pair (skip outputs for forward_yolo_head_pair)
+        '''
+        if x_start_latent is None:
+            b = x_start.shape[0]
+            x_latent,y_pair = self.yolomodel.forward_submodel(torch.cat([x_start, x_blur], 0),self.yolomodel.before_diffusion_model,output_y=True)
+            return x_latent[:b], x_latent[b:], y_pair
+        x_blur_latent,y_pair = self.yolomodel.forward_submodel(x_blur,self.yolomodel.before_diffusion_model,output_y=True)
+        return x_start_latent.type_as(x_blur_latent), x_blur_latent, y_pair
+
+    def forward_yolo_head_pair(self, latents, y_pair, batch_size, start_cached=False):
+        '''
+        after_diffusion_model once on all latents.
+        Input:
+            latents: list of [b, c, h, w], latents[0] comes from x_start, the others replace x_blur latent
+            y_pair: skip outputs {index: tensor} of before_diffusion_model on cat([x_start, x_blur])
+            start_cached: x_start head output is read from LatentStore, y_pair only holds
+                the x_blur skips and every latent replaces x_blur latent
+        Return:
+            list of change_yolo_detect_to_1d output, one per latent
+        '''
+        n = len(latents)
+        init_y = {}
+        for j, before_y in y_pair.items():
+            if start_cached:
+                init_y[j] = torch.cat([before_y] * n, 0)
+            else:
+                init_y[j] = torch.cat([before_y[:batch_size]] + [before_y[batch_size:]] * (n - 1), 0)
+        x_yolo = self.yolomodel.forward_submodel(torch.cat(latents, 0),self.yolomodel.after_diffusion_model,init_y=init_y)
+        return list(self.change_yolo_detect_to_1d(x_yolo,n*batch_size).chunk(n, 0))
+    
     def change_yolo_detect_to_1d(self,_layer,batch_size):
         #_layer0 = _layer[0].view(batch_size,-1)
         _layer1 = _layer[1][0].view(batch_size,-1)
@@ -1232,7 +1516,8 @@ class GaussianDiffusion(nn.Module):
         
         if mode =='train':
             b, c, h, w, device, img_size, = *x.shape, x.device, self.image_size
-            assert h//8 == img_size and w//8 == img_size, f'height and width of image must be {img_size}'
+            latent_stride = getattr(self.yolomodel, 'latent_stride', 8)
+            assert h//latent_stride == img_size and w//latent_stride == img_size, f'height and width of image must be {img_size*latent_stride}'
             return self.p_losses_pair(x, x_aug, t, *args, **kwargs)
         elif mode=='w/diffusion':
             if not g is None:
@@ -1252,11 +1537,11 @@ class GaussianDiffusion(nn.Module):
 
         
 class interpolateDiffusion(GaussianDiffusion):
-    def p_losses_pair(self, x_start, x_blur, t):
+    def p_losses_pair(self, x_start, x_blur, t, x_start_latent=None, x_start_yolo_1d=None):
+        # see GaussianDiffusion.p_losses_pair, U-Net once on 5b latents, yolo head once on 6b (5b with LatentStore)
         b, c, h, w = x_start.shape
         
-        x_start_latent,y_start = self.yolomodel.forward_submodel(x_start,self.yolomodel.before_diffusion_model,output_y=True)
-        x_blur_latent,y = self.yolomodel.forward_submodel(x_blur,self.yolomodel.before_diffusion_model,output_y=True)
+        x_start_latent, x_blur_latent, y_pair = self.forward_yolo_encoder_pair(x_start, x_blur, x_start_latent)
         
         zero_step = torch.zeros((b,)).to(t.device)
         
@@ -1271,11 +1556,10 @@ class interpolateDiffusion(GaussianDiffusion):
         xtg_latent = self.q_sample_gaussian(x_start=x_blur_latent, x_end=gaussian_latent, t=g_step)
         xitg_latent = self.q_sample_gaussian(x_start=x_interpolate, x_end=gaussian_latent, t=g_step)
         
-        x_recon_g = self.denoise_fn(x0_mix_gaussian, zero_step, g_step)
-        x_recon_t = self.denoise_fn(x_blur_latent, t, zero_step)
-        x_recon_it = self.denoise_fn(x_interpolate, mix_t_step, zero_step)
-        x_recon_tg = self.denoise_fn(xtg_latent, t, g_step)
-        x_recon_itg = self.denoise_fn(xitg_latent, mix_t_step, g_step)
+        x_recon = self.denoise_fn(torch.cat([x0_mix_gaussian, x_blur_latent, x_interpolate, xtg_latent, xitg_latent], 0),
+                                  torch.cat([zero_step, t.float(), mix_t_step, t.float(), mix_t_step], 0),
+                                  torch.cat([g_step.float(), zero_step, zero_step, g_step.float(), g_step.float()], 0))
+        x_recon_g, x_recon_t, x_recon_it, x_recon_tg, x_recon_itg = x_recon.chunk(5, 0)
 
 
         if self.loss_type == 'l1':
@@ -1296,29 +1580,13 @@ class interpolateDiffusion(GaussianDiffusion):
             
             
             # noise from raining etc
-            x_start_yolo = self.yolomodel.forward_submodel(x_start_latent,self.yolomodel.after_diffusion_model,init_y=y_start)
-            x_start_yolo_1d = self.change_yolo_detect_to_1d(x_start_yolo,b)
-            
-            y[-1]=x_recon_t
-            x_recon_t_yolo = self.yolomodel.forward_submodel(x_recon_t,self.yolomodel.after_diffusion_model,init_y=y)
-            x_recon_t_yolo_1d = self.change_yolo_detect_to_1d(x_recon_t_yolo,b)
-
-            y[-1]=x_recon_g
-            x_recon_g_yolo = self.yolomodel.forward_submodel(x_recon_g,self.yolomodel.after_diffusion_model,init_y=y)
-            x_recon_g_yolo_1d = self.change_yolo_detect_to_1d(x_recon_g_yolo,b)
-
-            
-            y[-1]=x_recon_tg
-            x_recon_tg_yolo = self.yolomodel.forward_submodel(x_recon_tg,self.yolomodel.after_diffusion_model,init_y=y)
-            x_recon_tg_yolo_1d = self.change_yolo_detect_to_1d(x_recon_tg_yolo,b)
-
-            y[-1]=x_recon_it
-            x_recon_it_yolo = self.yolomodel.forward_submodel(x_recon_it,self.yolomodel.after_diffusion_model,init_y=y)
-            x_recon_it_yolo_1d = self.change_yolo_detect_to_1d(x_recon_it_yolo,b)
-            
-            y[-1]=x_recon_itg
-            x_recon_itg_yolo = self.yolomodel.forward_submodel(x_recon_itg,self.yolomodel.after_diffusion_model,init_y=y)
-            x_recon_itg_yolo_1d = self.change_yolo_detect_to_1d(x_recon_itg_yolo,b)
+            if x_start_yolo_1d is None:
+                x_start_yolo_1d, x_recon_t_yolo_1d, x_recon_g_yolo_1d, x_recon_tg_yolo_1d, x_recon_it_yolo_1d, x_recon_itg_yolo_1d = self.forward_yolo_head_pair(
+                    [x_start_latent, x_recon_t, x_recon_g, x_recon_tg, x_recon_it, x_recon_itg], y_pair, b)
+            else:
+                x_recon_t_yolo_1d, x_recon_g_yolo_1d, x_recon_tg_yolo_1d, x_recon_it_yolo_1d, x_recon_itg_yolo_1d = self.forward_yolo_head_pair(
+                    [x_recon_t, x_recon_g, x_recon_tg, x_recon_it, x_recon_itg], y_pair, b, start_cached=True)
+                x_start_yolo_1d = x_start_yolo_1d.type_as(x_recon_t_yolo_1d)
 
 
             
@@ -1343,14 +1611,139 @@ class interpolateDiffusion(GaussianDiffusion):
         return loss
     
     
+class LatentStore(object):
+    '''
+    clean image yolo latents (before_diffusion_model output) and head outputs
+    (change_yolo_detect_to_1d) of the training folders, fp16 .npy read with mmap,
+    one row per image path and crop. The yolo model is frozen, so Trainer can read
+    them instead of running the clean image through the encoder and head every step.
+    folder/
+        index.json: image_size, split, rows {key: row}, crops {path: [[y, x], ...]} ([] = resized)
+        latent.npy: [n, c, h, w] fp16
+        head.npy: [n, d] fp16
+    '''
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        with open(self.folder / 'index.json', 'r') as f:
+            index = json.load(f)
+        self.image_size = index['image_size']
+        self.split = index.get('split', 14)
+        self.rows = index['rows']
+        self.crops = index['crops']
+        self.latent = None
+        self.head = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, path):
+        return str(path) in self.crops
+
+    @staticmethod
+    def key(path, crop_yx=None):
+        if crop_yx is None:
+            return str(path)
+        return '%s|%d,%d'%(str(path), crop_yx[0], crop_yx[1])
+
+    def path_crops(self, path):
+        # stored crops of an image, [] = resized, the image must be in the store
+        if str(path) not in self.crops:
+            print('%s not in latent store %s (%d images), rebuild it with build_latent_store.py for these folders'%(
+                str(path), str(self.folder / 'index.json'), len(self.crops)))
+            path_not_in_latent_store
+        return self.crops[str(path)]
+
+    def open(self):
+        # every dataloader worker maps the files itself
+        if self.latent is None:
+            self.latent = np.load(str(self.folder / 'latent.npy'), mmap_mode='r')
+            self.head = np.load(str(self.folder / 'head.npy'), mmap_mode='r')
+
+    def get(self, path, crop_yx=None):
+        '''
+        Return:
+            latent: [c, h, w] fp16 tensor, head: [d] fp16 tensor
+        '''
+        self.open()
+        key = self.key(path, crop_yx)
+        if key not in self.rows:
+            print('%s not in latent store %s (%d rows), rebuild it with build_latent_store.py for these folders'%(
+                key, str(self.folder / 'index.json'), len(self.rows)))
+            path_not_in_latent_store
+        row = self.rows[key]
+        return torch.from_numpy(np.array(self.latent[row])), torch.from_numpy(np.array(self.head[row]))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['latent'] = None
+        state['head'] = None
+        return state
+
+    @staticmethod
+    def build(folder, diffusion, dataset, n_crops=4, batch_size=32):
+        '''
+        run the clean images of dataset through diffusion.yolomodel and write the store.
+        Input:
+            diffusion: GaussianDiffusion with the frozen yolomodel used for training
+            dataset: Dataset_cv2_aug_step of the training folders
+            n_crops: random crops per image for folders the dataset crops (cityscapes)
+        '''
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        yolomodel = diffusion.yolomodel
+        device = next(yolomodel.parameters()).device
+
+        items = []
+        crops = {}
+        for path in dataset.paths:
+            crops[str(path)] = []
+            if dataset.is_crop(path):
+                h, w = cv2.imread(str(path)).shape[:2]
+                for _ in range(n_crops):
+                    crop_yx = dataset.random_crop_yx(h, w, dataset.image_size)
+                    crops[str(path)].append(list(crop_yx))
+                    items.append((path, crop_yx))
+            else:
+                items.append((path, None))
+
+        latent, head, rows = None, None, {}
+        with torch.no_grad():
+            for start in tqdm(range(0, len(items), batch_size)):
+                batch = items[start:start+batch_size]
+                imgs = []
+                for path, crop_yx in batch:
+                    img, meta, crop_yx = dataset.load_clean(path, crop_yx)
+                    imgs.append(dataset.npytotorch(img))
+                imgs = torch.stack(imgs).to(device)
+                x_latent,y = yolomodel.forward_submodel(imgs,yolomodel.before_diffusion_model,output_y=True)
+                x_yolo = yolomodel.forward_submodel(x_latent,yolomodel.after_diffusion_model,init_y=y)
+                x_yolo_1d = diffusion.change_yolo_detect_to_1d(x_yolo,imgs.shape[0])
+                if latent is None:
+                    latent = np.lib.format.open_memmap(str(folder / 'latent.npy'), mode='w+', dtype=np.float16, shape=(len(items),) + tuple(x_latent.shape[1:]))
+                    head = np.lib.format.open_memmap(str(folder / 'head.npy'), mode='w+', dtype=np.float16, shape=(len(items),) + tuple(x_yolo_1d.shape[1:]))
+                latent[start:start+len(batch)] = x_latent.half().cpu().numpy()
+                head[start:start+len(batch)] = x_yolo_1d.half().cpu().numpy()
+                for i, (path, crop_yx) in enumerate(batch):
+                    rows[LatentStore.key(path, crop_yx)] = start + i
+        latent.flush()
+        head.flush()
+
+        with open(folder / 'index.json', 'w') as f:
+            json.dump({'image_size': dataset.image_size, 'split': getattr(yolomodel, 'split', 14), 'rows': rows, 'crops': crops}, f)
+        print('latent store: %d rows, latent %s, head %s in %s'%(len(items), str(latent.shape[1:]), str(head.shape[1:]), str(folder)))
+        return LatentStore(folder)
+
+
 class Dataset_cv2_aug_step(data.Dataset):
-    def __init__(self, folder, augmenter, image_size, exts = ['jpg', 'jpeg', 'png'], evalMode=False, labelTxtFolder=None, output_max_noise=False):
+    def __init__(self, folder, augmenter, image_size, exts = ['jpg', 'jpeg', 'png'], evalMode=False, labelTxtFolder=None, output_max_noise=False, latent_store=None):
         super().__init__()
         self.folder = folder
         self.image_size = image_size
         self.augmenter = augmenter
         self.evalMode = evalMode
         self.output_max_noise = output_max_noise
+        # LatentStore, __getitem__ also returns the clean latent and yolo head output
+        self.latent_store = latent_store
         #self.paths = [p for ext in exts for p in Path(f'{folder}').glob(f'**/*.{ext}')]
         self.paths=[]
         self.bname=[]
@@ -1385,6 +1778,7 @@ class Dataset_cv2_aug_step(data.Dataset):
             plates = l[1:]
             label_data[name] = plates
         self.label_data = label_data
+        self.plate_labels = PlateLabels(label_data) # parsed once for eval_dataset
         
     def getMetaFromHWC(self, h, w, c, size):
         #h,w,c=img.shape
@@ -1413,12 +1807,13 @@ class Dataset_cv2_aug_step(data.Dataset):
         path = self.paths[index]
         bname = self.bname[index]
         #print(path)
-        img = cv2.imread(str(path))
-        if 'cityscapes' in str(path):
-            img = self.crop(img, self.image_size)
-            #print(img.shape)
-        else:
-            img, meta = self.resize(img, self.image_size)
+        crop_yx = None
+        if self.latent_store is not None and not self.evalMode:
+            # only crops with a stored latent
+            store_crops = self.latent_store.path_crops(path)
+            if len(store_crops) > 0:
+                crop_yx = store_crops[randint(0, len(store_crops)-1)]
+        img, meta, crop_yx = self.load_clean(path, crop_yx)
 
         
         step = randint(0,99)
@@ -1440,10 +1835,37 @@ class Dataset_cv2_aug_step(data.Dataset):
 
         else:
             if self.output_max_noise:
-                return [img_torch, img_blur_torch, img_blur_max_torch, step]
+                output = [img_torch, img_blur_torch, img_blur_max_torch, step]
             else:
-                return [img_torch, img_blur_torch, step]
-    
+                output = [img_torch, img_blur_torch, step]
+            if self.latent_store is not None:
+                output = output + list(self.latent_store.get(path, crop_yx))
+            return output
+
+    def is_crop(self, path):
+        return 'cityscapes' in str(path)
+
+    def load_clean(self, path, crop_yx=None):
+        '''
+        Input:
+            crop_yx: top left corner of the crop, random when None (only for is_crop paths)
+        Return:
+            img (HWC BGR), meta, crop_yx (None when the image is resized)
+        '''
+        img = cv2.imread(str(path))
+        if self.is_crop(path):
+            h, w, c = img.shape
+            if crop_yx is None:
+                crop_yx = self.random_crop_yx(h, w, self.image_size)
+            y, x = crop_yx
+            img = img[y:y+self.image_size,x:x+self.image_size,:]
+            meta = {}
+            #print(img.shape)
+        else:
+            img, meta = self.resize(img, self.image_size)
+            crop_yx = None
+        return img, meta, crop_yx
+
     def npytotorch(self, img):
         img = (img / 255.).astype(np.float32)
         img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x512x512
@@ -1475,13 +1897,17 @@ class Dataset_cv2_aug_step(data.Dataset):
     def crop(self, img, size):
         h, w, c= img.shape
         #print(img.shape)
+        y, x = self.random_crop_yx(h, w, size)
+        #print('x= %d,y= %d, size= %d'%(x,y,size))
+        return img[y:y+size,x:x+size,:]
+
+    def random_crop_yx(self, h, w, size):
         low=0
         highh=h-size
         highw=w-size
         y = np.random.randint(low=low,high=highh)
         x = np.random.randint(low=low,high=highw)
-        #print('x= %d,y= %d, size= %d'%(x,y,size))
-        return img[y:y+size,x:x+size,:]
+        return y, x
 
         
 # trainer class
@@ -1511,7 +1937,8 @@ class Trainer(object):
         load_path = None,
         dataset = None,
         shuffle=True,
-        test_mode=False
+        test_mode=False,
+        latent_store = None
     ):
         super().__init__()
         self.model = diffusion_model
@@ -1540,7 +1967,15 @@ class Trainer(object):
             print('eval data in %s loading complete.'%str(eval_data_folder))
 
             
-        self.ds = Dataset_cv2_aug_step(folder, self.aug_licence, image_size)
+        self.latent_store = None
+        if latent_store is not None:
+            self.latent_store = LatentStore(latent_store)
+            split = getattr(self.model.module.yolomodel, 'split', 14)
+            if self.latent_store.split != split:
+                print('latent store split %d but yolomodel split %d, rebuild it with build_latent_store.py --split %d'%(self.latent_store.split, split, split))
+                dsa
+            print('clean latents from latent store %s (%d rows)'%(str(latent_store), len(self.latent_store)))
+        self.ds = Dataset_cv2_aug_step(folder, self.aug_licence, image_size, latent_store=self.latent_store)
 
         self.dl = cycle(data.DataLoader(self.ds, batch_size = train_batch_size, shuffle=shuffle, pin_memory=True, num_workers=32,drop_last=True))
         #self.opt = Adam(diffusion_model.parameters(), lr=train_lr)
@@ -1589,7 +2024,8 @@ class Trainer(object):
                 'load_path':load_path,
                 'dataset':dataset,
                 'noiseStepMode':'default',
-                'shuffle':shuffle
+                'shuffle':shuffle,
+                'latent_store':latent_store
                 }
 
             )
@@ -1682,7 +2118,8 @@ class Trainer(object):
         while self.step < self.train_num_steps:
             u_loss = 0
             for i in range(self.gradient_accumulate_every):
-                data, data_blur, step = next(self.dl)#.cuda()
+                batch = next(self.dl)#.cuda()
+                data, data_blur, step = batch[:3]
                 data = data.cuda()
                 data_blur = data_blur.cuda()
                 step = step.cuda()
@@ -1691,7 +2128,10 @@ class Trainer(object):
                 #print('step.shape = '+str(step.shape))
                 #print('step = '+str(step))
                 
-                loss = torch.mean(self.model(data, data_blur, step))
+                if self.latent_store is not None:
+                    loss = torch.mean(self.model(data, data_blur, step, x_start_latent=batch[3].cuda(), x_start_yolo_1d=batch[4].cuda()))
+                else:
+                    loss = torch.mean(self.model(data, data_blur, step))
                 print(f'{self.step}: {loss.item()}')
                 u_loss += loss.item()
                 backwards(loss / self.gradient_accumulate_every, self.opt)
@@ -1708,7 +2148,7 @@ class Trainer(object):
             if self.step != 0 and self.step % self.save_and_sample_every == 0:
                 milestone = self.step // self.save_and_sample_every
                 batches = self.batch_size
-                data, data_blur, step = next(self.dl)#.cuda()
+                data, data_blur, step = next(self.dl)[:3]#.cuda()
                 data = data.cuda()
                 data_blur = data_blur.cuda()
                 step = step.cuda()
@@ -1787,37 +2227,17 @@ class Trainer(object):
                             #yolo_output_clean = self.ema_model(data_clean, data_clean, step, mode='wodiffusion')
                             
                             
-                            for index_yolooutput , _yolo_output in enumerate(yolo_output):
-                                if _yolo_output is not None:
-                                    sub_meta = {}
-                                    for metakey in meta.keys():
-                                        sub_meta[metakey] = meta[metakey][index_yolooutput]
-                                        
-                                    output = affine_transform(_yolo_output, sub_meta)
-                                    yolo_results[bname[index_yolooutput]] = output
-                                    
-                            for index_yolooutput , _yolo_output in enumerate(yolo_output_wodifussion):
-                                if _yolo_output is not None:
-                                    sub_meta = {}
-                                    for metakey in meta.keys():
-                                        sub_meta[metakey] = meta[metakey][index_yolooutput]
-                                        
-                                    output = affine_transform(_yolo_output, sub_meta)
-                                    yolo_results_wodifussion[bname[index_yolooutput]] = output
-
-                                    
-                            for index_yolooutput , _yolo_output in enumerate(yolo_output_clean):
-                                if _yolo_output is not None:
-                                    sub_meta = {}
-                                    for metakey in meta.keys():
-                                        sub_meta[metakey] = meta[metakey][index_yolooutput]
-                                        
-                                    output = affine_transform(_yolo_output, sub_meta)
-                                    yolo_results_clean[bname[index_yolooutput]] = output
-
-                        eval_dict = eval_dataset(yolo_results, self.evalDs.label_data)
-                        eval_dict_wodifussion = eval_dataset(yolo_results_wodifussion, self.evalDs.label_data,flag='_wodiffusion')
-                        eval_dict_clean = eval_dataset(yolo_results_clean, self.evalDs.label_data,flag='_clean')
+                            # back projection of the whole batch at once, meta is the collated {'nw': [b], ...}
+                            for results_dict, batch_output in [(yolo_results, yolo_output),
+                                                               (yolo_results_wodifussion, yolo_output_wodifussion),
+                                                               (yolo_results_clean, yolo_output_clean)]:
+                                for index_yolooutput, output in enumerate(affine_transform_batch(batch_output, meta)):
+                                    if output is not None:
+                                        results_dict[bname[index_yolooutput]] = output
+
+                        eval_dict = eval_dataset(yolo_results, self.evalDs.plate_labels)
+                        eval_dict_wodifussion = eval_dataset(yolo_results_wodifussion, self.evalDs.plate_labels,flag='_wodiffusion')
+                        eval_dict_clean = eval_dataset(yolo_results_clean, self.evalDs.plate_labels,flag='_clean')
                         licence_detect_gt = eval_dict['plate_detect_gt']
                         
                         #acc_val_loss = acc_val_loss + (u_val_loss/eval_len)
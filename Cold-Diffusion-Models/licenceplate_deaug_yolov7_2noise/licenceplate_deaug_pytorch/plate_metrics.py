@@ -0,0 +1,280 @@
+import numpy as np
+
+try:
+    import Levenshtein
+    LEVENSHTEIN_AVAILABLE = True
+except:
+    LEVENSHTEIN_AVAILABLE = False
+
+PLATE_CLASS = 34
+CLASS_CHARS = np.array(['0', '1', '2', '3', '4', '5', '6', '7', '8', '9',
+                        'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J', 'K',
+                        'L', 'M', 'N', 'P', 'Q', 'R', 'S', 'T', 'U', 'V',
+                        'W', 'X', 'Y', 'Z', 'Plate'])
+
+
+class PlateLabels(object):
+    '''
+    label.txt parsed once into arrays.
+    Input:
+        label_data: {name: ['x_min,y_min,x_max,y_max,plate', ...]} (label_data of the eval scripts)
+    Attributes:
+        names: image names in label_data order
+        boxes: int64 [n_plates, 4] ground truth plates of all images
+        strings: plate string of each row of boxes
+        count: int64 [n_images] plates per image, rows of image i are boxes[start[i]: start[i] + count[i]]
+    '''
+    def __init__(self, label_data):
+        self.names = list(label_data.keys())
+        self.index = {name: i for i, name in enumerate(self.names)}
+        boxes = []
+        self.strings = []
+        self.count = np.zeros(len(self.names), dtype=np.int64)
+        for i, name in enumerate(self.names):
+            for l in label_data[name]:
+                _l = l.split(',')
+                boxes.append([int(_l[0]), int(_l[1]), int(_l[2]), int(_l[3])])
+                self.strings.append(_l[-1])
+            self.count[i] = len(label_data[name])
+        self.boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+        self.start = np.cumsum(self.count) - self.count
+
+    @staticmethod
+    def from_file(label_txt):
+        label_data = {}
+        with open(label_txt, 'r') as label_file:
+            for line in label_file.readlines():
+                l = line.strip().split(' ')
+                label_data[l[0]] = l[1:]
+        return PlateLabels(label_data)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def as_plate_labels(label_data):
+    if isinstance(label_data, PlateLabels):
+        return label_data
+    return PlateLabels(label_data)
+
+
+def group_pairs(a_count, b_count):
+    '''
+    All (a, b) pairs inside each group, group by group, a major and b minor, the order of
+    the nested for loops over a and b of one image.
+    Input:
+        a_count, b_count: int64 [n_groups] rows of a and b in each group (rows sorted by group)
+    Return:
+        ia, ib: int64 [sum(a_count * b_count)] row of a and row of b of each pair
+    '''
+    n = a_count * b_count
+    total = int(n.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    k = np.arange(total) - np.repeat(np.cumsum(n) - n, n)
+    b_rep = np.repeat(b_count, n)
+    ia = np.repeat(np.cumsum(a_count) - a_count, n) + k // b_rep
+    ib = np.repeat(np.cumsum(b_count) - b_count, n) + k % b_rep
+    return ia, ib
+
+
+def pair_iou(bb1, bb2):
+    '''
+    get_iou of every row pair, bb1[i] against bb2[i].
+    Input:
+        bb1, bb2: [n, 4] (x_min, y_min, x_max, y_max)
+    '''
+    inter_w = np.clip(np.minimum(bb1[:, 2], bb2[:, 2]) - np.maximum(bb1[:, 0], bb2[:, 0]), 0, None)
+    inter_h = np.clip(np.minimum(bb1[:, 3], bb2[:, 3]) - np.maximum(bb1[:, 1], bb2[:, 1]), 0, None)
+    inter = inter_w * inter_h
+    union = (bb1[:, 2] - bb1[:, 0]) * (bb1[:, 3] - bb1[:, 1]) + (bb2[:, 2] - bb2[:, 0]) * (bb2[:, 3] - bb2[:, 1]) - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1).astype(np.float64), 0.)
+
+
+def pair_contain(bb1, bb2):
+    '''
+    check_bbox of every row pair, the larger box of bb1[i] and bb2[i] covers the other one.
+    '''
+    area1 = (bb1[:, 2] - bb1[:, 0]) * (bb1[:, 3] - bb1[:, 1])
+    area2 = (bb2[:, 2] - bb2[:, 0]) * (bb2[:, 3] - bb2[:, 1])
+    swap = (area1 < area2)[:, None]
+    large = np.where(swap, bb2, bb1)
+    small = np.where(swap, bb1, bb2)
+    return (large[:, 0] <= small[:, 0]) & (large[:, 1] <= small[:, 1]) & (large[:, 2] >= small[:, 2]) & (large[:, 3] >= small[:, 3])
+
+
+def edit_distance(r, h):
+    '''
+    sid of get_wer (substitution + insertion + deletion) of two strings.
+    '''
+    if r == h:
+        return 0
+    if LEVENSHTEIN_AVAILABLE:
+        return Levenshtein.distance(r, h)
+    # common prefix / suffix cost nothing
+    while len(r) > 0 and len(h) > 0 and r[0] == h[0]:
+        r, h = r[1:], h[1:]
+    while len(r) > 0 and len(h) > 0 and r[-1] == h[-1]:
+        r, h = r[:-1], h[:-1]
+    prev = list(range(len(h) + 1))
+    for i in range(1, len(r) + 1):
+        cur = [i] + [0] * len(h)
+        for j in range(1, len(h) + 1):
+            if r[i - 1] == h[j - 1]:
+                cur[j] = prev[j - 1]
+            else:
+                cur[j] = min(prev[j - 1], cur[j - 1], prev[j]) + 1
+        prev = cur
+    return prev[-1]
+
+
+def stack_results(results, names):
+    '''
+    Input:
+        results: {name: [num_objs, 6(x1, y1, x2, y2, conf, cls)]} of affine_transform
+        names: image order
+    Return:
+        boxes int64 [n, 4], cls int64 [n], count int64 [len(names)] objs per image
+    '''
+    dets = []
+    count = np.zeros(len(names), dtype=np.int64)
+    for i, name in enumerate(names):
+        if name in results:
+            det = np.asarray(results[name], dtype=np.float64).reshape(-1, 6)
+            dets.append(det)
+            count[i] = det.shape[0]
+    dets = np.concatenate(dets, 0) if len(dets) > 0 else np.zeros((0, 6))
+    # int() of group_plate, truncation toward zero
+    return dets[:, :4].astype(np.int64), dets[:, 5].astype(np.int64), count
+
+
+def group_plate_arrays(boxes, cls, count):
+    '''
+    group_plate of many images at once.
+    Input:
+        boxes, cls, count: stack_results output
+    Return:
+        plate_boxes int64 [n_plates, 4], plate_count int64 [n_images],
+        plate_str: string of the chars inside each plate, sorted by x_min,
+        (ic, ip): char row and plate row of each char in a plate, in plate_str order
+    '''
+    image = np.repeat(np.arange(len(count)), count)
+    is_plate = cls == PLATE_CLASS
+    plate_boxes = boxes[is_plate]
+    plate_count = np.bincount(image[is_plate], minlength=len(count))
+    char_boxes = boxes[~is_plate]
+    char_cls = cls[~is_plate]
+    char_count = np.bincount(image[~is_plate], minlength=len(count))
+
+    ic, ip = group_pairs(char_count, plate_count)
+    inside = pair_contain(plate_boxes[ip], char_boxes[ic])
+    ic, ip = ic[inside], ip[inside]
+    # by plate, then x_min, then detection order (sorted() is stable)
+    order = np.lexsort((ic, char_boxes[ic, 0], ip))
+    ic, ip = ic[order], ip[order]
+    chars = CLASS_CHARS[char_cls[ic]].tolist()
+    end = np.cumsum(np.bincount(ip, minlength=len(plate_boxes))).tolist()
+    plate_str = [''.join(chars[a:b]) for a, b in zip([0] + end[:-1], end)]
+    return plate_boxes, plate_count, plate_str, (ic, ip)
+
+
+def group_plate(outp):
+    '''
+    Vectorized group_plate, same output.
+    Input:
+        outp = float[[x1, y1, x2, y2, score, class], ...]
+    Return:
+        a sorted list of dict [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, idx], ...]}, ...]
+    '''
+    boxes, cls, count = stack_results({0: outp}, [0])
+    plate_boxes, plate_count, plate_str, (ic, ip) = group_plate_arrays(boxes, cls, count)
+    char_boxes = boxes[cls != PLATE_CLASS]
+    char_cls = cls[cls != PLATE_CLASS]
+    groups = [{'plate': p.tolist(), 'char': []} for p in plate_boxes]
+    for c, p in zip(ic.tolist(), ip.tolist()):
+        groups[p]['char'].append(char_boxes[c].tolist() + [int(char_cls[c])])
+    return groups
+
+
+def plate_counts(results, label_data):
+    '''
+    Counts of eval_dataset, one pass over all images.
+    Input:
+        results: {name: [num_objs, 6(x1, y1, x2, y2, conf, cls)]}
+        label_data: {name: ['x_min,y_min,x_max,y_max,plate', ...]} or PlateLabels
+    Return:
+        {'total_p', 'pred_p', 'correct_p', 'n_perfect', 'n_sid', 'n_detected'}
+    '''
+    labels = as_plate_labels(label_data)
+    boxes, cls, count = stack_results(results, labels.names)
+    plate_boxes, plate_count, plate_str, _ = group_plate_arrays(boxes, cls, count)
+
+    # plate - groundtruth matching, every (predict, gt) pair of an image
+    ip, ig = group_pairs(plate_count, labels.count)
+    match = pair_iou(labels.boxes[ig], plate_boxes[ip]) >= 0.5
+    ip, ig = ip[match], ig[match]
+
+    n_perfect, n_sid, n_detected = 0, 0, 0
+    for p, g in zip(ip.tolist(), ig.tolist()):
+        gt_str = labels.strings[g]
+        sid = edit_distance(gt_str, plate_str[p])
+        n_sid += sid
+        n_detected += len(gt_str)
+        if sid == 0:
+            n_perfect += 1
+    return {'total_p': len(labels.boxes), 'pred_p': len(plate_boxes), 'correct_p': len(ip),
+            'n_perfect': n_perfect, 'n_sid': n_sid, 'n_detected': n_detected}
+
+
+def eval_dataset(results, label_data, flag=''):
+    '''
+    eval_dataset of yolo_utils on the vectorized counts, same prints and accuracy_dict keys.
+    '''
+    counts = plate_counts(results, label_data)
+    total_p, pred_p, correct_p = counts['total_p'], counts['pred_p'], counts['correct_p']
+    n_perfect, n_sid, n_detected = counts['n_perfect'], counts['n_sid'], counts['n_detected']
+
+    if not pred_p == 0:
+        print("Number of Correctly Detected Plates =", correct_p)
+        print("Number of Detected Plates =", pred_p)
+        print("Number of All Plates =", total_p)
+        recall = correct_p/total_p
+        print("Recall = {:.4f}".format(recall))
+        precision = correct_p/pred_p
+        print("Precision = {:.4f}".format(precision))
+
+        print("Characters in Detected Plates = ", n_detected)
+        print("Error Characters (Detected) =", n_sid)
+        WER_det = n_sid/n_detected if not n_detected == 0 else 0
+        WER_gt = n_sid/n_perfect if not n_perfect == 0 else 0
+        print("World Error Rate (Detected) = {:.4f}".format(WER_det))
+        print("World Error Rate (Ground Truth) = {:.4f}".format(WER_gt))
+
+        print("\nNumber of Perfectly Recognized Plates = ", n_perfect)
+        plate_detect_det = n_perfect/correct_p if not correct_p == 0 else 0
+        print("Accuracy(Detected) = {:.4f}".format(plate_detect_det))
+        plate_detect_gt = n_perfect/total_p
+        print("Accuracy(Groundtruth) = {:.4f}".format(plate_detect_gt))
+    else:
+        plate_detect_det = 0
+        plate_detect_gt = 0
+        recall = 0
+        precision = 0
+        WER_det = 0
+        WER_gt = 0
+
+    accuracy_dict = {
+        'plate_detect_gt'+flag: plate_detect_gt,
+        'plate_detect_det'+flag: plate_detect_det,
+        'n_perfect'+flag: n_perfect,
+        'WER_det'+flag: WER_det,
+        'WER_gt'+flag: WER_gt,
+        'n_detected'+flag: n_detected,
+        'n_sid'+flag: n_sid,
+        'correct_p'+flag: correct_p,
+        'pred_p'+flag: pred_p,
+        'total_p'+flag: total_p,
+        'recall'+flag: recall,
+        'precision'+flag: precision
+    }
+    return accuracy_dict
@@ -4,6 +4,7 @@ import numpy as np
 import torch
 import torchvision
 import cv2
+from licenceplate_deaug_pytorch import plate_metrics
 
 
 def _classes():
@@ -117,6 +118,50 @@ def affine_transform(dets, meta):
     else:
         return dets
 
+META_KEYS = ['nw', 'nh', 'dw', 'dh', 'w', 'h']
+
+def stack_meta(meta, batch_size, device=None):
+    '''
+    Input:
+        meta: meta of a batch, collated by the dataloader {'nw': [b], 'nh': [b], ...}
+              or a list of per image meta ({} when the image was not resized)
+    Return:
+        float64 [b, 6(nw, nh, dw, dh, w, h)], (1, 1, 0, 0, 1, 1) for {}
+    '''
+    if isinstance(meta, dict):
+        if len(meta) == 0:
+            meta = [{}] * batch_size
+        else:
+            return torch.stack([torch.as_tensor(meta[k], dtype=torch.float64) for k in META_KEYS], 1).to(device)
+    rows = [[m[k] for k in META_KEYS] if len(m) > 0 else [1, 1, 0, 0, 1, 1] for m in meta]
+    return torch.tensor(rows, dtype=torch.float64, device=device).reshape(-1, 6)
+
+def affine_transform_batch(dets, meta):
+    '''
+    affine_transform of a whole batch, all boxes are mapped in one op on their device and
+    copied to the host once.
+    Input:
+        dets = non_max_suppression output, [batch](None or [num_objs, 6(x1, y1, x2, y2, conf, cls)])
+        meta = stacked meta of the batch, see stack_meta
+    Return:
+        [batch](None or numpy [num_objs, 6]), same as affine_transform(dets[i], meta[i])
+    '''
+    keep = [i for i, d in enumerate(dets) if d is not None]
+    output = [None] * len(dets)
+    if len(keep) == 0:
+        return output
+    x = torch.cat([dets[i] for i in keep], 0)
+    meta = stack_meta(meta, len(dets), x.device)
+    count = torch.tensor([dets[i].shape[0] for i in keep], device=x.device)
+    m = meta[torch.repeat_interleave(torch.tensor(keep, device=x.device), count)]
+    # M of cv2.getAffineTransform is diag(w / nw, h / nh), the offset is removed first
+    box = x[:, :4] - m[:, [2, 3, 2, 3]].to(x.dtype)
+    box = box.double() * (m[:, [4, 5, 4, 5]] / m[:, [0, 1, 0, 1]])
+    x = torch.cat([box.to(x.dtype), x[:, 4:]], 1).cpu().numpy()
+    for i, d in zip(keep, np.split(x, np.cumsum(count.tolist())[:-1])):
+        output[i] = d
+    return output
+
 def preproccess_img(img_path):
     img = cv2.imread(img_path)
     #h,w,c=img.shape
@@ -599,92 +644,101 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
 
     return output
 
-def eval_dataset(results,label_data,flag=''):
-    correct_plate = {}
-    total_p, correct_p, pred_p = 0, 0, 0
-    for k, v in label_data.items():
-        gt = transfer_label(v)
-        total_p += len(gt)
-        if k in results:
-            r = group_plate(results[k]) # r = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...]}, ...]
-            pred_p += len(r)
-            correct_r = []
-            for _r in r:
-                for idx, bbox in enumerate(gt):
-                    if get_iou(bbox, _r['plate']) >= 0.5:
-                        n_r = {'plate': _r['plate'], 'char': _r['char'], 'idx': idx}
-                        correct_r.append(n_r)
-            num = len(correct_r)
-            if num > 0:
-                correct_plate[k] = correct_r
-                correct_p += num
-                
-    n_perfect = 0  ### number of perfectly recognized plates
-    n_sid = 0  ### number of failed recognized chars in detected
-    n_detected = 0  ### number of chars in detected plates
-
-    if not pred_p ==0:
-
-                
-        print("Number of Correctly Detected Plates =", correct_p)
-        print("Number of Detected Plates =", pred_p)
-        print("Number of All Plates =", total_p)
-        recall=correct_p/total_p
-        print("Recall = {:.4f}".format(recall))
-        precision=correct_p/pred_p
-        print("Precision = {:.4f}".format(precision))
-        classes = _classes()
-
-        for k, v in label_data.items():
-            gt_strs = [s.split(',')[-1] for s in v]
-            if k in correct_plate:
-                objs = correct_plate[k]
-                for obj in objs: # obj = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...], 'idx': int(i)}]
-                    pred_str = [classes[x[-1]] for x in obj['char']]
-                    wer, sid, t = get_wer(list(gt_strs[obj['idx']]), pred_str)
-                    n_sid += sid
-                    n_detected += t
-                    if wer == 0:
-                        n_perfect += 1
-
-
-        print("Characters in Detected Plates = ", n_detected)
-        print("Error Characters (Detected) =", n_sid)
-        WER_det=n_sid/n_detected
-        WER_gt=n_sid/n_perfect
-        print("World Error Rate (Detected) = {:.4f}".format(WER_det))
-        print("World Error Rate (Ground Truth) = {:.4f}".format(WER_gt))
-
-        print("\nNumber of Perfectly Recognized Plates = ", n_perfect)
-        if not correct_p ==0:
-            plate_detect_det = n_perfect/correct_p
-        else:
-            plate_detect_det=0
-        print("Accuracy(Detected) = {:.4f}".format(plate_detect_det))
-        plate_detect_gt = n_perfect/total_p
-        print("Accuracy(Groundtruth) = {:.4f}".format(plate_detect_gt))
+def non_max_suppression_batch(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
+                              max_det=300, group_plate=False, plate_class=34):
+    """Runs Non-Maximum Suppression (NMS) on a whole batch with one nms call
+
+    Same candidates, conf and class offsets as non_max_suppression, images are kept apart by a
+    coordinate offset instead of a python loop over the batch, and there is no time_limit.
+    Detections of an image are sorted by conf with ties in candidate order, so max_det keeps
+    the same boxes on every run and device.
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+         with group_plate also a list of (m, 2) long tensors per image, [plate row, char row] for
+         every char inside a plate_class detection, the rules of group_plate / check_bbox in the
+         eval scripts: int pixel boxes, the larger box of the pair must cover the smaller one, a
+         char can be in several plates. Sorted by char row, then plate row.
+    """
+
+    bs = prediction.shape[0]
+    nc = prediction.shape[2] - 5  # number of classes
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    multi_label &= nc > 1  # multiple labels per box
+
+    bi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # candidates of all images
+    x = prediction[bi, ai]
+    if nc == 1:
+        conf = x[:, 4:5]
     else:
-        plate_detect_det=0
-        plate_detect_gt=0
-        recall=0
-        precision=0
-        WER_det = 0
-        WER_gt = 0
-
-    accuracy_dict={
-        'plate_detect_gt'+flag:plate_detect_gt,
-        'plate_detect_det'+flag:plate_detect_det,
-        'n_perfect'+flag:n_perfect,
-        'WER_det'+flag:WER_det,
-        'WER_gt'+flag:WER_gt,
-        'n_detected'+flag:n_detected,
-        'n_sid'+flag:n_sid,
-        'correct_p'+flag:correct_p,
-        'pred_p'+flag:pred_p,
-        'total_p'+flag:total_p,
-        'recall'+flag:recall,
-        'precision'+flag:precision
-        
-    }
-    
-    return accuracy_dict
\ No newline at end of file
+        conf = x[:, 5:] * x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])
+
+    if multi_label:
+        i, j = (conf > conf_thres).nonzero(as_tuple=True)
+        x = torch.cat((box[i], conf[i, j, None], j[:, None].float()), 1)
+        image = bi[i]
+    else:  # best class only
+        conf, j = conf.max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x = torch.cat((box, conf, j.float()), 1)[keep]
+        image = bi[keep]
+
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, image = x[keep], image[keep]
+
+    # by image, then conf, ties in candidate order, and at most max_nms per image
+    order = torch.sort(x[:, 4], descending=True, stable=True)[1]
+    order = order[torch.sort(image[order], stable=True)[1]]
+    x, image = x[order], image[order]
+    count = torch.bincount(image, minlength=bs)
+    start = torch.cumsum(count, 0) - count
+    keep = (torch.arange(x.shape[0], device=x.device) - start[image]) < max_nms
+    x, image = x[keep], image[keep]
+
+    # Batched NMS, class offset of non_max_suppression and an image offset larger than all boxes
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes = (x[:, :4] + c).double()
+    if boxes.shape[0]:
+        boxes = boxes + image[:, None].double() * (boxes.max() - boxes.min() + 1)
+    i = torchvision.ops.nms(boxes, x[:, 4].double(), iou_thres)  # NMS
+    i = i.sort()[0]  # back to image, conf, candidate order
+    image = image[i]
+    count = torch.bincount(image, minlength=bs)
+    start = torch.cumsum(count, 0) - count
+    keep = (torch.arange(i.shape[0], device=x.device) - start[image]) < max_det  # limit detections
+    x, image = x[i[keep]], image[keep]
+    count = torch.bincount(image, minlength=bs)
+    output = list(x.split(count.tolist()))
+
+    if not group_plate:
+        return output
+
+    # chars of each plate inside the same image, check_bbox on int boxes
+    start = torch.cumsum(count, 0) - count
+    is_plate = x[:, 5] == plate_class
+    plate = is_plate.nonzero().view(-1)  # [n, plates] pairs, few plates per batch
+    b = x[:, :4].trunc()
+    p = b[plate]
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    p_in_b = (b[:, None, 0] <= p[None, :, 0]) & (b[:, None, 1] <= p[None, :, 1])
+    p_in_b &= (b[:, None, 2] >= p[None, :, 2]) & (b[:, None, 3] >= p[None, :, 3])
+    b_in_p = (p[None, :, 0] <= b[:, None, 0]) & (p[None, :, 1] <= b[:, None, 1])
+    b_in_p &= (p[None, :, 2] >= b[:, None, 2]) & (p[None, :, 3] >= b[:, None, 3])
+    inside = torch.where(area[plate][None, :] >= area[:, None], b_in_p, p_in_b)  # larger box covers the smaller
+    inside &= (image[:, None] == image[plate][None, :]) & ~is_plate[:, None]
+    k, q = inside.nonzero(as_tuple=True)
+    pairs = torch.stack((plate[q] - start[image[k]], k - start[image[k]]), 1)
+    return output, list(pairs.split(torch.bincount(image[k], minlength=bs).tolist()))
+
+def eval_dataset(results,label_data,flag=''):
+    '''
+    Input:
+        results: {name: [num_objs, 6(x1, y1, x2, y2, conf, cls)]}
+        label_data: {name: ['x_min,y_min,x_max,y_max,plate', ...]} or plate_metrics.PlateLabels
+    Return:
+        accuracy_dict, vectorized in plate_metrics.eval_dataset
+    '''
+    return plate_metrics.eval_dataset(results, label_data, flag=flag)
@@ -41,8 +41,10 @@ parser.add_argument('--yolomodel', default='/data/licence_plate/_yolo/yolov7/run
 parser.add_argument('--yolohyperparam', default='/data/licence_plate/_yolo/yolov7/cfg/deploy/hyp.scratch.tiny.yaml', type=str)
 parser.add_argument('--yolocfg', default='/data/licence_plate/_yolo/yolov7/cfg/training/yolov7-tiny.yaml', type=str)
 parser.add_argument('--yoloclass', default=35, type=int)
+parser.add_argument('--split', default='14', type=str)#last yolo layer before diffusion, index or stage name like P3
 parser.add_argument('--eval_data_path', default='/data/licence_plate/_plate/generated_data/result4/img/', type=str)
 parser.add_argument('--eval_data_label_path', default='/data/licence_plate/_plate/generated_data/result4/label.txt', type=str)
+parser.add_argument('--latent_store', default=None, type=str)#folder from build_latent_store.py
 
 
 args = parser.parse_args()
@@ -54,7 +56,7 @@ with open(args.yolohyperparam) as f:
 yolomodel = Model_with_diffusion(args.yolocfg, ch=3, nc=args.yoloclass, anchors=hyp.get('anchors')).cuda() # create
 yolomodel.load_state_dict(torch.load(args.yolomodel))
 yolomodel.eval()
-yolomodel.create_subnetwork()
+yolomodel.create_subnetwork(split=int(args.split) if args.split.lstrip('-').isdigit() else args.split)
 #yolomodel = torch.nn.DataParallel(yolomodel, device_ids=range(torch.cuda.device_count()))
 
 #yolomodel = torch.nn.DataParallel(yolomodel, device_ids=range(torch.cuda.device_count()))
@@ -79,7 +81,7 @@ yolomodel.create_subnetwork()
 model = Unet_2timeEmb(
     dim = 64,
     dim_mults = (1, 2, 4, 8),
-    channels=128,
+    channels=yolomodel.latent_channels,
     with_time_emb=not(args.remove_time_embed),
     residual=args.residual,
     predict_noise=args.predict_noise
@@ -88,9 +90,9 @@ model = Unet_2timeEmb(
 if args.interpolate_noise:
     diffusion = interpolateDiffusion(
         model,
-        image_size = 64,
+        image_size = 512 // yolomodel.latent_stride,
         device_of_kernel = 'cuda',
-        channels = 128,
+        channels = yolomodel.latent_channels,
         timesteps = args.time_steps,        # number of steps
         t_steps = args.t_steps,        # number of steps
         g_steps = args.g_steps,        # number of steps
@@ -105,9 +107,9 @@ else:
     
     diffusion = GaussianDiffusion(
         model,
-        image_size = 64,
+        image_size = 512 // yolomodel.latent_stride,
         device_of_kernel = 'cuda',
-        channels = 128,
+        channels = yolomodel.latent_channels,
         timesteps = args.time_steps,        # number of steps
         t_steps = args.t_steps,        # number of steps
         g_steps = args.g_steps,        # number of steps
@@ -141,7 +143,8 @@ trainer = Trainer(
     load_path = args.load_path,
     dataset = 'AOLP',
     eval_data_folder = args.eval_data_path,
-    eval_data_label_folder = args.eval_data_label_path
+    eval_data_label_folder = args.eval_data_label_path,
+    latent_store = args.latent_store
 )
 
 trainer.train()
@@ -138,11 +138,20 @@ class LayerNorm(nn.Module):
         self.eps = eps
         self.g = nn.Parameter(torch.ones(1, dim, 1, 1))
         self.b = nn.Parameter(torch.zeros(1, dim, 1, 1))
+        self.fused = False
 
     def forward(self, x):
-        var = torch.var(x, dim = 1, unbiased = False, keepdim = True)
-        mean = torch.mean(x, dim = 1, keepdim = True)
-        return (x - mean) / (var + self.eps).sqrt() * self.g + self.b
+        if self.fused:
+            # one layer_norm kernel over the channels of the NHWC view (no copy for channels_last x),
+            # the output keeps the memory format of x for the next conv
+            y = F.layer_norm(x.permute(0, 2, 3, 1).float(), (x.shape[1],), self.g.view(-1).float(), self.b.view(-1).float(), self.eps)
+            memory_format = torch.channels_last if x.is_contiguous(memory_format = torch.channels_last) else torch.contiguous_format
+            return y.permute(0, 3, 1, 2).to(x.dtype).contiguous(memory_format = memory_format)
+        # statistics in float32, var of fp16 / bf16 activations under autocast overflows
+        x32 = x.float()
+        var = torch.var(x32, dim = 1, unbiased = False, keepdim = True)
+        mean = torch.mean(x32, dim = 1, keepdim = True)
+        return ((x32 - mean) / (var + self.eps).sqrt() * self.g + self.b).to(x.dtype)
 
 class PreNorm(nn.Module):
     def __init__(self, dim, fn):
@@ -176,16 +185,32 @@ class ConvNextBlock(nn.Module):
         )
 
         self.res_conv = nn.Conv2d(dim, dim_out, 1) if dim != dim_out else nn.Identity()
+        # Unet.inference_mode: mlp(time embedding) of every t, and ds_conv bias + condition of a fixed t
+        self.register_buffer('cond_table', None, persistent = False)
+        self.register_buffer('fixed_bias', None, persistent = False)
+        self.fused = False
 
     def forward(self, x, time_emb = None):
-        h = self.ds_conv(x)
+        if exists(self.fixed_bias):
+            h = F.conv2d(x, self.ds_conv.weight, self.fixed_bias, padding = 3, groups = self.ds_conv.groups)
+        else:
+            h = self.ds_conv(x)
 
-        if exists(self.mlp):
+        if exists(self.mlp) and not exists(self.fixed_bias):
             assert exists(time_emb), 'time emb must be passed in'
-            condition = self.mlp(time_emb)
-            h = h + rearrange(condition, 'b c -> b c 1 1')
+            if exists(self.cond_table) and not time_emb.is_floating_point():
+                condition = self.cond_table[time_emb]  # time_emb is the step
+            else:
+                condition = self.mlp(time_emb)
+            if self.fused:
+                h += condition[:, :, None, None].to(h.dtype)  # h is a fresh conv output
+            else:
+                h = h + rearrange(condition, 'b c -> b c 1 1')
 
         h = self.net(h)
+        if self.fused:
+            h += self.res_conv(x)
+            return h
         return h + self.res_conv(x)
 
 class LinearAttention(nn.Module):
@@ -196,8 +221,20 @@ class LinearAttention(nn.Module):
         hidden_dim = dim_head * heads
         self.to_qkv = nn.Conv2d(dim, hidden_dim * 3, 1, bias = False)
         self.to_out = nn.Conv2d(hidden_dim, dim, 1)
+        self.fused = False
+
+    def forward_fused(self, x):
+        # same attention with one reshape of qkv (a view for NCHW x) and two batched matmuls, the scale
+        # is folded in the d x e context instead of q, the output comes out as b (h c) (x y)
+        b, c, h, w = x.shape
+        q, k, v = self.to_qkv(x).reshape(b, 3, self.heads, -1, h * w).unbind(1)
+        context = torch.matmul(k.softmax(dim = -1), v.transpose(-1, -2)) * self.scale
+        out = torch.matmul(context.transpose(-1, -2), q).reshape(b, -1, h, w)
+        return self.to_out(out)
 
     def forward(self, x):
+        if self.fused:
+            return self.forward_fused(x)
         b, c, h, w = x.shape
         qkv = self.to_qkv(x).chunk(3, dim = 1)
         q, k, v = map(lambda t: rearrange(t, 'b (h c) x y -> b h c (x y)', h = self.heads), qkv)
@@ -276,10 +313,75 @@ class Unet(nn.Module):
             ConvNextBlock(dim, dim),
             nn.Conv2d(dim, out_dim, 1)
         )
+        self.register_buffer('time_table', None, persistent = False)
+        self.fixed_time = None
+        self.amp_dtype = None
+        self.channels_last = False
+
+    def fused_mode(self, fused = True, channels_last = True):
+        '''
+        LayerNorm as one layer_norm kernel, LinearAttention with batched matmuls and in place adds in
+        ConvNextBlock, channels_last weights and activations (GPU, on CPU the attention reshapes cost
+        more than the convolutions gain). Parameters are unchanged, the state_dict of a checkpoint
+        loads with or without it.
+        '''
+        for m in self.modules():
+            if isinstance(m, (LayerNorm, LinearAttention, ConvNextBlock)):
+                m.fused = fused
+        self.channels_last = fused and channels_last
+        return self.to(memory_format = torch.channels_last if self.channels_last else torch.contiguous_format)
+
+    def inference_mode(self, timesteps = 100, amp_dtype = None, fixed_time = None):
+        '''
+        Precomputed time embedding for sampling, call again after the weights change (ema update, load).
+        Input:
+            timesteps: time_mlp of steps 0..timesteps-1 and the condition of every ConvNextBlock are
+                tabled, an int64 time indexes them, a float time still runs time_mlp.
+                None = back to the plain forward
+            amp_dtype: torch.float16 / torch.bfloat16, forward runs under autocast and returns the
+                input dtype (LayerNorm statistics stay float32)
+            fixed_time: step folded in the ds_conv bias of every block, forward then ignores time
+        '''
+        self.time_table = None
+        for m in self.modules():
+            if isinstance(m, ConvNextBlock):
+                m.cond_table = None
+        if exists(timesteps) and exists(self.time_mlp):
+            p = next(self.parameters())
+            with torch.no_grad():
+                self.time_table = self.time_mlp(torch.arange(timesteps, device = p.device))
+                for m in self.modules():
+                    if isinstance(m, ConvNextBlock) and exists(m.mlp):
+                        m.cond_table = m.mlp(self.time_table)
+        self.amp_dtype = amp_dtype
+        return self.fix_time(fixed_time if exists(self.time_table) else None)
+
+    def fix_time(self, time = None):
+        # fold the condition of step time in the ds_conv biases, None unfolds
+        self.fixed_time = time
+        for m in self.modules():
+            if isinstance(m, ConvNextBlock):
+                m.fixed_bias = None
+                if exists(time) and exists(m.cond_table):
+                    m.fixed_bias = (m.ds_conv.bias + m.cond_table[time]).detach()
+        return self
 
     def forward(self, x, time):
+        if self.channels_last:
+            x = x.contiguous(memory_format = torch.channels_last)
+        if exists(self.amp_dtype):
+            with torch.autocast(x.device.type, dtype = self.amp_dtype):
+                return self.forward_unet(x, time).to(x.dtype)
+        return self.forward_unet(x, time)
+
+    def forward_unet(self, x, time):
         orig_x = x
-        t = self.time_mlp(time) if exists(self.time_mlp) else None
+        if exists(self.fixed_time):
+            t = None  # folded in the block biases
+        elif exists(self.time_table) and not time.is_floating_point():
+            t = time  # index of the block condition tables
+        else:
+            t = self.time_mlp(time) if exists(self.time_mlp) else None
 
         h = []
 
@@ -301,12 +403,25 @@ class Unet(nn.Module):
             x = attn(x)
             x = upsample(x)
         if self.residual:
-            return self.final_conv(x) + orig_x
+            return (self.final_conv(x) + orig_x).contiguous()
 
-        return self.final_conv(x)
+        return self.final_conv(x).contiguous()
 
 # gaussian diffusion trainer class
 
+
+def quantize_dynamic_unet(unet):
+    '''
+    Post training dynamic int8 (CPU) copy of a Unet, weights of the nn.Linear layers (time_mlp and the
+    block mlp) in int8, torch dynamic quantization has no Conv2d, the convolutions stay float32.
+    Return: quantized copy on the cpu, inference_mode tables rebuilt from the int8 layers
+    '''
+    timesteps = unet.time_table.shape[0] if exists(unet.time_table) else None
+    q = torch.ao.quantization.quantize_dynamic(copy.deepcopy(unet).cpu().eval(), {nn.Linear}, dtype = torch.qint8)
+    if exists(timesteps):
+        q.inference_mode(timesteps, fixed_time = unet.fixed_time)
+    return q
+
 def extract(a, t, x_shape):
     b, *_ = t.shape
     out = a.gather(-1, t)
@@ -713,6 +828,157 @@ class GaussianDiffusion(nn.Module):
         return X_0s, X_ts
 
 
+    def get_sample_schedule(self, schedule='uniform', n_steps=None, t=None):
+        '''
+        Timesteps visited by schedule_sample.
+        Input:
+            schedule: 'uniform' (same stride), 'quadratic' (denser near t=0) or a list of timesteps,
+                      i.e. [99, 60, 30, 10, 0]
+            n_steps: number of denoise_fn calls for 'uniform' and 'quadratic' (default t)
+            t: start from t-1 (default num_timesteps)
+        Return:
+            strictly decreasing list of int, i.e. [99, 74, 49, 24, 0]
+        '''
+        if t == None:
+            t = self.num_timesteps
+        if n_steps == None:
+            n_steps = t
+        n_steps = max(1, min(int(n_steps), t))
+
+        if isinstance(schedule, (list, tuple)):
+            timesteps = [int(x) for x in schedule]
+        elif schedule == 'uniform':
+            timesteps = np.round(np.linspace(t - 1, 0, n_steps)).astype(int).tolist()
+        elif schedule == 'quadratic':
+            timesteps = np.round(np.linspace(np.sqrt(t - 1), 0, n_steps) ** 2).astype(int).tolist()
+        else:
+            print('not support schedule = %s'%str(schedule))
+            noThisSchedule
+
+        timesteps = sorted(set(timesteps), reverse=True)
+        if timesteps[0] > self.num_timesteps - 1 or timesteps[-1] < 0:
+            print('schedule %s out of range [0, %d]'%(str(timesteps), self.num_timesteps - 1))
+            scheduleOutOfRange
+        return timesteps
+
+    @torch.no_grad()
+    def schedule_sample(self, batch_size=16, img=None, t=None, schedule='uniform', n_steps=None, wo_noise=False, clamp=False):
+        '''
+        all_sample with a timestep schedule, jumps from timesteps[i] to timesteps[i+1] in one
+        denoise_fn call. schedule=list(range(t-1, -1, -1)) gives the same X_0s, X_ts as all_sample.
+        Input:
+            schedule, n_steps, t: see get_sample_schedule
+            wo_noise: img is already degraded to timesteps[0]
+            clamp: clamp x0 predictions to [0, 1] like the image space test scripts
+        Return:
+            X_0s: x0 prediction of every visited timestep
+            X_ts: input of every visited timestep
+        '''
+        timesteps = self.get_sample_schedule(schedule, n_steps, t)
+
+        if not wo_noise:
+            with torch.no_grad():
+                img = self.func[timesteps[0]](img)
+
+        X_0s = []
+        X_ts = []
+        for idx, times in enumerate(timesteps):
+            step = torch.full((batch_size,), times, dtype=torch.long, device=img.device)
+            x = self.denoise_fn(img, step)
+            if clamp:
+                x = torch.clamp(x, min=0.0, max=1.0)
+            X_0s.append(x)
+            X_ts.append(img)
+
+            # next timestep, -1 = clean image
+            times_next = timesteps[idx + 1] if idx + 1 < len(timesteps) else -1
+            if self.train_routine == 'Final':
+                if times_next >= 0:
+                    x_times_next = self.func[times_next](x)
+                else:
+                    x_times_next = x
+
+                if self.sampling_routine == 'default':
+                    x = x_times_next
+
+                elif self.sampling_routine == 'x0_step_down':
+                    x_times = self.func[times](x)
+                    x = img - x_times + x_times_next
+                    if clamp:
+                        x = torch.clamp(x, min=0.0, max=1.0)
+
+            img = x
+
+        return X_0s, X_ts
+
+    @torch.no_grad()
+    def early_exit_sample(self, img=None, t=None, schedule='uniform', n_steps=None, threshold=1e-3, exit_space='image', min_steps=2, wo_noise=False, clamp=False):
+        '''
+        schedule_sample which retires a sample as soon as its x0 prediction stops changing,
+        mean |x0_i - x0_(i-1)| < threshold, the rest of the batch is compacted so later
+        denoise_fn calls run on fewer images.
+        Input:
+            schedule, n_steps, t: see get_sample_schedule
+            threshold: L1 change between two x0 predictions to retire a sample
+            exit_space: 'image' compares x0 itself, 'latent' compares yolomodel.before_diffusion_model(x0)
+            min_steps: denoise_fn calls before a sample may retire
+            wo_noise, clamp: see schedule_sample
+        Return:
+            x0: last x0 prediction of every sample
+            n_calls: long [b], denoise_fn calls spent on every sample
+        '''
+        timesteps = self.get_sample_schedule(schedule, n_steps, t)
+        if exit_space == 'latent' and getattr(self, 'yolomodel', None) is None:
+            print('exit_space = latent need yolomodel, please check.')
+            noyolomodel
+
+        if not wo_noise:
+            with torch.no_grad():
+                img = self.func[timesteps[0]](img)
+
+        x0 = torch.zeros_like(img)
+        n_calls = torch.zeros((img.shape[0],), dtype=torch.long, device=img.device)
+        active = torch.arange(img.shape[0], device=img.device)
+        feat_prev = None
+        for idx, times in enumerate(timesteps):
+            step = torch.full((img.shape[0],), times, dtype=torch.long, device=img.device)
+            x = self.denoise_fn(img, step)
+            if clamp:
+                x = torch.clamp(x, min=0.0, max=1.0)
+            x0[active] = x
+            n_calls[active] += 1
+
+            if idx + 1 == len(timesteps):
+                break
+
+            if exit_space == 'latent':
+                feat = self.yolomodel.forward_submodel(x, self.yolomodel.before_diffusion_model)
+            else:
+                feat = x
+            if feat_prev is not None and idx + 1 >= min_steps:
+                change = (feat - feat_prev).abs().flatten(1).mean(1)
+                keep = change >= threshold
+                if not keep.all():
+                    active, img, x, feat = active[keep], img[keep], x[keep], feat[keep]
+                    if active.shape[0] == 0:
+                        break
+            feat_prev = feat
+
+            times_next = timesteps[idx + 1]
+            if self.train_routine == 'Final':  # as schedule_sample, other routines feed x0 back
+                x_times_next = self.func[times_next](x)
+                if self.sampling_routine == 'default':
+                    x = x_times_next
+                elif self.sampling_routine == 'x0_step_down':
+                    x_times = self.func[times](x)
+                    x = img - x_times + x_times_next
+                    if clamp:
+                        x = torch.clamp(x, min=0.0, max=1.0)
+            img = x
+
+        return x0, n_calls
+
+
     @torch.no_grad()
     def forward_and_backward(self, batch_size=16, img=None, t=None, times=None, eval=True):
 
@@ -791,32 +1057,14 @@ class GaussianDiffusion(nn.Module):
         return img
 
     def q_sample(self, x_start, t):
-
-        max_iters = torch.max(t)
-        all_blurs = []
-        x = x_start
-        #for i in range(max_iters+1):
-        #    with torch.no_grad():
-        #        #print(x.shape)
-        #        x = self.func[i](x)
-        #        all_blurs.append(x)
-        for i in range(max_iters+1):
+        # func[i] always starts from x_start, so every sample only needs its own
+        # func[t[b]]; samples sharing a t are degraded together.
+        # (was: apply func[0..max(t)] to the whole batch and stack T x B images)
+        choose_blur = torch.empty_like(x_start)
+        for step in torch.unique(t).tolist():
+            idx = (t == step).nonzero(as_tuple=True)[0]
             with torch.no_grad():
-                #print(x.shape)
-                x = self.func[i](x_start)
-                all_blurs.append(x)
-
-        all_blurs = torch.stack(all_blurs)
-
-        choose_blur = []
-
-        for step in range(t.shape[0]):
-            if step != -1:
-                choose_blur.append(all_blurs[t[step], step])
-            else:
-                choose_blur.append(x_start[step])
-
-        choose_blur = torch.stack(choose_blur)
+                choose_blur[idx] = self.func[step](x_start[idx])
 
         return choose_blur
     
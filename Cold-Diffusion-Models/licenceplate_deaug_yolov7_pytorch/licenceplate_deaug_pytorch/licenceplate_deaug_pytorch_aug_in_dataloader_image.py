@@ -758,32 +758,14 @@ class GaussianDiffusion(nn.Module):
         return img
 
     def q_sample(self, x_start, t):
-
-        max_iters = torch.max(t)
-        all_blurs = []
-        x = x_start
-        #for i in range(max_iters+1):
-        #    with torch.no_grad():
-        #        #print(x.shape)
-        #        x = self.func[i](x)
-        #        all_blurs.append(x)
-        for i in range(max_iters+1):
+        # func[i] always starts from x_start, so every sample only needs its own
+        # func[t[b]]; samples sharing a t are degraded together.
+        # (was: apply func[0..max(t)] to the whole batch and stack T x B images)
+        choose_blur = torch.empty_like(x_start)
+        for step in torch.unique(t).tolist():
+            idx = (t == step).nonzero(as_tuple=True)[0]
             with torch.no_grad():
-                #print(x.shape)
-                x = self.func[i](x_start)
-                all_blurs.append(x)
-
-        all_blurs = torch.stack(all_blurs)
-
-        choose_blur = []
-
-        for step in range(t.shape[0]):
-            if step != -1:
-                choose_blur.append(all_blurs[t[step], step])
-            else:
-                choose_blur.append(x_start[step])
-
-        choose_blur = torch.stack(choose_blur)
+                choose_blur[idx] = self.func[step](x_start[idx])
 
         return choose_blur
     
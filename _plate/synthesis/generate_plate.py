@@ -1,70 +1,81 @@
 import sys
-import glob
-import numpy as np
-import os
-sys.path.append('/data/licence_plate/_yolo/yolov7/')
-from matplotlib import pyplot as plt
-from matplotlib.patches import Rectangle
-from utils.generator import plate_generator
-from utils.general import xyxy2xywh
-from utils.augmentations import mix_augmentaion
-import cv2
+import argparse
 import concurrent.futures
 import os
-from PIL import Image
-import random
 import time
 from tqdm import tqdm
 
-aug_licence = mix_augmentaion()
-aug_licence.imshape=(512,512)
-aug_licence.random_parameter()
-
-#image_generator = plate_generator(augmentor=aug_licence)
-image_generator = plate_generator()
-
-
-def generate_plate():
-    # Set a unique random seed for each process
-    # Using a combination of the current time and the process ID ensures uniqueness
-    random_seed = (int(time.time() * 1000) + os.getpid()) % (2**32)
-    random.seed(random_seed)
-    np.random.seed(random_seed)
-
-    img, msg = image_generator.get_plate()
-    return img, msg
+# offline plate dataset: --workers processes each build their own plate_generator, seeded from
+# (--seed, worker), and write their own samples, the parent only collects counts, no pixels go
+# through the process pool.
+# --format shards: tar shards (jpg + labels.npy + step.txt [+ clean.jpg]) + index.json, read in training
+# by train_gendata.py --shards <output>
+# --format files: %08d.jpg + %08d.txt of the previous generate_plate.py
+# mix_aug degradation as LoadImagesAndLabels_generate, --bg_image_from input --bg_dir <train_path> also puts
+# the plates on the train_gendata.py background images
+# python generate_plate.py --n 100000 --workers 16 --output plates_shards --bg_image_from input --bg_dir /data/yolov7/coco/images/train2017 --save_clean
 
-def multi_cpu_for_loop(n=100, output_dir='opt'):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+parser = argparse.ArgumentParser()
+parser.add_argument('--n', default=100, type=int)
+parser.add_argument('--workers', default=os.cpu_count(), type=int)
+parser.add_argument('--output', default='opt', type=str)
+parser.add_argument('--format', default='shards', choices=['shards', 'files'], type=str)
+parser.add_argument('--shard_size', default=1000, type=int)#samples per tar
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--no_augment', action='store_true')#no mix_augmentaion degradation, LoadImagesAndLabels_generate always has it
+parser.add_argument('--bg_image_from', default='gen', choices=['input', 'gen'], type=str)#gen = plate_generator backgrounds, input = images of --bg_dir as LoadImagesAndLabels_generate
+parser.add_argument('--bg_dir', default=None, type=str)#background images, the train_path of train_gendata.py
+parser.add_argument('--save_clean', action='store_true')#also store the image before degradation
+parser.add_argument('--quality', default=95, type=int)#jpeg quality
+parser.add_argument('--style', default='random', type=str)
+parser.add_argument('--image_size', default=512, type=int)
+parser.add_argument('--yolo_path', default='/data/licence_plate/_yolo/yolov7/', type=str)
+parser.add_argument('--char_path', nargs=2, default=None, type=str)#6 and 7 characters folders, plate_generator default when None
+parser.add_argument('--plate_bg', nargs=2, default=None, type=str)#blank plates, plate_generator default when None
+parser.add_argument('--glyph_atlas', default=None, type=str)
 
-    with concurrent.futures.ProcessPoolExecutor() as executor:
-        # Submit all tasks and create a list of futures
-        futures = [executor.submit(generate_plate) for _ in range(n)]
+args = parser.parse_args()
+if args.bg_image_from == 'input' and args.bg_dir is None:
+    parser.error('--bg_image_from input needs --bg_dir (the train_path images of train_gendata.py)')
+print(args)
 
-        # Initialize a tqdm progress bar
-        with tqdm(total=n, desc="Processing Images", unit="image") as progress_bar:
-            for i, future in enumerate(concurrent.futures.as_completed(futures)):
-                img, msg = future.result()
+sys.path.append(args.yolo_path)
+from utils.plate_shards import write_plate_shards, write_index
 
-                # Format the filename as '%08d'
-                base_filename = f'{i:08d}'
-                img_path = os.path.join(output_dir, base_filename + '.jpg')
-                txt_path = os.path.join(output_dir, base_filename + '.txt')
 
-                # Save image using cv2.imwrite
-                cv2.imwrite(img_path, img)
+def worker_counts(n, workers):
+    # n samples split over the workers, the first n % workers write one more
+    return [n // workers + (1 if w < n % workers else 0) for w in range(workers)]
 
-                # Save label to a text file, format the message to exclude '[' and ']', using ',' to join
-                with open(txt_path, 'w') as file:
-                    for sublist in msg:
-                        formatted_line = ','.join(map(str, sublist))
-                        file.write(formatted_line + '\n')
 
-                # Update the progress bar
-                progress_bar.update(1)
+def generate(args):
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    bg_dir = args.bg_dir if args.bg_image_from == 'input' else None
+    generator_kwargs = dict(image_size=args.image_size, augment=not args.no_augment, load_path=args.char_path,
+                            bg_path=args.plate_bg, atlas_path=args.glyph_atlas, bg_dir=bg_dir)
+    counts = worker_counts(args.n, args.workers)
+    start_time = time.time()
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(write_plate_shards, w, counts[w], args.output, seed=args.seed,
+                                   shard_size=args.shard_size, quality=args.quality, save_clean=args.save_clean,
+                                   style=args.style, file_format=args.format, worker_offset=sum(counts[:w]),
+                                   **generator_kwargs)
+                   for w in range(args.workers) if counts[w] > 0]
+        with tqdm(total=args.n, desc="Processing Images", unit="image") as progress_bar:
+            for future in concurrent.futures.as_completed(futures):
+                results.append(future.result())
+                progress_bar.update(results[-1]['count'])
+    seconds = time.time() - start_time
+    if args.format == 'shards':
+        index = write_index(args.output, results, seed=args.seed, augment=not args.no_augment, save_clean=args.save_clean,
+                            bg_image_from=args.bg_image_from, bg_dir=bg_dir and os.path.abspath(bg_dir),
+                            image_size=args.image_size, style=args.style, workers=args.workers)
+        print('%d shards' % len(index['shards']))
+    print('%d samples in %.1f s, %.1f samples/s, %d workers' % (args.n, seconds, args.n / seconds, args.workers))
+    print(f'Images and labels saved in {args.output}')
 
-    print(f'Images and labels saved in {output_dir}')
 
-# Call the function
-multi_cpu_for_loop(100, 'opt')
+if __name__ == '__main__':
+    generate(args)
@@ -0,0 +1,120 @@
+import argparse
+import time
+import torch
+from utils.general import non_max_suppression, non_max_suppression_batch
+
+# non_max_suppression_batch against the per image loop of non_max_suppression on detect outputs
+# shaped like the yolov7-tiny 35 class head (3 anchors on strides 8 / 16 / 32), a few plates of
+# 6-8 chars per image, each object hit by a cluster of anchors, low objectness elsewhere.
+# same detections per image, ms per batch.
+# python benchmark_nms.py --batch_size 32 --img_size 512 1024
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', default=32, type=int)
+parser.add_argument('--img_size', nargs='+', default=[512, 1024], type=int)
+parser.add_argument('--nc', default=35, type=int)
+parser.add_argument('--plates', default=3, type=int)#max plates per image
+parser.add_argument('--conf_thres', default=0.25, type=float)
+parser.add_argument('--iou_thres', default=0.45, type=float)
+parser.add_argument('--n_repeat', default=20, type=int)
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+
+args = parser.parse_args()
+print(args)
+
+device = torch.device(args.device)
+g = torch.Generator().manual_seed(args.seed)
+
+
+def rand(*shape):
+    return torch.rand(shape, generator=g)
+
+
+def fake_prediction(batch_size, img_size):
+    n = 3 * sum((img_size // s) ** 2 for s in (8, 16, 32))
+    pred = torch.zeros((batch_size, n, args.nc + 5))
+    pred[..., :2] = rand(batch_size, n, 2) * img_size
+    pred[..., 2:4] = rand(batch_size, n, 2) * 60 + 4
+    pred[..., 4] = torch.sigmoid(torch.randn((batch_size, n), generator=g) * 2 - 6)
+    pred[..., 5:] = torch.sigmoid(torch.randn((batch_size, n, args.nc), generator=g) * 2 - 4)
+    for b in range(batch_size):
+        objs = []
+        for _ in range(int(rand(1) * (args.plates + 1))):
+            w, h = 80 + rand(1).item() * 200, 25 + rand(1).item() * 50
+            x, y = rand(1).item() * (img_size - w), rand(1).item() * (img_size - h)
+            objs.append((x + w / 2, y + h / 2, w, h, args.nc - 1))
+            n_char = 6 + int(rand(1) * 3)
+            for k in range(n_char):
+                objs.append((x + w * (k + 0.5) / n_char, y + h / 2, 0.8 * w / n_char, 0.8 * h, int(rand(1) * (args.nc - 1))))
+        for cx, cy, w, h, cls in objs:
+            hits = torch.randint(0, n, (int(8 + rand(1) * 16),), generator=g)
+            jitter = torch.randn((len(hits), 4), generator=g) * 0.05
+            pred[b, hits, 0] = cx + jitter[:, 0] * w
+            pred[b, hits, 1] = cy + jitter[:, 1] * h
+            pred[b, hits, 2] = w * (1 + jitter[:, 2])
+            pred[b, hits, 3] = h * (1 + jitter[:, 3])
+            pred[b, hits, 4] = 0.5 + rand(len(hits)) * 0.45
+            pred[b, hits, 5 + cls] = 0.7 + rand(len(hits)) * 0.3
+            second = int(rand(1) * (args.nc - 1))
+            pred[b, hits, 5 + second] = torch.maximum(pred[b, hits, 5 + second], rand(len(hits)) * 0.6)
+    return pred.to(device)
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timing(func):
+    out = func()
+    sync()
+    start_time = time.time()
+    for _ in range(args.n_repeat):
+        func()
+    sync()
+    return out, (time.time() - start_time) / args.n_repeat
+
+
+def check_bbox(bb1, bb2):
+    # check_bbox of the eval scripts, the larger box must cover the smaller one
+    bb1_area = (bb1[2] - bb1[0]) * (bb1[3] - bb1[1])
+    bb2_area = (bb2[2] - bb2[0]) * (bb2[3] - bb2[1])
+    if bb1_area < bb2_area:
+        bb1, bb2 = bb2, bb1
+    return bb1[0] <= bb2[0] and bb1[1] <= bb2[1] and bb1[2] >= bb2[2] and bb1[3] >= bb2[3]
+
+
+def sorted_rows(x):
+    # rows in a fixed order, the loop keeps the nms (conf) order
+    x = x.cpu().double()
+    for col in reversed(range(x.shape[1])):
+        x = x[torch.sort(x[:, col], stable=True)[1]]
+    return x
+
+
+for img_size in args.img_size:
+    pred = fake_prediction(args.batch_size, img_size)
+    kwargs = dict(conf_thres=args.conf_thres, iou_thres=args.iou_thres, multi_label=True)
+    ref, t_loop = timing(lambda: non_max_suppression(pred.clone(), labels=[], **kwargs))
+    out, t_batch = timing(lambda: non_max_suppression_batch(pred, **kwargs))
+    (out_g, plate_chars), t_group = timing(lambda: non_max_suppression_batch(pred, group_plate=True, **kwargs))
+
+    n_diff = 0
+    n_pairs = 0
+    for a, b, c in zip(ref, out, out_g):
+        assert torch.equal(b, c)
+        if a.shape != b.shape or not torch.allclose(sorted_rows(a), sorted_rows(b)):
+            n_diff += 1
+    for b, pairs in zip(out_g, plate_chars):
+        # the pairs of the group_plate loop of the eval scripts
+        boxes = [[int(v) for v in row[:4]] for row in b.tolist()]
+        plates = [q for q in range(len(boxes)) if int(b[q, 5]) == args.nc - 1]
+        loop_pairs = [[q, k] for k in range(len(boxes)) if int(b[k, 5]) != args.nc - 1
+                      for q in plates if check_bbox(boxes[q], boxes[k])]
+        assert pairs.tolist() == loop_pairs, 'group_plate pairs differ from check_bbox'
+        n_pairs += len(loop_pairs)
+    print('img_size %d: %d anchors, %.1f detections / image, loop %.2f ms, batch %.2f ms (x%.1f), batch + group_plate %.2f ms (%d char-plate pairs), %d / %d images differ'%(
+        img_size, pred.shape[1], sum(len(x) for x in ref) / len(ref), t_loop * 1000, t_batch * 1000,
+        t_loop / max(t_batch, 1e-9), t_group * 1000, n_pairs, n_diff, len(ref)))
+    assert n_diff == 0, 'non_max_suppression_batch changed the detections'
@@ -0,0 +1,71 @@
+import argparse
+import os
+import time
+import cv2
+import numpy as np
+import torch
+from utils.generator import plate_generator
+
+# plate assembly + recolouring of plate_generator: cv2.resize of every glyph and adjust_colour__
+# full image scans (glyph_atlas = None) against the glyph atlas (slice copies of label maps and
+# plate_palette lookup), same plates for the same seed, samples/s on one core. Atlas build time from
+# the png against the load of its .npz.
+# python benchmark_plate_atlas.py --n_samples 500 --atlas glyph_atlas.npz
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--n_samples', default=200, type=int)
+parser.add_argument('--style', default='random', type=str)
+parser.add_argument('--char_path', nargs=2, default=None, type=str)#6 and 7 characters folders, plate_generator default when None
+parser.add_argument('--plate_bg', nargs=2, default=None, type=str)#blank plates, plate_generator default when None
+parser.add_argument('--atlas', default='glyph_atlas.npz', type=str)
+parser.add_argument('--seed', default=0, type=int)
+
+args = parser.parse_args()
+print(args)
+
+# samples/s/core
+cv2.setNumThreads(1)
+torch.set_num_threads(1)
+
+generator = plate_generator(load_path=args.char_path, bg_path=args.plate_bg)
+
+start_time = time.time()
+atlas = generator.get_glyph_atlas()
+build_time = time.time() - start_time
+if os.path.exists(args.atlas):
+    os.remove(args.atlas)
+generator.get_glyph_atlas(args.atlas)  # write
+start_time = time.time()
+loaded = generator.get_glyph_atlas(args.atlas)
+load_time = time.time() - start_time
+assert all(np.array_equal(atlas[k], loaded[k]) for k in atlas), 'npz atlas differs from the built one'
+print('atlas build %.1f ms, npz load %.1f ms, %.1f MB'%(build_time * 1000, load_time * 1000, os.path.getsize(args.atlas) / 2 ** 20))
+
+
+def legacy_plate():
+    img, sheet = generator.basic_plate_allrandom(style=args.style)
+    return generator.adjust_colour__(img, np.random.randint(5)), sheet
+
+
+def atlas_plate():
+    img, sheet = generator.basic_plate_allrandom(style=args.style, labels=True)
+    return generator.plate_palette(np.random.randint(5))[img], sheet
+
+
+def timing(func):
+    np.random.seed(args.seed)
+    out = []
+    start_time = time.time()
+    for _ in range(args.n_samples):
+        out.append(func())
+    return out, args.n_samples / (time.time() - start_time)
+
+
+generator.glyph_atlas = None
+legacy, legacy_speed = timing(legacy_plate)
+generator.glyph_atlas = atlas
+fast, fast_speed = timing(atlas_plate)
+for (img1, sheet1), (img2, sheet2) in zip(legacy, fast):
+    assert np.array_equal(img1, img2) and sheet1 == sheet2, 'atlas plate differs from the legacy plate'
+print('plate + colour   legacy %8.1f samples/s/core, atlas %8.1f samples/s/core (x%.1f), %d same plates'%(
+    legacy_speed, fast_speed, fast_speed / legacy_speed, len(fast)))
@@ -0,0 +1,67 @@
+import argparse
+import time
+import cv2
+import numpy as np
+import torch
+from utils.generator import plate_generator
+
+# backgrounds and textures of plate_generator, p50 / p99 / max ms per sample on one core:
+# random_bg (float64 expression tree, reject and rebuild) against random_bg_fast (bounded tree,
+# float32, full size or low_res + resize) and the pool of sample_bg (random crop / flips),
+# add_noise(create_texture(...)) of add_texture against create_texture_fast and sample_texture.
+# no glyph / plate files are read.
+# python benchmark_plate_background.py --n_samples 200 --image_size 512
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--n_samples', default=100, type=int)
+parser.add_argument('--image_size', default=512, type=int)
+parser.add_argument('--low_res', default=128, type=int)
+parser.add_argument('--pool_size', default=64, type=int)
+parser.add_argument('--seed', default=0, type=int)
+
+args = parser.parse_args()
+print(args)
+
+# ms per sample on one core
+cv2.setNumThreads(1)
+torch.set_num_threads(1)
+
+generator = plate_generator.__new__(plate_generator)  # backgrounds only, no glyph atlas
+generator.bg_pool_size = args.pool_size
+generator.bg_pool_refresh = 0.05
+generator.bg_low_res = args.low_res
+generator.bg_pool = []
+generator.texture_pool = []
+size = args.image_size
+
+
+def legacy_texture():
+    texture_bg = generator.add_noise(generator.create_texture(generator.create_blank_image(size, size, background=230), sigma=4), sigma=10)
+    return np.repeat(texture_bg, 3, axis=-1)
+
+
+def warm_pool(func):
+    for _ in range(args.pool_size):
+        func()
+
+
+configs = [('random_bg', lambda: generator.random_bg(image_size=size), None),
+           ('random_bg_fast full', lambda: generator.random_bg_fast(size, low_res=None), None),
+           ('random_bg_fast %d'%args.low_res, lambda: generator.random_bg_fast(size, low_res=args.low_res), None),
+           ('sample_bg (pool)', lambda: generator.sample_bg(size), lambda: warm_pool(lambda: generator.sample_bg(size))),
+           ('texture', legacy_texture, None),
+           ('create_texture_fast', lambda: generator.create_texture_fast(size), None),
+           ('sample_texture (pool)', lambda: generator.sample_texture(size), lambda: warm_pool(lambda: generator.sample_texture(size)))]
+
+print('%-24s %10s %10s %10s %10s'%('', 'p50 ms', 'p99 ms', 'max ms', 'mean ms'))
+for name, func, warm in configs:
+    np.random.seed(args.seed)
+    if warm is not None:
+        warm()
+    times = []
+    for _ in range(args.n_samples):
+        start_time = time.perf_counter()
+        out = func()
+        times.append((time.perf_counter() - start_time) * 1000)
+    assert out.shape[0:2] == (size, size), '%s returned %s'%(name, str(out.shape))
+    print('%-24s %10.2f %10.2f %10.2f %10.2f'%(name, np.percentile(times, 50), np.percentile(times, 99), np.max(times), np.mean(times)))
@@ -0,0 +1,78 @@
+import argparse
+import time
+import cv2
+import numpy as np
+import torch
+from utils.generator import plate_generator, crop_image
+
+# plate_generator.get_plate with the ROI compositor (fast_composite, corners rejection test, one plate
+# sized warp per plate, alpha composite) against the full frame one (warp of the black image_size
+# canvas, pixel overlap test, merge), samples/s on one core for the compositing stage and the whole
+# get_plate. --check compares one ROI warp against the full frame warp of the same placement.
+# python benchmark_plate_compositor.py --n_samples 500 --check 100
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--n_samples', default=200, type=int)
+parser.add_argument('--image_size', default=512, type=int)
+parser.add_argument('--style', default='random', type=str)
+parser.add_argument('--char_path', nargs=2, default=None, type=str)#6 and 7 characters folders, plate_generator.load_path when None
+parser.add_argument('--plate_bg', nargs=2, default=None, type=str)#blank plates, plate_generator.bg_path when None
+parser.add_argument('--check', default=20, type=int)#placements compared to the full frame warp
+parser.add_argument('--seed', default=0, type=int)
+
+args = parser.parse_args()
+print(args)
+
+# samples/s/core
+cv2.setNumThreads(1)
+torch.set_num_threads(1)
+np.random.seed(args.seed)
+
+generator = plate_generator(image_size=args.image_size, load_path=args.char_path, bg_path=args.plate_bg)
+bg_image = np.random.randint(0, 256, (args.image_size, args.image_size, 3), dtype=np.uint8)
+
+
+def make_plate():
+    img, sheet = generator.basic_plate_allrandom(style=args.style)
+    img = generator.adjust_colour__(img, np.random.randint(5))
+    return generator.resize_plate(img, sheet)
+
+
+plates = [make_plate() + make_plate() for _ in range(args.n_samples)]
+
+if args.check > 0:
+    max_diff = 0
+    for i in range(args.check):
+        img, sheet = plates[i][:2]
+        offset, angles = generator.sample_placement(img.shape[0:2])
+        H, M = generator.plate_homography(offset, angles)
+        h, w = img.shape[0:2]
+        corners = generator.transform_points([[0, 0], [w, 0], [w, h], [0, h]], H)
+        blank, _ = generator.paste_to_black_BG(img, nw=args.image_size, nh=args.image_size, offset_h=offset[1], offset_w=offset[0])
+        full, M_full = generator.perspective_transform(blank, theta_x=angles[0], theta_y=angles[1], theta_z=angles[2])
+        roi = generator.warp_plate_roi(np.zeros_like(full), img, H, corners)
+        assert np.allclose(M, M_full), 'plate_homography differs from perspective_transform'
+        max_diff = max(max_diff, np.abs(roi.astype(int) - full.astype(int)).max())
+    print('ROI warp on black against the full frame warp, %d placements, max pixel diff %d'%(args.check, max_diff))
+    assert max_diff <= 1, 'ROI warp differs from the full frame warp'
+
+
+def timing(func):
+    start_time = time.time()
+    for img1, sheet1, img2, sheet2 in plates:
+        func(img1, [dict(s) for s in sheet1], img2, [dict(s) for s in sheet2], bg_image.copy())
+    return args.n_samples / (time.time() - start_time)
+
+
+full_frame = timing(generator.composite_plates_full_frame)
+roi = timing(generator.composite_plates)
+print('compositing      full frame %8.1f samples/s/core, ROI %8.1f samples/s/core (x%.1f)'%(full_frame, roi, roi / full_frame))
+
+speed = {}
+for fast_composite in [False, True]:
+    generator.fast_composite = fast_composite
+    start_time = time.time()
+    for _ in range(args.n_samples):
+        generator.get_plate(bg_image=bg_image, style=args.style)
+    speed[fast_composite] = args.n_samples / (time.time() - start_time)
+print('get_plate        full frame %8.1f samples/s/core, ROI %8.1f samples/s/core (x%.1f)'%(speed[False], speed[True], speed[True] / speed[False]))
@@ -0,0 +1,144 @@
+import argparse
+import time
+import torch
+from utils.general import non_max_suppression_batch
+from utils.plate_metrics import group_plate
+from utils.plate_decode import PlateDecoder, CLASS_NAMES, TAIWAN_FORMATS
+
+# PlateDecoder against non_max_suppression + group_plate + get_str on detect outputs made from
+# style='real' plates (c_list1, dot, c_list2 on one line, or c_list1 over c_list2 for two row plates),
+# where some chars also fire a look-alike of the other char set (8 / B, 5 / S, ...).
+# plate string accuracy and ms per batch.
+# python benchmark_plate_decode.py --batch_size 32 --img_size 512
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--batch_size', default=32, type=int)
+parser.add_argument('--img_size', default=512, type=int)
+parser.add_argument('--plates', default=3, type=int)#max plates per image
+parser.add_argument('--two_row', default=0.3, type=float)#ratio of two row plates
+parser.add_argument('--confuse', default=0.1, type=float)#ratio of chars with a look-alike above the true class
+parser.add_argument('--n_repeat', default=20, type=int)
+parser.add_argument('--seed', default=0, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+
+args = parser.parse_args()
+print(args)
+
+device = torch.device(args.device)
+g = torch.Generator().manual_seed(args.seed)
+nc = 35
+look_alike = {0: 'D', 1: 'J', 2: 'Z', 4: 'A', 5: 'S', 6: 'G', 7: 'T', 8: 'B'}
+look_alike = dict(list(look_alike.items()) + [(CLASS_NAMES.index(v), CLASS_NAMES[k]) for k, v in look_alike.items()])
+
+
+def rand():
+    return torch.rand(1, generator=g).item()
+
+
+def randint(n):
+    return int(torch.randint(0, n, (1,), generator=g))
+
+
+def fake_plate_string():
+    fmt = TAIWAN_FORMATS[randint(len(TAIWAN_FORMATS))]
+    s = ''.join(CLASS_NAMES[randint(10)] if c == 'D' else CLASS_NAMES[10 + randint(24)] for c in fmt)
+    split = {'LLLDDDD': 3, 'LLDDDD': 2, 'DDDDLL': 4, 'LLLDDD': 3, 'DDDLLL': 3}[fmt]
+    return s, split
+
+
+def fake_prediction(batch_size, img_size):
+    n = 3 * sum((img_size // s) ** 2 for s in (8, 16, 32))
+    pred = torch.zeros((batch_size, n, nc + 5))
+    pred[..., :2] = torch.rand((batch_size, n, 2), generator=g) * img_size
+    pred[..., 2:4] = torch.rand((batch_size, n, 2), generator=g) * 60 + 4
+    pred[..., 4] = torch.sigmoid(torch.randn((batch_size, n), generator=g) * 1.5 - 8)
+    pred[..., 5:] = torch.sigmoid(torch.randn((batch_size, n, nc), generator=g) * 1.5 - 6.5)
+    gt = []
+    for b in range(batch_size):
+        objs = []
+        gt.append([])
+        band = img_size / args.plates  # one plate per horizontal band, plates do not overlap
+        for p in range(randint(args.plates + 1)):
+            s, split = fake_plate_string()
+            two_row = rand() < args.two_row
+            w, h = (100 + rand() * 100, 60 + rand() * 30) if two_row else (120 + rand() * 160, 30 + rand() * 40)
+            h = min(h, band)
+            x, y = rand() * (img_size - w), p * band + rand() * (band - h)
+            objs.append((x + w / 2, y + h / 2, w, h, nc - 1, None))
+            gt[-1].append(s)
+            if two_row:
+                rows = [(s[:split], y + 0.27 * h), (s[split:], y + 0.73 * h)]
+                ch = 0.38 * h
+            else:
+                rows = [(s[:split] + '-' + s[split:], y + 0.5 * h)]
+                ch = 0.6 * h
+            for text, cy in rows:
+                cw = 0.8 * w / max(len(text), 1)  # chars on the inner 80% of the plate
+                for k, c in enumerate(text):
+                    if c == '-':
+                        continue
+                    cls = CLASS_NAMES.index(c)
+                    confuse = look_alike.get(cls) if rand() < args.confuse else None
+                    objs.append((x + 0.1 * w + cw * (k + 0.5), cy, 0.8 * cw, ch, cls, confuse))
+        free = torch.randperm(n, generator=g).tolist()  # each anchor fires for one object only
+        for cx, cy, w, h, cls, confuse in objs:
+            hits = torch.tensor([free.pop() for _ in range(int(8 + rand() * 16))])
+            jitter = torch.randn((len(hits), 4), generator=g) * 0.04
+            pred[b, hits, 0] = cx + jitter[:, 0] * w
+            pred[b, hits, 1] = cy + jitter[:, 1] * h
+            pred[b, hits, 2] = w * (1 + jitter[:, 2])
+            pred[b, hits, 3] = h * (1 + jitter[:, 3])
+            pred[b, hits, 4] = 0.6 + torch.rand(len(hits), generator=g) * 0.35
+            pred[b, hits, 5 + cls] = 0.6 + torch.rand(len(hits), generator=g) * 0.2
+            if confuse is not None:
+                pred[b, hits, 5 + CLASS_NAMES.index(confuse)] = 0.85 + torch.rand(len(hits), generator=g) * 0.1
+    return pred.to(device), gt
+
+
+def baseline(pred):
+    # non_max_suppression + group_plate + get_str of the eval scripts
+    strings = []
+    for det in non_max_suppression_batch(pred, multi_label=True):
+        groups = group_plate(det.cpu().numpy())
+        strings.append([''.join(CLASS_NAMES[c[-1]] for c in gr['char']) for gr in groups])
+    return strings
+
+
+decoder = PlateDecoder()
+
+
+def decode(pred):
+    return decoder.strings(decoder(pred))
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def timing(func, pred):
+    out = func(pred)
+    sync()
+    start_time = time.time()
+    for _ in range(args.n_repeat):
+        func(pred)
+    sync()
+    return out, (time.time() - start_time) / args.n_repeat
+
+
+def accuracy(strings, gt):
+    n = sum(len(x) for x in gt)
+    correct = sum(len(set(s) & set(t)) for s, t in zip(strings, gt))
+    return correct / max(n, 1)
+
+
+pred, gt = fake_prediction(args.batch_size, args.img_size)
+with torch.no_grad():
+    base_strings, t_base = timing(baseline, pred)
+    dec_strings, t_dec = timing(decode, pred)
+    args_free = PlateDecoder(formats=None)
+    free_strings = args_free.strings(args_free(pred))
+
+print('%d plates, plate string accuracy: nms + group_plate %.3f, decoder argmax %.3f, decoder with formats %.3f'%(
+    sum(len(x) for x in gt), accuracy(base_strings, gt), accuracy(free_strings, gt), accuracy(dec_strings, gt)))
+print('nms + group_plate + get_str %.2f ms / batch, PlateDecoder %.2f ms / batch'%(t_base * 1000, t_dec * 1000))
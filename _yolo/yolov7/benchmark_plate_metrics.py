@@ -0,0 +1,177 @@
+import argparse
+import copy
+import time
+import numpy as np
+from utils.plate_metrics import PlateLabels, eval_dataset, group_plate, CLASS_CHARS, PLATE_CLASS
+
+# eval_dataset of utils/plate_metrics against the pure python one of yolo_utils, on detections
+# made from the groundtruth of each label file (jittered plates, dropped / swapped / extra chars,
+# false plates), same accuracy_dict, ms per call.
+# python benchmark_plate_metrics.py --label_txt /data/licence_plate/_plate/weather/label.txt /data/licence_plate/_plate/AOLP/label.txt
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--label_txt', nargs='+', default=['/data/licence_plate/_plate/weather/label.txt',
+                                                       '/data/licence_plate/_plate/AOLP/label.txt'], type=str)
+parser.add_argument('--n_repeat', default=5, type=int)
+parser.add_argument('--seed', default=0, type=int)
+
+args = parser.parse_args()
+print(args)
+
+
+# eval_dataset of yolo_utils before vectorization
+def transfer_label(lab):
+    new_lab = []
+    for l in lab:
+        _l = l.split(',')
+        new_lab.append([int(_l[0]), int(_l[1]), int(_l[2]), int(_l[3])])
+    return new_lab
+
+
+def get_iou(bb1, bb2):
+    x_left = max(bb1[0], bb2[0])
+    y_top = max(bb1[1], bb2[1])
+    x_right = min(bb1[2], bb2[2])
+    y_bottom = min(bb1[3], bb2[3])
+    if x_right < x_left or y_bottom < y_top:
+        return 0.0
+    intersection_area = (x_right - x_left) * (y_bottom - y_top)
+    bb1_area = (bb1[2] - bb1[0]) * (bb1[3] - bb1[1])
+    bb2_area = (bb2[2] - bb2[0]) * (bb2[3] - bb2[1])
+    return intersection_area / float(bb1_area + bb2_area - intersection_area)
+
+
+def check_bbox(bb1, bb2):
+    bb1_area = (bb1[2] - bb1[0]) * (bb1[3] - bb1[1])
+    bb2_area = (bb2[2] - bb2[0]) * (bb2[3] - bb2[1])
+    if bb1_area < bb2_area:
+        bb1, bb2 = bb2, bb1
+    return bb1[0] <= bb2[0] and bb1[1] <= bb2[1] and bb1[2] >= bb2[2] and bb1[3] >= bb2[3]
+
+
+def group_plate_loop(outp):
+    chars = []
+    groups = []
+    for obj in outp:
+        if int(obj[-1]) == 34:
+            groups.append({'plate': [int(p) for p in obj[:4]], 'char': []})
+        else:
+            chars.append(obj)
+    for obj in chars:
+        cha = [int(obj[0]), int(obj[1]), int(obj[2]), int(obj[3]), int(obj[5])]
+        for g in groups:
+            if check_bbox(g['plate'], cha[:4]):
+                g['char'].append(cha)
+    for g in groups:
+        g['char'] = sorted(g['char'], key=lambda x: x[0])
+    return groups
+
+
+def get_wer(r, h):
+    d = np.zeros((len(r) + 1) * (len(h) + 1), dtype=np.uint16)
+    d = d.reshape((len(r) + 1, len(h) + 1))
+    for i in range(len(r) + 1):
+        for j in range(len(h) + 1):
+            if i == 0:
+                d[0][j] = j
+            elif j == 0:
+                d[i][0] = i
+    for i in range(1, len(r) + 1):
+        for j in range(1, len(h) + 1):
+            if r[i - 1] == h[j - 1]:
+                d[i][j] = d[i - 1][j - 1]
+            else:
+                d[i][j] = min(d[i - 1][j - 1] + 1, d[i][j - 1] + 1, d[i - 1][j] + 1)
+    sid = d[len(r)][len(h)]
+    return float(sid) / len(r) * 100, sid, len(r)
+
+
+def eval_dataset_loop(results, label_data):
+    correct_plate = {}
+    total_p, correct_p, pred_p = 0, 0, 0
+    for k, v in label_data.items():
+        gt = transfer_label(v)
+        total_p += len(gt)
+        if k in results:
+            r = group_plate_loop(results[k])
+            pred_p += len(r)
+            correct_r = []
+            for _r in r:
+                for idx, bbox in enumerate(gt):
+                    if get_iou(bbox, _r['plate']) >= 0.5:
+                        correct_r.append({'plate': _r['plate'], 'char': _r['char'], 'idx': idx})
+            if len(correct_r) > 0:
+                correct_plate[k] = correct_r
+                correct_p += len(correct_r)
+    n_perfect, n_sid, n_detected = 0, 0, 0
+    for k, v in label_data.items():
+        gt_strs = [s.split(',')[-1] for s in v]
+        for obj in correct_plate.get(k, []):
+            pred_str = [CLASS_CHARS[x[-1]] for x in obj['char']]
+            wer, sid, t = get_wer(list(gt_strs[obj['idx']]), pred_str)
+            n_sid += sid
+            n_detected += t
+            if wer == 0:
+                n_perfect += 1
+    return {'total_p': total_p, 'pred_p': pred_p, 'correct_p': correct_p,
+            'n_perfect': n_perfect, 'n_sid': int(n_sid), 'n_detected': n_detected}
+
+
+def fake_results(label_data, rng):
+    # a noisy detector on the groundtruth
+    results = {}
+    for k, v in label_data.items():
+        if rng.random() < 0.05:
+            continue
+        dets = []
+        for l in v + ['%d,%d,%d,%d,%s'%(20, 20, 120, 60, 'AB123')] * int(rng.random() < 0.1):
+            _l = l.split(',')
+            x1, y1, x2, y2 = [float(x) for x in _l[:4]]
+            w, h = x2 - x1, y2 - y1
+            jitter = rng.normal(0, 0.08, 4) * [w, h, w, h]
+            dets.append([x1 + jitter[0], y1 + jitter[1], x2 + jitter[2], y2 + jitter[3], 0.9, PLATE_CLASS])
+            plate = list(_l[-1])
+            for i, c in enumerate(plate):
+                if rng.random() < 0.05:
+                    continue
+                cls = int(np.nonzero(CLASS_CHARS == c)[0][0]) if c in CLASS_CHARS else 0
+                if rng.random() < 0.05:
+                    cls = int(rng.integers(0, PLATE_CLASS))
+                cx1 = x1 + w * (i + 0.1) / max(len(plate), 1)
+                dets.append([cx1, y1 + 0.1 * h, cx1 + 0.8 * w / max(len(plate), 1), y2 - 0.1 * h, 0.8, cls])
+            if rng.random() < 0.05:
+                dets.append([x1 + 0.5 * w, y1 + 0.1 * h, x1 + 0.6 * w, y2 - 0.1 * h, 0.5, int(rng.integers(0, PLATE_CLASS))])
+        order = rng.permutation(len(dets))
+        results[k] = np.array(dets, dtype=np.float32).reshape(-1, 6)[order]
+    return results
+
+
+def timing(func):
+    start_time = time.time()
+    for _ in range(args.n_repeat):
+        out = func()
+    return out, (time.time() - start_time) / args.n_repeat
+
+
+rng = np.random.default_rng(args.seed)
+for label_txt in args.label_txt:
+    labels = PlateLabels.from_file(label_txt)
+    label_data = {}
+    with open(label_txt, 'r') as label_file:
+        for line in label_file.readlines():
+            l = line.strip().split(' ')
+            label_data[l[0]] = l[1:]
+    results = fake_results(label_data, rng)
+
+    for k in list(results.keys())[:200]:
+        groups = group_plate(results[k])
+        assert groups == group_plate_loop(results[k]), 'group_plate changed on %s'%k
+
+    ref, t_loop = timing(lambda: eval_dataset_loop(results, label_data))
+    accuracy_dict, t_vec = timing(lambda: eval_dataset(results, labels))
+    accuracy_dict_dict, _ = timing(lambda: eval_dataset(results, label_data))
+    for key, value in ref.items():
+        assert accuracy_dict[key] == value, '%s: %s != %s'%(key, accuracy_dict[key], value)
+    assert accuracy_dict == accuracy_dict_dict
+    print('%s: %d images, %d plates, loop %.1f ms, vectorized %.1f ms (x%.1f)'%(
+        label_txt, len(labels), ref['total_p'], t_loop * 1000, t_vec * 1000, t_loop / max(t_vec, 1e-9)))
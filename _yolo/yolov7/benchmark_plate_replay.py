@@ -0,0 +1,69 @@
+import argparse
+import glob
+import os
+import time
+import cv2
+import numpy as np
+import torch
+import yaml
+from utils.generator import plate_generator
+from utils.datasets import LoadImagesAndLabels_generate, LoadImagesAndLabels_replay, InfiniteDataLoader
+
+# training samples/s of LoadImagesAndLabels_generate (plate_generator + mix_aug for every mosaic tile)
+# against LoadImagesAndLabels_replay (pool of generated samples per worker, --refresh of it generated
+# again per epoch), same hyp / mosaic / perspective augmentation, pool hit rate and generator samples/s
+# of replay_metrics per epoch.
+# python benchmark_plate_replay.py --bg_dir /data/yolov7/coco/images/train2017 --glyph_atlas glyph_atlas.npz --workers 8
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--bg_dir', default='replay_benchmark_bg', type=str)#background images, random ones written when missing
+parser.add_argument('--n', default=256, type=int)#samples per epoch
+parser.add_argument('--epochs', default=3, type=int)
+parser.add_argument('--img_size', default=640, type=int)
+parser.add_argument('--batch_size', default=16, type=int)
+parser.add_argument('--workers', default=2, type=int)
+parser.add_argument('--pool', default=64, type=int)#replay_pool per worker
+parser.add_argument('--refresh', default=0.25, type=float)#replay_refresh
+parser.add_argument('--hyp', default='data/hyp.scratch.p5.yaml', type=str)
+parser.add_argument('--glyph_atlas', default='glyph_atlas.npz', type=str)
+parser.add_argument('--char_path', nargs=2, default=None, type=str)#6 and 7 characters folders, to build --glyph_atlas when missing
+parser.add_argument('--plate_bg', nargs=2, default=None, type=str)#blank plates, to build --glyph_atlas when missing
+
+args = parser.parse_args()
+print(args)
+
+if not os.path.exists(args.glyph_atlas):
+    plate_generator(load_path=args.char_path, bg_path=args.plate_bg, atlas_path=args.glyph_atlas)
+if not glob.glob(os.path.join(args.bg_dir, '*.jpg')):
+    os.makedirs(args.bg_dir, exist_ok=True)
+    for i in range(args.n):
+        cv2.imwrite(os.path.join(args.bg_dir, '%08d.jpg'%i), np.random.randint(0, 256, (480, 640, 3), dtype=np.uint8))
+
+with open(args.hyp) as f:
+    hyp = yaml.load(f, Loader=yaml.SafeLoader)
+hyp['paste_in'] = 0  # needs the labels of a file dataset
+
+
+def run(name, dataset):
+    dataset.image_files = dataset.image_files[:args.n]
+    dataset.indices = range(len(dataset))
+    loader = InfiniteDataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers,
+                                collate_fn=LoadImagesAndLabels_generate.collate_fn)
+    for epoch in range(args.epochs):  # InfiniteDataLoader, same workers and pools every epoch
+        start_time = time.time()
+        n = 0
+        for img, labels, keys, shapes in loader:
+            n += img.shape[0]
+        msg = '%-10s epoch %d %10.1f samples/s'%(name, epoch, n / (time.time() - start_time))
+        if hasattr(dataset, 'replay_metrics'):
+            metrics = dataset.replay_metrics()
+            msg += ', hit rate %.2f, generated %d at %.1f samples/s/worker, pool %d'%(
+                metrics['replay/hit_rate'], metrics['replay/generated'], metrics['replay/generator_fps'], metrics['replay/pool'])
+        print(msg)
+
+
+cv2.setNumThreads(1)
+kwargs = dict(augment=True, hyp=hyp, glyph_atlas=args.glyph_atlas, fast_generator=True)  # as train_gendata.py
+run('generate', LoadImagesAndLabels_generate(args.bg_dir, args.img_size, args.batch_size, **kwargs))
+run('replay', LoadImagesAndLabels_replay(args.bg_dir, args.img_size, args.batch_size, replay_pool=args.pool,
+                                         replay_refresh=args.refresh, **kwargs))
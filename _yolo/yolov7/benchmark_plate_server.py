@@ -0,0 +1,100 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import cv2
+import numpy as np
+import torch
+import yaml
+from models.yolo_with_diffusion import Model_with_diffusion
+from utils.plate_server import PlatePipeline, PlateServer, load_ema_denoise_fn
+
+# load generator of PlateServer: clients send one image at a time and wait for the plates,
+# latency p50 / p99 and images/s at each concurrency level, mean batch size of the worker.
+# without --weights / --unet_path the models are randomly initialized (speed only).
+# python benchmark_plate_server.py --weights runs/train/exp2/weights/best_288_state_dict.pt \
+#     --unet_path /data/licence_plate/Cold-Diffusion-Models/licenceplate_deaug_yolov7_pytorch/latent_yolov7_1024_aug_from_dataloader_train/model.pt \
+#     --img_dir /data/licence_plate/_plate/AOLP/original/ --concurrency 1 4 16 64
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--cfg', default='cfg/training/yolov7-tiny.yaml', type=str)
+parser.add_argument('--hyp', default='cfg/deploy/hyp.scratch.tiny.yaml', type=str)
+parser.add_argument('--weights', default='', type=str)#state_dict of Model_with_diffusion
+parser.add_argument('--unet_path', default='', type=str)#model.pt of the diffusion Trainer
+parser.add_argument('--diffusion_path', default='../../Cold-Diffusion-Models/licenceplate_deaug_yolov7_2noise/', type=str)
+parser.add_argument('--nc', default=35, type=int)
+parser.add_argument('--input_size', default=512, type=int)
+parser.add_argument('--img_dir', default='', type=str)#random images when empty
+parser.add_argument('--times', nargs='+', default=[100], type=int)#diffusion step of each request, drawn from the list
+parser.add_argument('--concurrency', nargs='+', default=[1, 4, 16, 64], type=int)
+parser.add_argument('--n_requests', default=256, type=int)#per concurrency level
+parser.add_argument('--max_batch_size', default=16, type=int)
+parser.add_argument('--max_wait_ms', default=5, type=float)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+
+args = parser.parse_args()
+print(args)
+
+sys.path.append(args.diffusion_path)
+from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader_2noise import Unet
+
+device = torch.device(args.device)
+with open(args.hyp) as f:
+    hyp = yaml.load(f, Loader=yaml.SafeLoader)  # load hyps
+model = Model_with_diffusion(args.cfg, ch=3, nc=args.nc, anchors=hyp.get('anchors')).to(device)
+if args.weights:
+    model.load_state_dict(torch.load(args.weights, map_location=device))
+model.eval()
+model.create_subnetwork()
+
+unet = Unet(
+    dim = 64,
+    dim_mults = (1, 2, 4, 8),
+    channels=model.latent_channels,
+    with_time_emb=True,
+    residual=False
+)
+if args.unet_path:
+    unet = load_ema_denoise_fn(unet, args.unet_path, device)
+else:
+    unet = unet.to(device).eval()
+
+pipeline = PlatePipeline(model, unet, args.input_size, device)
+
+if args.img_dir:
+    imgs = [cv2.imread(os.path.join(args.img_dir, f)) for f in sorted(os.listdir(args.img_dir))[:64] if f.endswith('.jpg')]
+else:
+    rng = np.random.default_rng(0)
+    imgs = [rng.integers(0, 255, (int(rng.integers(240, 720)), int(rng.integers(320, 1280)), 3), dtype=np.uint8) for _ in range(64)]
+
+
+async def client(server, n, latency, rng):
+    for _ in range(n):
+        img = imgs[int(rng.integers(len(imgs)))]
+        times = args.times[int(rng.integers(len(args.times)))]
+        start_time = time.perf_counter()
+        await server.infer(img, times=times)
+        latency.append(time.perf_counter() - start_time)
+
+
+async def load_test(concurrency):
+    server = PlateServer(pipeline, max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000)
+    await server.start()
+    # warm up, one full batch
+    await asyncio.gather(*[server.infer(imgs[0]) for _ in range(args.max_batch_size)])
+    server.batch_sizes = []
+    latency = []
+    n = max(args.n_requests // concurrency, 1)
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client(server, n, latency, np.random.default_rng(i)) for i in range(concurrency)])
+    total = time.perf_counter() - start_time
+    await server.stop()
+    latency = np.array(latency) * 1000
+    print('concurrency %3d: %d requests, p50 %.1f ms, p99 %.1f ms, %.1f images/s, mean batch %.1f'%(
+        concurrency, len(latency), np.percentile(latency, 50), np.percentile(latency, 99),
+        len(latency) / total, np.mean(server.batch_sizes)))
+
+
+for concurrency in args.concurrency:
+    asyncio.get_event_loop().run_until_complete(load_test(concurrency))
@@ -0,0 +1,130 @@
+import argparse
+import concurrent.futures
+import os
+import shutil
+import time
+import cv2
+import numpy as np
+import torch
+from utils.generator import plate_generator
+from utils.plate_shards import write_plate_shards, write_index, read_shard_index, iterate_shard, stream_samples
+from utils.datasets import LoadImagesAndLabels_shards
+
+# offline plate dataset of _plate/synthesis/generate_plate.py: samples/s of the previous layout (workers
+# return the images, the parent encodes and writes jpg + txt) against workers writing their own shards,
+# same seed twice gives the same labels / steps / jpg bytes, samples/s of stream_samples, readers
+# together read every sample once, samples/s of LoadImagesAndLabels_shards in a DataLoader.
+# python benchmark_plate_shards.py --n 2000 --workers 8 --bg_dir /data/yolov7/coco/images/train2017 --output /tmp/plate_shards
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--n', default=400, type=int)
+parser.add_argument('--workers', default=4, type=int)
+parser.add_argument('--output', default='plate_shards_benchmark', type=str)
+parser.add_argument('--shard_size', default=100, type=int)
+parser.add_argument('--no_augment', action='store_true')
+parser.add_argument('--bg_dir', default=None, type=str)#background images, plate_generator backgrounds when None
+parser.add_argument('--image_size', default=512, type=int)
+parser.add_argument('--char_path', nargs=2, default=None, type=str)#6 and 7 characters folders, plate_generator default when None
+parser.add_argument('--plate_bg', nargs=2, default=None, type=str)#blank plates, plate_generator default when None
+parser.add_argument('--loader_workers', default=2, type=int)
+parser.add_argument('--seed', default=0, type=int)
+
+args = parser.parse_args()
+print(args)
+
+generator_kwargs = dict(image_size=args.image_size, augment=not args.no_augment, load_path=args.char_path, bg_path=args.plate_bg,
+                        bg_dir=args.bg_dir)
+legacy_generator = None
+
+
+def legacy_sample(seed):
+    # previous generate_plate.py worker, the image goes back to the parent
+    global legacy_generator
+    if legacy_generator is None:
+        cv2.setNumThreads(1)
+        legacy_generator = plate_generator(image_size=args.image_size, load_path=args.char_path, bg_path=args.plate_bg)
+        legacy_generator.fast_composite = legacy_generator.fast_background = True  # same plates as make_generator, only the layout differs
+    np.random.seed(seed)
+    return legacy_generator.get_plate()
+
+
+def legacy_write(output_dir):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(legacy_sample, i) for i in range(args.n)]
+        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+            img, msg = future.result()
+            base_filename = os.path.join(output_dir, '%08d'%i)
+            cv2.imwrite(base_filename + '.jpg', img)
+            with open(base_filename + '.txt', 'w') as file:
+                for sublist in msg:
+                    file.write(','.join(map(str, sublist)) + '\n')
+
+
+def shard_write(output_dir, seed):
+    counts = [args.n // args.workers + (1 if w < args.n % args.workers else 0) for w in range(args.workers)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(write_plate_shards, w, counts[w], output_dir, seed=seed, shard_size=args.shard_size,
+                                   save_clean=not args.no_augment, **generator_kwargs) for w in range(args.workers)]
+        results = [f.result() for f in futures]
+    return write_index(output_dir, results, seed=seed)
+
+
+def timing(func, *inputs):
+    output_dir = os.path.join(args.output, func.__name__)
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+    start_time = time.time()
+    func(output_dir, *inputs)
+    return output_dir, args.n / (time.time() - start_time)
+
+
+def write_speed(name, speed, output_dir):
+    size = sum(os.path.getsize(os.path.join(output_dir, f)) for f in os.listdir(output_dir))
+    print('%-28s %10.1f samples/s %8d files %10.1f MB'%(name, speed, len(os.listdir(output_dir)), size / 2 ** 20))
+
+
+_, legacy_speed = timing(legacy_write)
+write_speed('parent writes jpg + txt', legacy_speed, os.path.join(args.output, 'legacy_write'))
+shard_dir, shard_speed = timing(shard_write, args.seed)
+write_speed('workers write shards', shard_speed, shard_dir)
+
+# determinism: worker 0 again with the same seed
+check_dir = os.path.join(args.output, 'check')
+if os.path.exists(check_dir):
+    shutil.rmtree(check_dir)
+os.makedirs(check_dir)
+n_check = min(args.shard_size, args.n // args.workers)
+result = write_plate_shards(0, n_check, check_dir, seed=args.seed, shard_size=args.shard_size, save_clean=not args.no_augment, **generator_kwargs)
+first = list(iterate_shard(os.path.join(shard_dir, result['shards'][0]['path'])))[:n_check]
+again = list(iterate_shard(os.path.join(check_dir, result['shards'][0]['path'])))
+for a, b in zip(first, again):
+    assert a['key'] == b['key'] and a['step'] == b['step'] and np.array_equal(a['labels'], b['labels']), 'seed %d not deterministic'%args.seed
+    assert np.array_equal(a['img'], b['img']), 'seed %d images differ'%args.seed
+print('seed %d worker 0: %d samples rewritten, same labels / steps / images'%(args.seed, len(again)))
+
+shards = read_shard_index(shard_dir)
+start_time = time.time()
+n_read = sum(1 for _ in stream_samples(shards, loop=False))
+print('%-28s %10.1f samples/s %8d samples'%('stream_samples', n_read / (time.time() - start_time), n_read))
+assert n_read == args.n, 'stream_samples read %d of %d samples'%(n_read, args.n)
+
+# readers (dataloader workers x ranks) split the shards by count, or every n_parts-th sample when there
+# are fewer shards than readers, together they read every sample once, counts differ by at most one shard
+for n_parts in sorted(set([max(len(shards) // 2, 1), len(shards) + 3])):
+    reads = [[s['key'] for s in stream_samples(shards, part, n_parts, shuffle_buffer=8, loop=False)] for part in range(n_parts)]
+    keys = [k for r in reads for k in r]
+    assert len(keys) == args.n and len(set(keys)) == args.n, '%d readers of %d shards: %d reads, %d samples of %d'%(
+        n_parts, len(shards), len(keys), len(set(keys)), args.n)
+    counts = [len(r) for r in reads]
+    assert max(counts) - min(counts) <= max(s['count'] for s in shards), 'readers unbalanced %s'%counts
+    print('%d readers of %d shards: every sample read once, %d-%d samples per reader'%(n_parts, len(shards), min(counts), max(counts)))
+
+dataset = LoadImagesAndLabels_shards(shard_dir, args.image_size, batch_size=16)
+loader = torch.utils.data.DataLoader(dataset, batch_size=16, num_workers=args.loader_workers,
+                                     collate_fn=LoadImagesAndLabels_shards.collate_fn)
+start_time = time.time()
+n_read = 0
+for img, labels, keys, shapes in loader:
+    n_read += img.shape[0]
+print('%-28s %10.1f samples/s %8d samples, %d loader workers'%('LoadImagesAndLabels_shards', n_read / (time.time() - start_time), n_read, args.loader_workers))
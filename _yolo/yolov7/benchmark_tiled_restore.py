@@ -0,0 +1,83 @@
+import argparse
+import sys
+import time
+import torch
+from utils.tiled_restore import TiledRestorer
+
+# whole image denoise_fn against TiledRestorer (overlapping tiles, feathered seams) and plate tiles
+# only, ms and peak device memory per image size, relative diff of the tiled output to the whole one.
+# a pointwise denoise_fn (1x1 conv) checks the blending itself, tiled == whole up to float error.
+# image space (image_diffusion_2l.py): --channels 3 --residual --tile 256 --overlap 32
+# yolo latent at stride 8 (test_yolov7_diffusion_latent_demix_1024.py): --channels 128 --size 128 256 --tile 32 --overlap 8
+# python benchmark_tiled_restore.py --channels 3 --residual --size 512 1024 2048 --tile 256 --overlap 32
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--diffusion_path', default='../../Cold-Diffusion-Models/licenceplate_deaug_yolov7_pytorch/', type=str)
+parser.add_argument('--channels', default=3, type=int)
+parser.add_argument('--residual', action='store_true')
+parser.add_argument('--size', nargs='+', default=[512, 1024, 2048], type=int)
+parser.add_argument('--full_max', default=2048, type=int)#largest size run as a whole image
+parser.add_argument('--tile', default=256, type=int)
+parser.add_argument('--overlap', default=32, type=int)
+parser.add_argument('--tile_batch', default=8, type=int)
+parser.add_argument('--n_plates', default=2, type=int)#random plate boxes per image for the plate tiles mode
+parser.add_argument('--plate_size', default=0.1, type=float)#plate width / image size
+parser.add_argument('--batch_size', default=1, type=int)
+parser.add_argument('--n_repeat', default=3, type=int)
+parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+
+args = parser.parse_args()
+print(args)
+
+sys.path.append(args.diffusion_path)
+from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader import Unet
+
+device = torch.device(args.device)
+torch.manual_seed(0)
+unet = Unet(dim=64, dim_mults=(1, 2, 4, 8), channels=args.channels, with_time_emb=True, residual=args.residual).to(device).eval()
+pointwise = torch.nn.Conv2d(args.channels, args.channels, 1).to(device)
+
+
+def timing(func, *inputs):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    with torch.no_grad():
+        out = func(*inputs)
+        start_time = time.time()
+        for _ in range(args.n_repeat):
+            func(*inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else float('nan')
+    return out, (time.time() - start_time) / args.n_repeat * 1000, peak
+
+
+def random_plates(size):
+    boxes = []
+    for _ in range(args.batch_size):
+        w = size * args.plate_size
+        xy = torch.rand((args.n_plates, 2)) * (size - w)
+        boxes.append(torch.cat([xy, xy + torch.tensor([w, w / 2])], 1))
+    return boxes
+
+
+restorer = TiledRestorer(unet, args.tile, args.overlap, args.tile_batch)
+restorer_pointwise = TiledRestorer(lambda x, t: pointwise(x), args.tile, args.overlap, args.tile_batch)
+print('%-6s %-12s %10s %12s %10s %12s'%('size', 'mode', 'ms', 'peak MB', 'tiles', 'rel diff'))
+for size in args.size:
+    x = torch.rand((args.batch_size, args.channels, size, size), device=device)
+    t = torch.randint(0, 100, (args.batch_size,), device=device)
+    with torch.no_grad():
+        ref = pointwise(x)
+        diff = ((restorer_pointwise(x, t) - ref).abs().max() / ref.abs().max()).item()
+    assert diff < 1e-5, 'tiles of a pointwise denoise_fn differ from the whole image (%.2e)'%diff
+    full = None
+    if size <= args.full_max:
+        full, ms, peak = timing(unet, x, t)
+        print('%-6d %-12s %10.1f %12.1f %10s %12s'%(size, 'whole', ms, peak, '-', '-'))
+    tiled, ms, peak = timing(restorer, x, t)
+    diff = '-' if full is None else '%.2e'%((tiled - full).abs().max() / full.abs().max()).item()
+    print('%-6d %-12s %10.1f %12.1f %10.2f %12s'%(size, 'tiled', ms, peak, sum(restorer.restored) / args.batch_size, diff))
+    _, ms, peak = timing(restorer, x, t, random_plates(size), args.overlap)
+    print('%-6d %-12s %10.1f %12.1f %10.2f %12s'%(size, 'plate tiles', ms, peak, sum(restorer.restored) / args.batch_size, '-'))
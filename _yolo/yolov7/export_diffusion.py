@@ -0,0 +1,162 @@
+import argparse
+import sys
+import numpy as np
+import torch
+import torchvision
+import yaml
+from models.yolo_with_diffusion import Model_with_diffusion
+from models.experimental import DiffusionEnd2End
+
+# one onnx graph of before_diffusion_model -> Unet / Unet_2timeEmb -> after_diffusion_model -> NMS,
+# timestep fixed (--times) or a graph input (--times -1), NMS of onnxruntime (--max-wh) or
+# EfficientNMS_TRT (no --max-wh). with onnxruntime NMS the graph is run on onnxruntime-CPU and
+# compared to the pytorch pipeline + torchvision nms.
+# python export_diffusion.py --weights runs/train/exp2/weights/best_288_state_dict.pt \
+#     --unet_path /data/licence_plate/Cold-Diffusion-Models/licenceplate_deaug_yolov7_pytorch/latent_yolov7_1024_aug_from_dataloader_train/model.pt \
+#     --img-size 1024 --times 100 --max-wh 1024 --output diffusion_end2end.onnx
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--cfg', default='cfg/training/yolov7-tiny.yaml', type=str)
+parser.add_argument('--hyp', default='cfg/deploy/hyp.scratch.tiny.yaml', type=str)
+parser.add_argument('--weights', default='', type=str)#state_dict of Model_with_diffusion, random init when empty
+parser.add_argument('--unet_path', default='', type=str)#model.pt of the diffusion Trainer, random init when empty
+parser.add_argument('--unet', default='Unet', choices=['Unet', 'Unet_2timeEmb'], type=str)
+parser.add_argument('--diffusion_path', default='../../Cold-Diffusion-Models/licenceplate_deaug_yolov7_2noise/', type=str)
+parser.add_argument('--nc', default=35, type=int)
+parser.add_argument('--split', default='14', type=str)#create_subnetwork split, layer index or 'P3'
+parser.add_argument('--times', default=100, type=int)#diffusion step in the graph, -1 = input t
+parser.add_argument('--times_g', default=100, type=int)#g step of Unet_2timeEmb, -1 = input g
+parser.add_argument('--img-size', default=512, type=int)
+parser.add_argument('--batch-size', default=1, type=int)
+parser.add_argument('--dynamic-batch', action='store_true')
+parser.add_argument('--topk-all', default=100, type=int)
+parser.add_argument('--iou-thres', default=0.45, type=float)
+parser.add_argument('--conf-thres', default=0.25, type=float)
+parser.add_argument('--max-wh', default=None, type=int)#onnxruntime NMS class offset, None = TensorRT NMS
+parser.add_argument('--opset', default=12, type=int)
+parser.add_argument('--output', default='diffusion_end2end.onnx', type=str)
+parser.add_argument('--seed', default=0, type=int)
+
+args = parser.parse_args()
+print(args)
+
+sys.path.append(args.diffusion_path)
+from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader_2noise import Unet, Unet_2timeEmb
+from utils.plate_server import load_ema_denoise_fn
+
+torch.manual_seed(args.seed)
+device = torch.device('cpu')
+with open(args.hyp) as f:
+    hyp = yaml.load(f, Loader=yaml.SafeLoader)  # load hyps
+model = Model_with_diffusion(args.cfg, ch=3, nc=args.nc, anchors=hyp.get('anchors')).to(device)
+if args.weights:
+    model.load_state_dict(torch.load(args.weights, map_location=device))
+model.eval()
+with torch.no_grad():
+    model.fuse()  # only for ONNX, IDetect.fuseforward has the end2end output
+model.create_subnetwork(int(args.split) if args.split.lstrip('-').isdigit() else args.split)
+
+unet = (Unet if args.unet == 'Unet' else Unet_2timeEmb)(
+    dim = 64,
+    dim_mults = (1, 2, 4, 8),
+    channels=model.latent_channels,
+    with_time_emb=True,
+    residual=False
+)
+if args.unet_path:
+    unet = load_ema_denoise_fn(unet, args.unet_path, device)
+unet.eval()
+
+times = args.times if args.times > 0 else None
+times_g = args.times_g if args.times_g > 0 else None
+two_time_emb = args.unet == 'Unet_2timeEmb'
+end2end = DiffusionEnd2End(model, unet, times=times, times_g=times_g, two_time_emb=two_time_emb, max_obj=args.topk_all,
+                           iou_thres=args.iou_thres, score_thres=args.conf_thres, max_wh=args.max_wh, device=device,
+                           n_classes=args.nc).eval()
+
+img = torch.rand((args.batch_size, 3, args.img_size, args.img_size))
+t = torch.full((args.batch_size,), args.times if times is None else 1, dtype=torch.long)
+g = torch.full((args.batch_size,), args.times_g if times_g is None else 1, dtype=torch.long)
+inputs, input_names = [img], ['images']
+if times is None:
+    t = torch.randint(1, 101, (args.batch_size,))
+    inputs.append(t)
+    input_names.append('t')
+if two_time_emb and times_g is None:
+    g = torch.randint(1, 101, (args.batch_size,))
+    if times is not None:
+        inputs.append(None)
+    inputs.append(g)
+    input_names.append('g')
+inputs = tuple(inputs)
+
+if args.max_wh is None:
+    output_names = ['num_dets', 'det_boxes', 'det_scores', 'det_classes']
+    dynamic_axes = {n: {0: 'batch'} for n in output_names}
+else:
+    output_names = ['output']
+    dynamic_axes = {'output': {0: 'num_dets'}}
+if args.dynamic_batch:
+    dynamic_axes.update({n: {0: 'batch'} for n in input_names})
+
+with torch.no_grad():
+    end2end(*inputs)  # dry run, Detect grids
+    torch.onnx.export(end2end, inputs, args.output, verbose=False, opset_version=args.opset,
+                      input_names=input_names, output_names=output_names, dynamic_axes=dynamic_axes,
+                      **({'dynamo': False} if 'dynamo' in torch.onnx.export.__code__.co_varnames else {}))
+
+import onnx
+onnx_model = onnx.load(args.output)  # load onnx model
+onnx.checker.check_model(onnx_model)  # check onnx model
+print('ONNX export success, saved as %s, inputs %s, outputs %s'%(args.output, input_names, output_names))
+
+if args.max_wh is None:
+    print('EfficientNMS_TRT graph, onnxruntime smoke test skipped (needs --max-wh)')
+    sys.exit(0)
+
+# onnxruntime-CPU smoke test: the graph without NMS against the pytorch pipeline, then the NMS
+# graph against pytorch + torchvision nms ([batch_index, x1, y1, x2, y2, cls, score] rows), every
+# row is a candidate box, same count and top score per image (near tied scores of an untrained
+# model may swap boxes between the two nms)
+import onnxruntime as ort
+raw = DiffusionEnd2End(model, unet, times=times, times_g=times_g, two_time_emb=two_time_emb, device=device,
+                       include_nms=False).eval()
+raw_output = args.output.replace('.onnx', '_raw.onnx')
+with torch.no_grad():
+    torch.onnx.export(raw, inputs, raw_output, verbose=False, opset_version=args.opset,
+                      input_names=input_names, output_names=['output'],
+                      **({'dynamo': False} if 'dynamo' in torch.onnx.export.__code__.co_varnames else {}))
+feed = {'images': img.numpy()}
+if 't' in input_names:
+    feed['t'] = t.numpy()
+if 'g' in input_names:
+    feed['g'] = g.numpy()
+raw_ort = ort.InferenceSession(raw_output, providers=['CPUExecutionProvider']).run(None, feed)[0]
+out_ort = ort.InferenceSession(args.output, providers=['CPUExecutionProvider']).run(None, feed)[0]
+
+with torch.no_grad():
+    pred = raw(img, t, g)
+raw_diff = np.abs(raw_ort - pred.numpy()).max() / max(np.abs(pred.numpy()).max(), 1e-9)
+print('raw detect output, relative max diff onnxruntime - pytorch = %.2e'%raw_diff)
+assert raw_diff < 1e-3, 'onnxruntime and pytorch detect outputs differ'
+
+boxes = torchvision.ops.box_convert(pred[..., :4], 'cxcywh', 'xyxy')
+score, cls = (pred[..., 5:] * pred[..., 4:5]).max(2)
+n_torch, n_same = [], 0
+for i in range(pred.shape[0]):
+    keep = score[i] > args.conf_thres
+    b, s, c = boxes[i][keep], score[i][keep], cls[i][keep]
+    k = torchvision.ops.nms(b + c[:, None].float() * args.max_wh, s, args.iou_thres)[:args.topk_all]
+    n_torch.append(len(k))
+    # every onnxruntime row is a candidate box of this image
+    rows = torch.from_numpy(out_ort[out_ort[:, 0] == i, 1:])
+    cand = torch.cat([b, c[:, None].float(), s[:, None]], 1)
+    if len(rows):
+        dist = (rows[:, None, :] - cand[None, :, :]).abs().max(2)[0].min(1)[0]
+        assert (dist < 1e-2).all(), 'onnxruntime detection not in the pytorch candidates of image %d'%i
+        assert abs(rows[:, 5].max() - s[k].max()) < 1e-5, 'onnxruntime and pytorch top scores differ'
+        kept = cand[k]
+        n_same += int(((rows[:, None, :] - kept[None, :, :]).abs().max(2)[0].min(1)[0] < 1e-2).sum())
+n_ort = np.bincount(out_ort[:, 0].astype(np.int64), minlength=len(img)).tolist()
+print('detections per image onnxruntime %s, pytorch %s, %d / %d same as torchvision nms'%(n_ort, n_torch, n_same, sum(n_torch)))
+assert n_ort == n_torch, 'onnxruntime and pytorch detections differ'
@@ -1,4 +1,5 @@
 import os
+import argparse
 import cv2
 import numpy as np
 import torch
@@ -7,12 +8,24 @@ import torch.nn as nn
 import yaml
 import math
 import copy
+import time
 from tqdm import tqdm
 
-from utils.general import non_max_suppression
-from augmentations import mix_augmentaion
+from utils.general import non_max_suppression, non_max_suppression_batch
+from utils.plate_decode import PlateDecoder
+from utils.plate_metrics import plate_counts, PlateLabels
+from utils.augmentations_torch import mix_augmentaion_torch
+from utils.eval_engine import EvalEngine
+from utils.tiled_restore import TiledRestorer, plate_boxes
+from functools import partial
 from matplotlib import pyplot as plt
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--sweep', nargs='*', default=[], choices=['schedule', 'early_exit', 'unet_mode', 'tile'])#extra sweeps after the step_t sweep, none by default
+parser.add_argument('--decoder', default='nms', choices=['nms', 'plate_decode'])#detections of the EvalEngine configs, nms = non_max_suppression_batch, plate_decode = PlateDecoder (format constrained chars)
+args = parser.parse_args()
+print(args)
+
 #weight = 'runs/train/exp2/weights/best_288.pt'
 weight = 'runs/train/exp5/best_726.pt'
 data = 'data/plate.yaml'
@@ -21,7 +34,9 @@ diffusion_size = 1024
 conf_thres = 0.5
 iou_thres = 0.5
 device = 'cuda:1'
-aug_licence = mix_augmentaion()
+eval_batch_size = 8
+plate_decoder = PlateDecoder(conf_thres=conf_thres, iou_thres=iou_thres) if args.decoder == 'plate_decode' else None
+aug_licence = mix_augmentaion_torch()
 aug_licence.imshape=(input_size,input_size)
 aug_licence.random_parameter()
 with open(data) as f:
@@ -60,7 +75,7 @@ import sys
 
 #from demixing_diffusion_pytorch.demixing_diffusion_licencepairs_pytorch import Unet, GaussianDiffusion, Trainer
 sys.path.append('/data/licence_plate/Cold-Diffusion-Models/licenceplate_deaug_yolov7_pytorch/')
-from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader import Unet, GaussianDiffusion, Trainer
+from licenceplate_deaug_pytorch.licenceplate_deaug_pytorch_aug_in_dataloader import Unet, GaussianDiffusion, Trainer, quantize_dynamic_unet
 work_path='/data/licence_plate/Cold-Diffusion-Models/'
 
 
@@ -266,10 +281,26 @@ def run(img_path):
     Return: output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
     '''
     img, meta = preproccess_img(img_path)
+    return run_img(img), meta
+
+def detect_batch(pred):
+    '''
+    pred: detect output [b, anchors, 5 + nc]
+    Return: b x [num_objs, 6(x1, y1, x2, y2, conf, cls)], non_max_suppression_batch or PlateDecoder (--decoder)
+    '''
+    if plate_decoder is not None:
+        return plate_decoder.to_detections(plate_decoder(pred))
+    return non_max_suppression_batch(pred, conf_thres=conf_thres, iou_thres=iou_thres, multi_label=True)
+
+def run_img(img):
+    '''
+    img: [b, 3, input_size, input_size] on device
+    Return: output = b x [num_objs, 6(x1, y1, x2, y2, conf, cls)]
+    '''
     with torch.no_grad():
         ret = model(img)
-        ret = non_max_suppression(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, labels=[], multi_label=True)
-    return ret, meta
+        ret = detect_batch(ret[0])
+    return ret
 
 #X_0s, X_ts = self.ema_model.module.all_sample(batch_size=batches, img=og_img, times=s_times)
 #step = torch.full((batch_size,), t - 1, dtype=torch.long).cuda()
@@ -293,6 +324,13 @@ def run_withdiffusion(img_path,times=100):
     Return: output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
     '''
     img, meta = preproccess_img(img_path)
+    return run_withdiffusion_img(img,times), meta
+
+def run_withdiffusion_img(img,times=100):
+    '''
+    img: [b, 3, input_size, input_size] on device
+    Return: output = b x [num_objs, 6(x1, y1, x2, y2, conf, cls)]
+    '''
     #b,h,w,c=img.shape
     #print(meta)
     with torch.no_grad():
@@ -312,10 +350,48 @@ def run_withdiffusion(img_path,times=100):
         #print(meta)
 
         ret = model(img_diffusion_output)
-        ret = non_max_suppression(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, labels=[], multi_label=True)
-    return ret, meta
+        ret = detect_batch(ret[0])
+    return ret
+
+
 
+def run_withdiffusion_unet_img(img,unet,times=100):
+    '''
+    run_withdiffusion_img with another denoise_fn (inference modes of Unet)
+    img: [b, 3, input_size, input_size] on device
+    Return: output = b x [num_objs, 6(x1, y1, x2, y2, conf, cls)]
+    '''
+    with torch.no_grad():
+        img_diffusion_input = resize_batch(img,diffusion_size)
+        batch_size = img.shape[0]
+        step = torch.full((batch_size,), times - 1, dtype=torch.long).cuda().to(device)
+        img_diffusion = unet(img_diffusion_input,step)
+        img_diffusion = torch.clamp(img_diffusion, min=0.0, max=1.0)
+        img_diffusion_output = resize_batch(img_diffusion,input_size)
+        ret = model(img_diffusion_output)
+        ret = detect_batch(ret[0])
+    return ret
 
+def run_withdiffusion_tiled_img(img,restorer,times=100,first_pass=False,margin=32):
+    '''
+    run_withdiffusion_img with the denoise_fn on overlapping tiles of the diffusion_size image (TiledRestorer),
+    first_pass: restore only the tiles around the plates found by yolo on img
+    img: [b, 3, input_size, input_size] on device
+    Return: output = b x [num_objs, 6(x1, y1, x2, y2, conf, cls)], fraction of tiles restored per image
+    '''
+    with torch.no_grad():
+        img_diffusion_input = resize_batch(img,diffusion_size)
+        boxes = None
+        if first_pass:
+            boxes = plate_boxes(run_img(img), diffusion_size / input_size)
+        batch_size = img.shape[0]
+        step = torch.full((batch_size,), times - 1, dtype=torch.long).cuda().to(device)
+        img_diffusion = restorer(img_diffusion_input,step,boxes,margin)
+        img_diffusion = torch.clamp(img_diffusion, min=0.0, max=1.0)
+        img_diffusion_output = resize_batch(img_diffusion,input_size)
+        ret = model(img_diffusion_output)
+        ret = detect_batch(ret[0])
+    return ret, restorer.restored
 
 def run_withdiffusion_step(img_path,times=100,per_step=1):
     '''
@@ -345,6 +421,41 @@ def run_withdiffusion_step(img_path,times=100,per_step=1):
         ret = non_max_suppression(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, labels=[], multi_label=True)
     return ret, meta
 
+def run_withdiffusion_schedule(img_path,schedule='uniform',n_steps=5):
+    '''
+    Few step version of run_withdiffusion_step_cold_img, see GaussianDiffusion.get_sample_schedule.
+    Return: output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
+    '''
+    img, meta = preproccess_img(img_path)
+    return run_withdiffusion_schedule_img(img,schedule,n_steps), meta
+
+def run_withdiffusion_schedule_img(img,schedule='uniform',n_steps=5):
+    with torch.no_grad():
+        batch_size = img.shape[0]
+        X_0s, X_ts = diffusion_trainer.ema_model.module.schedule_sample(batch_size=batch_size, img=img, schedule=schedule, n_steps=n_steps, wo_noise=True, clamp=True)
+        img_diffusion_output = X_0s[-1]
+
+        ret = model(img_diffusion_output)
+        ret = detect_batch(ret[0])
+    return ret
+
+def run_withdiffusion_early_exit(img_path,schedule='uniform',n_steps=100,threshold=1e-3):
+    '''
+    run_withdiffusion_schedule which stops once the x0 prediction converges.
+    Return: output = [num_objs, 6(x1, y1, x2, y2, conf, cls)], denoise_fn calls
+    '''
+    img, meta = preproccess_img(img_path)
+    ret, n_calls = run_withdiffusion_early_exit_img(img,schedule,n_steps,threshold)
+    return ret, meta, n_calls
+
+def run_withdiffusion_early_exit_img(img,schedule='uniform',n_steps=100,threshold=1e-3):
+    with torch.no_grad():
+        img_diffusion_output, n_calls = diffusion_trainer.ema_model.module.early_exit_sample(img=img, schedule=schedule, n_steps=n_steps, threshold=threshold, wo_noise=True, clamp=True)
+
+        ret = model(img_diffusion_output)
+        ret = detect_batch(ret[0])
+    return ret, n_calls.tolist()
+
 def run_withdiffusion_step_img(img_path,times=100,per_step=1):
     '''
     Return: output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
@@ -711,24 +822,8 @@ def get_wer(r, h):
     return result, sid, total
 
 def eval_dataset(results,label_data):
-    correct_plate = {}
-    total_p, correct_p, pred_p = 0, 0, 0
-    for k, v in label_data.items():
-        gt = transfer_label(v)
-        total_p += len(gt)
-        if k in results:
-            r = group_plate(results[k]) # r = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...]}, ...]
-            pred_p += len(r)
-            correct_r = []
-            for _r in r:
-                for idx, bbox in enumerate(gt):
-                    if get_iou(bbox, _r['plate']) >= 0.5:
-                        n_r = {'plate': _r['plate'], 'char': _r['char'], 'idx': idx}
-                        correct_r.append(n_r)
-            num = len(correct_r)
-            if num > 0:
-                correct_plate[k] = correct_r
-                correct_p += num
+    counts = plate_counts(results, label_data) # vectorized, utils/plate_metrics.py
+    total_p, correct_p, pred_p = counts['total_p'], counts['correct_p'], counts['pred_p']
                 
     print("Number of Correctly Detected Plates =", correct_p)
     print("Number of Detected Plates =", pred_p)
@@ -736,21 +831,9 @@ def eval_dataset(results,label_data):
     print("Recall = {:.4f}".format(correct_p/total_p))
     print("Precision = {:.4f}".format(correct_p/pred_p))
 
-    n_perfect = 0  ### number of perfectly recognized plates
-    n_sid = 0  ### number of failed recognized chars in detected
-    n_detected = 0  ### number of chars in detected plates
-
-    for k, v in label_data.items():
-        gt_strs = [s.split(',')[-1] for s in v]
-        if k in correct_plate:
-            objs = correct_plate[k]
-            for obj in objs: # obj = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...], 'idx': int(i)}]
-                pred_str = [classes[x[-1]] for x in obj['char']]
-                wer, sid, t = get_wer(list(gt_strs[obj['idx']]), pred_str)
-                n_sid += sid
-                n_detected += t
-                if wer == 0:
-                    n_perfect += 1
+    n_perfect = counts['n_perfect']  ### number of perfectly recognized plates
+    n_sid = counts['n_sid']  ### number of failed recognized chars in detected
+    n_detected = counts['n_detected']  ### number of chars in detected plates
 
 
     print("Characters in Detected Plates = ", n_detected)
@@ -760,6 +843,7 @@ def eval_dataset(results,label_data):
     print("\nNumber of Perfectly Recognized Plates = ", n_perfect)
     print("Accuracy(Detected) = {:.4f}".format(n_perfect/correct_p))
     print("Accuracy(Groundtruth) = {:.4f}".format(n_perfect/total_p))
+    return {'recall': correct_p/total_p, 'precision': correct_p/pred_p, 'accuracy': n_perfect/total_p}
     
 """
 Create label dictionary.
@@ -778,57 +862,159 @@ for line in lines:
     name = l[0]
     plates = l[1:]
     label_data[name] = plates
+plate_labels = PlateLabels(label_data) # parsed once for every eval_dataset below
 #img_dir = '/data/licence_plate/_plate/AOLP/original/'
 img_dir = '/data/licence_plate/_plate/weather/original/'
 
-img_paths = os.listdir(img_dir)
-img_paths.sort()
 model.create_subnetwork()
 #model.before_diffusion_model.half()
 #model.after_diffusion_model.half()
 
-
-_t=[]
-results_all=[]
-
-results = {}
-for f in tqdm(img_paths, ncols=80):
-    if f.endswith('.jpg'):
-        bname = os.path.splitext(f)[0]
-        img_p = img_dir + f
-        ret, meta = run(img_p)
-        
-        if ret[0] is not None:
-            output = affine_transform(ret, meta) # output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
-            results[bname] = output
-            
-_t.append(-1)
-results_all.append(results)
-
+# yolo only (-1) and every step_t on each batch, one pass over the folder
+engine = EvalEngine(img_dir, input_size, device, batch_size=eval_batch_size)
+configs = {-1: run_img}
 #for step_t in [0,50,100,150,200]:
 for step_t in [0,25,50,75,100]:
-    results_diffusion = {}
-    for f in tqdm(img_paths, ncols=80):
-        if f.endswith('.jpg'):
-            bname = os.path.splitext(f)[0]
-            img_p = img_dir + f
-
-            ret, meta = run_withdiffusion(img_p,times=step_t)
-            
-            if ret[0] is not None:
-                #print(meta)
-                output = affine_transform(ret, meta) # output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
-                results_diffusion[bname] = output
-    _t.append(step_t)
-    results_all.append(results_diffusion)
+    configs[step_t] = partial(run_withdiffusion_img, times=step_t)
+results_all = engine.run(configs)
     
 print('yolo model_path= %s'%(weight))
 print('input_size= %s'%(input_size))
 print('diffusion_size= %s'%(diffusion_size))
 print('model_path= %s'%(model_path))
-for _ind,result_ in enumerate(results_all):
+for now_t, result_ in results_all.items():
     #print(result_)
-    now_t=_t[_ind]
     print('--------------')
     print('step_t = %d, '%(now_t))
-    eval_dataset(result_,label_data)
\ No newline at end of file
+    eval_dataset(result_,plate_labels)
+
+
+
+def load_label_data(label_txt):
+    return PlateLabels.from_file(label_txt)
+
+label_sets = [('weather', '/data/licence_plate/_plate/weather/label.txt', '/data/licence_plate/_plate/weather/original/'),
+              ('AOLP', '/data/licence_plate/_plate/AOLP/label.txt', '/data/licence_plate/_plate/AOLP/original/')]
+
+
+
+"""
+Accuracy vs latency of few step schedules (GaussianDiffusion.schedule_sample) on both label sets,
+--sweep schedule.
+"""
+if 'schedule' in args.sweep:
+    schedules = [('uniform', 100), ('uniform', 20), ('uniform', 10), ('uniform', 5),
+                 ('quadratic', 10), ('quadratic', 5), ([99, 60, 30, 10, 0], None)]
+    sweep = []
+    for set_name, set_label_txt, set_img_dir in label_sets:
+        set_label_data = load_label_data(set_label_txt)
+        set_engine = EvalEngine(set_img_dir, input_size, device, batch_size=eval_batch_size)
+        configs = {}
+        for schedule, n_steps in schedules:
+            configs[(str(schedule), n_steps)] = partial(run_withdiffusion_schedule_img, schedule=schedule, n_steps=n_steps)
+        results_schedule = set_engine.run(configs)
+        for schedule, n_steps in schedules:
+            n_call = len(diffusion_trainer.ema_model.module.get_sample_schedule(schedule, n_steps))
+            print('--------------')
+            print('%s, schedule = %s, denoise_fn calls = %d'%(set_name, str(schedule), n_call))
+            accuracy = eval_dataset(results_schedule[(str(schedule), n_steps)], set_label_data)
+            sweep.append([set_name, str(schedule), n_call, accuracy['accuracy'], set_engine.time[(str(schedule), n_steps)] * 1000])
+
+    print('==============')
+    print('batch size %d'%eval_batch_size)
+    print('%-8s %-24s %6s %9s %12s'%('set', 'schedule', 'calls', 'accuracy', 'ms / image'))
+    for set_name, schedule, n_call, acc, latency in sweep:
+        print('%-8s %-24s %6d %9.4f %12.1f'%(set_name, schedule, n_call, acc, latency))
+
+
+
+"""
+Early exit on the weather set: accuracy, latency and denoise_fn calls per image, --sweep early_exit.
+"""
+if 'early_exit' in args.sweep:
+    set_label_data = load_label_data(label_sets[0][1])
+    set_engine = EvalEngine(label_sets[0][2], input_size, device, batch_size=eval_batch_size)
+    thresholds = [0, 1e-4, 5e-4, 1e-3, 5e-3]
+    results_early_exit = set_engine.run({threshold: partial(run_withdiffusion_early_exit_img, threshold=threshold) for threshold in thresholds})
+    early_exit_sweep = []
+    for threshold in thresholds:
+        _calls = set_engine.extra[threshold]
+        print('--------------')
+        print('early exit threshold = %g, denoise_fn calls mean = %.1f, min = %d, max = %d'%(threshold, np.mean(_calls), np.min(_calls), np.max(_calls)))
+        accuracy = eval_dataset(results_early_exit[threshold], set_label_data)
+        early_exit_sweep.append([threshold, np.mean(_calls), accuracy['accuracy'], set_engine.time[threshold] * 1000])
+
+    print('==============')
+    print('%-10s %10s %9s %12s'%('threshold', 'calls', 'accuracy', 'ms / image'))
+    for threshold, calls, acc, latency in early_exit_sweep:
+        print('%-10g %10.1f %9.4f %12.1f'%(threshold, calls, acc, latency))
+
+
+
+"""
+Unet inference modes (Unet.inference_mode / quantize_dynamic_unet) on the weather set at one step:
+accuracy delta to the plain fp32 denoise_fn and latency, int8 runs the denoise_fn on the cpu.
+--sweep unet_mode.
+"""
+if 'unet_mode' in args.sweep:
+    mode_t = 100
+    denoise_fn = diffusion_trainer.ema_model.module.denoise_fn
+    timesteps = diffusion_trainer.ema_model.module.num_timesteps
+    unet_modes = {'fp32': denoise_fn,
+                  'time table': copy.deepcopy(denoise_fn).inference_mode(timesteps),
+                  'fixed t': copy.deepcopy(denoise_fn).inference_mode(timesteps, fixed_time=mode_t - 1),
+                  'fp16': copy.deepcopy(denoise_fn).inference_mode(timesteps, amp_dtype=torch.float16, fixed_time=mode_t - 1),
+                  'bf16': copy.deepcopy(denoise_fn).inference_mode(timesteps, amp_dtype=torch.bfloat16, fixed_time=mode_t - 1)}
+    denoise_int8 = quantize_dynamic_unet(copy.deepcopy(denoise_fn).inference_mode(timesteps))
+    unet_modes['int8 (cpu)'] = lambda x, t: denoise_int8(x.cpu(), t.cpu()).to(x.device)
+    set_label_data = load_label_data(label_sets[0][1])
+    set_engine = EvalEngine(label_sets[0][2], input_size, device, batch_size=eval_batch_size)
+    results_mode = set_engine.run({mode: partial(run_withdiffusion_unet_img, unet=unet, times=mode_t) for mode, unet in unet_modes.items()})
+    mode_sweep = []
+    for mode in unet_modes:
+        print('--------------')
+        print('Unet mode = %s, step_t = %d'%(mode, mode_t))
+        accuracy = eval_dataset(results_mode[mode], set_label_data)
+        mode_sweep.append([mode, accuracy['accuracy'], set_engine.time[mode] * 1000])
+
+    print('==============')
+    print('%-12s %9s %9s %12s'%('mode', 'accuracy', 'delta', 'ms / image'))
+    for mode, acc, latency in mode_sweep:
+        print('%-12s %9.4f %+9.4f %12.1f'%(mode, acc, acc - mode_sweep[0][1], latency))
+
+
+
+
+"""
+Tiled restoration (TiledRestorer) on the weather set at one step: whole diffusion_size image against
+overlapping tiles and against the tiles of the first pass plates only, accuracy, latency and peak
+device memory of the config.
+--sweep tile, peak memory on cuda only.
+"""
+if 'tile' in args.sweep:
+    tile_t = 100
+    denoise_fn = diffusion_trainer.ema_model.module.denoise_fn
+    tile_configs = {'whole': partial(run_withdiffusion_img, times=tile_t)}
+    for tile, overlap in [(512, 64), (256, 32)]:
+        tile_configs['tile %d'%tile] = partial(run_withdiffusion_tiled_img, restorer=TiledRestorer(denoise_fn, tile, overlap), times=tile_t)
+        tile_configs['plates %d'%tile] = partial(run_withdiffusion_tiled_img, restorer=TiledRestorer(denoise_fn, tile, overlap), times=tile_t, first_pass=True)
+    set_label_data = load_label_data(label_sets[0][1])
+    set_engine = EvalEngine(label_sets[0][2], input_size, device, batch_size=eval_batch_size)
+    tile_sweep = []
+    on_cuda = torch.device(device).type == 'cuda'
+    for name, func in tile_configs.items():
+        # one config per pass, the peak memory is its own
+        if on_cuda:
+            torch.cuda.reset_peak_memory_stats(device)
+        results_tile = set_engine.run({name: func})
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20 if on_cuda else float('nan')
+        tiles = np.mean(set_engine.extra[name]) if len(set_engine.extra[name]) > 0 else 1.0
+        print('--------------')
+        print('%s, step_t = %d, tiles restored = %.2f, peak memory = %.0f MB'%(name, tile_t, tiles, peak))
+        accuracy = eval_dataset(results_tile[name], set_label_data)
+        tile_sweep.append([name, tiles, accuracy['accuracy'], set_engine.time[name] * 1000, peak])
+
+    print('==============')
+    print('%-12s %7s %9s %9s %12s %10s'%('mode', 'tiles', 'accuracy', 'delta', 'ms / image', 'peak MB'))
+    for name, tiles, acc, latency, peak in tile_sweep:
+        print('%-12s %7.2f %9.4f %+9.4f %12.1f %10.0f'%(name, tiles, acc, acc - tile_sweep[0][2], latency, peak))
@@ -241,6 +241,54 @@ class End2End(nn.Module):
         return x
 
 
+class DiffusionEnd2End(nn.Module):
+    '''
+    export onnx or tensorrt model of the diffusion pipeline with NMS operation:
+    before_diffusion_model -> denoise_fn -> after_diffusion_model (skip outputs of before) -> NMS.
+    Input:
+        model: Model_with_diffusion after create_subnetwork
+        denoise_fn: Unet (forward(x, t)) or Unet_2timeEmb (forward(x, t, g)) on the latent
+        times: fixed diffusion step baked in the graph, None = timestep is a graph input t [b]
+        times_g: fixed g step of Unet_2timeEmb, None = graph input g [b], ignored for Unet
+        include_nms: False = raw detect output [b, anchors, 5 + nc], no NMS
+    '''
+    def __init__(self, model, denoise_fn, times=None, times_g=None, two_time_emb=False, max_obj=100, iou_thres=0.45,
+                 score_thres=0.25, max_wh=None, device=None, n_classes=80, include_nms=True):
+        super().__init__()
+        device = device if device else torch.device('cpu')
+        assert isinstance(max_wh,(int)) or max_wh is None
+        self.model = model.to(device)
+        self.model.model[-1].end2end = True
+        self.denoise_fn = denoise_fn.to(device)
+        self.times = times
+        self.times_g = times_g
+        self.two_time_emb = two_time_emb
+        self.patch_model = ONNX_TRT if max_wh is None else ONNX_ORT
+        self.end2end = self.patch_model(max_obj, iou_thres, score_thres, max_wh, device, n_classes) if include_nms else None
+        if self.end2end is not None:
+            self.end2end.eval()
+
+    def step(self, latent, times, t):
+        # step = times - 1 of the eval scripts, float for the sinusoidal embedding
+        if times is not None:
+            return torch.ones_like(latent[:, 0, 0, 0]) * (times - 1)
+        return t.float() - 1
+
+    def forward_raw(self, x, t=None, g=None):
+        latent, y = self.model.forward_submodel(x, self.model.before_diffusion_model, output_y=True)
+        if self.two_time_emb:
+            latent = self.denoise_fn(latent, self.step(latent, self.times, t), self.step(latent, self.times_g, g))
+        else:
+            latent = self.denoise_fn(latent, self.step(latent, self.times, t))
+        return self.model.forward_submodel(latent, self.model.after_diffusion_model, init_y=y)
+
+    def forward(self, x, t=None, g=None):
+        x = self.forward_raw(x, t, g)
+        if self.end2end is not None:
+            x = self.end2end(x)
+        return x
+
+
 
 
 
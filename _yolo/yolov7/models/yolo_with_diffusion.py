@@ -738,6 +738,77 @@ class Model(nn.Module):
         model_info(self, verbose, img_size)
         
         
+class SubmodelPlan(object):
+    # execution plan of model[start:end+1]: input index of every layer and the outputs
+    # to drop after it, resolved once, so forward has no isinstance / save checks.
+    # Plain object (not nn.Module), so it is not in the state_dict and DataParallel
+    # replicas share it, the layers are passed in at run time.
+    def __init__(self, model, start, end):
+        layers = list(model)
+        self.start, self.end = start, end
+        self.input_slot = end + 1  # x, also stands for output start-1 (y[-1]=x in forward_submodel)
+
+        def resolve(i, f):
+            j = i - 1 if f == -1 else (f if f >= 0 else i + f)
+            return self.input_slot if j == start - 1 else j
+
+        srcs, last_use = [], {}
+        for m in layers[start:end + 1]:
+            if isinstance(m.f, int):
+                src = resolve(m.i, m.f)
+                for_free = [src]
+            else:
+                src = tuple(resolve(m.i, f) for f in m.f)
+                for_free = list(src)
+            srcs.append(src)
+            for j in for_free:
+                last_use[j] = m.i
+
+        # outputs of this part used by layers after end (the y list for init_y)
+        self.keep = sorted(set(resolve(m.i, f) for m in layers[end + 1:] for f in ([m.f] if isinstance(m.f, int) else m.f)
+                               if start <= resolve(m.i, f) <= end))
+        # outputs of earlier layers read from init_y
+        self.external = sorted(set(j for j in last_use if j < start - 1))
+        # y of output_y, the last output is x itself
+        self.skip = [j for j in self.keep if j != end]
+
+        free = [[] for _ in srcs]
+        for j, i in last_use.items():
+            if j not in self.keep and j != self.input_slot:
+                free[i - start].append(j)
+        for i in range(start, end):
+            if i not in last_use and i not in self.keep:
+                free[i - start].append(i)  # not read by any layer
+        self.steps = [(src, not isinstance(src, int), tuple(f)) for src, f in zip(srcs, free)]
+        self.compiled = None
+
+    def run(self, submodel, x, init_y=None, output_y=False):
+        if self.compiled is not None:
+            return self.compiled(list(submodel), x, init_y, output_y)
+        return self.run_layers(list(submodel), x, init_y, output_y)
+
+    def run_layers(self, layers, x, init_y=None, output_y=False):
+        buf = [None] * (self.end + 2)
+        buf[self.input_slot] = x
+        for j in self.external:
+            buf[j] = init_y[j]
+        i = self.start
+        for m, (src, from_list, free) in zip(layers, self.steps):
+            x = m([buf[j] for j in src] if from_list else buf[src])
+            buf[i] = x
+            for j in free:
+                buf[j] = None
+            i += 1
+        if output_y:
+            return x, {j: buf[j] for j in self.skip}
+        return x
+
+    def compile(self, **kwargs):
+        # straight-line layer calls once unrolled, torch.compile gets the whole part as one graph
+        self.compiled = torch.compile(self.run_layers, **kwargs)
+        return self
+
+
 class Model_with_diffusion(Model):
     def __init__(self, cfg='yolor-csp-c.yaml', ch=3, nc=None, anchors=None):  # model, input channels, number of classes
         super(Model, self).__init__()
@@ -814,10 +885,21 @@ class Model_with_diffusion(Model):
         initialize_weights(self)
         self.info()
         logger.info('')
-    def create_subnetwork(self):
-        
-        self.before_diffusion_model = self.subnetwork(self.model,0,14)
-        self.after_diffusion_model = self.subnetwork(self.model,15,77)
+    def create_subnetwork(self, split=14):
+        '''
+        Input:
+            split: last layer of before_diffusion_model, layer index in the yaml or stage
+                name 'P3' / 'P3/8' (last backbone layer with stride 8, = 14 for yolov7-tiny)
+        after create_subnetwork:
+            self.skip_index: outputs of before_diffusion_model read by after_diffusion_model,
+                forward_submodel(..., output_y=True) returns them as {index: tensor}
+            self.latent_channels, self.latent_stride, self.latent_shape(img_size)
+        '''
+        strides, channels = self.layer_strides()
+        split = self.split_index(split, strides)
+        self.split = split
+        self.before_diffusion_model = self.subnetwork(self.model,0,split)
+        self.after_diffusion_model = self.subnetwork(self.model,split+1,len(self.model)-1)
         
         for param in self.before_diffusion_model.parameters():
             param.requires_grad=False
@@ -825,6 +907,63 @@ class Model_with_diffusion(Model):
             param.requires_grad=False
         for param in self.model.parameters():
             param.requires_grad=False
+        self.create_submodel_plan()
+        self.skip_index = self.before_diffusion_model.plan.skip
+        self.latent_channels = channels[split]
+        self.latent_stride = strides[split]
+        logger.info('diffusion split after layer %d (%s), latent %d channels stride %d, skips %s' % (
+            split, self.model[split].type, self.latent_channels, self.latent_stride, str(self.skip_index)))
+
+    def create_submodel_plan(self):
+        self.before_diffusion_model.plan = SubmodelPlan(self.model,0,self.split)
+        self.after_diffusion_model.plan = SubmodelPlan(self.model,self.split+1,len(self.model)-1)
+
+    def latent_shape(self, img_size):
+        return (self.latent_channels, img_size // self.latent_stride, img_size // self.latent_stride)
+
+    def split_index(self, split, strides):
+        n_backbone = len(self.yaml['backbone'])
+        if isinstance(split, str):
+            level = int(split.split('/')[0].strip('Pp'))
+            index = [i for i in range(n_backbone) if strides[i] == 2 ** level]
+            assert len(index) > 0, 'no backbone layer with stride %d for split %s' % (2 ** level, split)
+            return index[-1]
+        split = split if split >= 0 else len(self.model) + split
+        assert 0 <= split < len(self.model) - 1, 'split %d out of range' % split
+        assert strides[split] is not None, 'split %d is not a feature map' % split
+        return split
+
+    def layer_strides(self, s=256):
+        # output stride / channels of every layer from one dummy forward, None for Detect
+        p = next(self.parameters())
+        training = self.training
+        self.eval()
+        y, strides, channels = [], [], []
+        x = torch.zeros(1, self.yaml['ch'], s, s, device=p.device, dtype=p.dtype)
+        with torch.no_grad():
+            for m in self.model:
+                if m.f != -1:  # if not from previous layer
+                    x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
+                x = m(x)
+                y.append(x)
+                is_map = isinstance(x, torch.Tensor) and x.dim() == 4
+                strides.append(s // x.shape[-2] if is_map else None)
+                channels.append(x.shape[1] if is_map else None)
+        self.train(training)
+        return strides, channels
+
+    def compile_submodel(self, **kwargs):
+        '''
+        torch.compile the before / after plans (torch >= 2.0), forward_submodel then
+        costs about the same as forward_once. jit.script does not fit, Concat / Detect
+        take a list and the other layers a tensor.
+        '''
+        if not hasattr(torch, 'compile'):
+            print('torch %s has no torch.compile, use the plain plan'%torch.__version__)
+            return self
+        self.before_diffusion_model.plan.compile(**kwargs)
+        self.after_diffusion_model.plan.compile(**kwargs)
+        return self
             
     def subnetwork(self, model, start_layer_idx, end_layer_idx):
         subnetwork = nn.Sequential()
@@ -853,8 +992,18 @@ class Model_with_diffusion(Model):
             return self.forward_once(x, profile)  # single-scale inference, train
     
     def forward_submodel(self, x, submodel, init_y=None, output_y=False, profile=False):
+        # output_y: (x, {layer index: saved output}) on both paths, init_y takes that dict or the old y list
+        plan = getattr(submodel, 'plan', None)
+        if plan is not None and not profile and not getattr(self, 'traced', False) and (init_y is not None or plan.start == 0):
+            return plan.run(submodel, x, init_y, output_y)
+        return self.forward_submodel_layers(x, submodel, init_y, output_y, profile)
+
+    def forward_submodel_layers(self, x, submodel, init_y=None, output_y=False, profile=False):
+        # layer by layer, keeps every saved output, for profile / traced
         y, dt = [], []  # outputs
 
+        if isinstance(init_y, dict):
+            init_y = [init_y.get(j) for j in range(submodel[0].i)]
         if init_y is not None:
             for _, before_y in enumerate(init_y):
                 y.append(before_y)
@@ -891,7 +1040,8 @@ class Model_with_diffusion(Model):
         if profile:
             print('%.1fms total' % sum(dt))
         if output_y:
-            return x,y
+            # same type as SubmodelPlan.run, the saved outputs before the last one (x)
+            return x,{j: before_y for j, before_y in enumerate(y[:-1]) if before_y is not None}
         else:
             return x
     '''    
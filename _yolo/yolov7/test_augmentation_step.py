@@ -9,6 +9,7 @@ import math
 from tqdm import tqdm
 
 from utils.general import non_max_suppression
+from utils.plate_metrics import plate_counts
 from augmentations import mix_augmentaion
 from matplotlib import pyplot as plt
 import sys
@@ -464,24 +465,8 @@ def get_wer(r, h):
     return result, sid, total
 
 def eval_dataset(results,label_data):
-    correct_plate = {}
-    total_p, correct_p, pred_p = 0, 0, 0
-    for k, v in label_data.items():
-        gt = transfer_label(v)
-        total_p += len(gt)
-        if k in results:
-            r = group_plate(results[k]) # r = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...]}, ...]
-            pred_p += len(r)
-            correct_r = []
-            for _r in r:
-                for idx, bbox in enumerate(gt):
-                    if get_iou(bbox, _r['plate']) >= 0.5:
-                        n_r = {'plate': _r['plate'], 'char': _r['char'], 'idx': idx}
-                        correct_r.append(n_r)
-            num = len(correct_r)
-            if num > 0:
-                correct_plate[k] = correct_r
-                correct_p += num
+    counts = plate_counts(results, label_data) # vectorized, utils/plate_metrics.py
+    total_p, correct_p, pred_p = counts['total_p'], counts['correct_p'], counts['pred_p']
                 
     print("Number of Correctly Detected Plates =", correct_p)
     print("Number of Detected Plates =", pred_p)
@@ -489,21 +474,9 @@ def eval_dataset(results,label_data):
     print("Recall = {:.4f}".format(correct_p/total_p))
     print("Precision = {:.4f}".format(correct_p/pred_p))
 
-    n_perfect = 0  ### number of perfectly recognized plates
-    n_sid = 0  ### number of failed recognized chars in detected
-    n_detected = 0  ### number of chars in detected plates
-
-    for k, v in label_data.items():
-        gt_strs = [s.split(',')[-1] for s in v]
-        if k in correct_plate:
-            objs = correct_plate[k]
-            for obj in objs: # obj = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...], 'idx': int(i)}]
-                pred_str = [classes[x[-1]] for x in obj['char']]
-                wer, sid, t = get_wer(list(gt_strs[obj['idx']]), pred_str)
-                n_sid += sid
-                n_detected += t
-                if wer == 0:
-                    n_perfect += 1
+    n_perfect = counts['n_perfect']  ### number of perfectly recognized plates
+    n_sid = counts['n_sid']  ### number of failed recognized chars in detected
+    n_detected = counts['n_detected']  ### number of chars in detected plates
 
 
     print("Characters in Detected Plates = ", n_detected)
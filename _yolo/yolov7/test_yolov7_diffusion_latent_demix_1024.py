@@ -7,8 +7,12 @@ import torch.nn as nn
 import yaml
 import math
 from tqdm import tqdm
+from functools import partial
 
-from utils.general import non_max_suppression
+from utils.general import non_max_suppression, non_max_suppression_batch
+from utils.plate_metrics import plate_counts
+from utils.eval_engine import EvalEngine
+from utils.tiled_restore import TiledRestorer, plate_boxes
 from augmentations import mix_augmentaion
 import sys
 sys.path.append('/data/frank/licence_plate/Cold-Diffusion-Models/licenceplate_deaug_yolov7_pytorch/')
@@ -21,6 +25,7 @@ input_size = 1024
 conf_thres = 0.5
 iou_thres = 0.5
 device = 'cuda:0'
+eval_batch_size = 8
 aug_licence = mix_augmentaion()
 
 with open(data) as f:
@@ -210,6 +215,13 @@ def run_withdiffusion_direct(img_path,times=99):
     Return: output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
     '''
     img, meta = preproccess_img(img_path)
+    return run_withdiffusion_direct_img(img,times), meta
+
+def run_withdiffusion_direct_img(img,times=99):
+    '''
+    img: [b, 3, input_size, input_size] on device
+    Return: output = b x [num_objs, 6(x1, y1, x2, y2, conf, cls)]
+    '''
     with torch.no_grad():
         ret_bf,y = model.module.forward_submodel(img,model.module.before_diffusion_model,output_y=True)
         batch_size = ret_bf.shape[0]
@@ -223,14 +235,43 @@ def run_withdiffusion_direct(img_path,times=99):
         #ret_diffusion = ret_bf
         y[-1]=ret_diffusion
         ret = model.module.forward_submodel(ret_diffusion,model.module.after_diffusion_model,init_y=y)
-        ret = non_max_suppression(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, labels=[], multi_label=True)
-    return ret, meta
+        ret = non_max_suppression_batch(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, multi_label=True)
+    return ret
+
+def run_withdiffusion_tiled_img(img,restorer,times=99,first_pass=False,margin=4):
+    '''
+    run_withdiffusion_direct_img with the denoise_fn on overlapping tiles of the latent (TiledRestorer),
+    first_pass: restore only the latent tiles around the plates found by yolo on img
+    img: [b, 3, input_size, input_size] on device
+    Return: output = b x [num_objs, 6(x1, y1, x2, y2, conf, cls)], fraction of tiles restored per image
+    '''
+    with torch.no_grad():
+        boxes = None
+        if first_pass:
+            ret = model(img)
+            ret = non_max_suppression_batch(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, multi_label=True)
+            boxes = plate_boxes(ret, 1.0 / model.module.latent_stride)
+        ret_bf,y = model.module.forward_submodel(img,model.module.before_diffusion_model,output_y=True)
+        batch_size = ret_bf.shape[0]
+        step = torch.full((batch_size,), times - 1, dtype=torch.long).cuda().to(device)
+        ret_diffusion = restorer(ret_bf,step,boxes,margin)
+        y[-1]=ret_diffusion
+        ret = model.module.forward_submodel(ret_diffusion,model.module.after_diffusion_model,init_y=y)
+        ret = non_max_suppression_batch(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, multi_label=True)
+    return ret, restorer.restored
 
 def run_withdiffusion_step(img_path,times=99):
     '''
     Return: output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
     '''
     img, meta = preproccess_img(img_path)
+    return run_withdiffusion_step_img(img,times), meta
+
+def run_withdiffusion_step_img(img,times=99):
+    '''
+    img: [b, 3, input_size, input_size] on device
+    Return: output = b x [num_objs, 6(x1, y1, x2, y2, conf, cls)]
+    '''
     with torch.no_grad():
         ret_bf,y = model.module.forward_submodel(img,model.module.before_diffusion_model,output_y=True)
         batch_size = ret_bf.shape[0]
@@ -245,8 +286,8 @@ def run_withdiffusion_step(img_path,times=99):
         #ret_diffusion = ret_bf
         y[-1]=all_images
         ret = model.module.forward_submodel(all_images,model.module.after_diffusion_model,init_y=y)
-        ret = non_max_suppression(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, labels=[], multi_label=True)
-    return ret, meta
+        ret = non_max_suppression_batch(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, multi_label=True)
+    return ret
 
 def run_withdiffusion_ema(img_path,times=99):
     '''
@@ -547,24 +588,8 @@ def get_wer(r, h):
     return result, sid, total
 
 def eval_dataset(results,label_data):
-    correct_plate = {}
-    total_p, correct_p, pred_p = 0, 0, 0
-    for k, v in label_data.items():
-        gt = transfer_label(v)
-        total_p += len(gt)
-        if k in results:
-            r = group_plate(results[k]) # r = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...]}, ...]
-            pred_p += len(r)
-            correct_r = []
-            for _r in r:
-                for idx, bbox in enumerate(gt):
-                    if get_iou(bbox, _r['plate']) >= 0.5:
-                        n_r = {'plate': _r['plate'], 'char': _r['char'], 'idx': idx}
-                        correct_r.append(n_r)
-            num = len(correct_r)
-            if num > 0:
-                correct_plate[k] = correct_r
-                correct_p += num
+    counts = plate_counts(results, label_data) # vectorized, utils/plate_metrics.py
+    total_p, correct_p, pred_p = counts['total_p'], counts['correct_p'], counts['pred_p']
                 
     print("Number of Correctly Detected Plates =", correct_p)
     print("Number of Detected Plates =", pred_p)
@@ -572,21 +597,9 @@ def eval_dataset(results,label_data):
     print("Recall = {:.4f}".format(correct_p/total_p))
     print("Precision = {:.4f}".format(correct_p/pred_p))
 
-    n_perfect = 0  ### number of perfectly recognized plates
-    n_sid = 0  ### number of failed recognized chars in detected
-    n_detected = 0  ### number of chars in detected plates
-
-    for k, v in label_data.items():
-        gt_strs = [s.split(',')[-1] for s in v]
-        if k in correct_plate:
-            objs = correct_plate[k]
-            for obj in objs: # obj = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...], 'idx': int(i)}]
-                pred_str = [classes[x[-1]] for x in obj['char']]
-                wer, sid, t = get_wer(list(gt_strs[obj['idx']]), pred_str)
-                n_sid += sid
-                n_detected += t
-                if wer == 0:
-                    n_perfect += 1
+    n_perfect = counts['n_perfect']  ### number of perfectly recognized plates
+    n_sid = counts['n_sid']  ### number of failed recognized chars in detected
+    n_detected = counts['n_detected']  ### number of chars in detected plates
 
 
     print("Characters in Detected Plates = ", n_detected)
@@ -625,28 +638,18 @@ model.module.create_subnetwork()
 #model.after_diffusion_model.half()
 
 
-results_diffusion = {}
-for f in tqdm(img_paths, ncols=80):
-    if f.endswith('.jpg'):
-        bname = os.path.splitext(f)[0]
-        img_p = img_dir + f
-        
-        ret, meta = run_withdiffusion_direct(img_p)
-        
-        if ret[0] is not None:
-            output = affine_transform(ret, meta) # output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
-            results_diffusion[bname] = output
-eval_dataset(results_diffusion,label_data)
-
-results_diffusion = {}
-for f in tqdm(img_paths, ncols=80):
-    if f.endswith('.jpg'):
-        bname = os.path.splitext(f)[0]
-        img_p = img_dir + f
-        
-        ret, meta = run_withdiffusion_step(img_p)
-        
-        if ret[0] is not None:
-            output = affine_transform(ret, meta) # output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
-            results_diffusion[bname] = output
-eval_dataset(results_diffusion,label_data)
\ No newline at end of file
+# direct, step and tiled on each batch, one pass over the folder
+engine = EvalEngine(img_dir, input_size, device, batch_size=eval_batch_size)
+# latent tiles of 32 (256 pixels at stride 8), whole latent and plate tiles of a first pass
+restorer = TiledRestorer(diffusion_trainer.model.module.denoise_fn, tile=32, overlap=8)
+results_all = engine.run({'direct': run_withdiffusion_direct_img, 'step': run_withdiffusion_step_img,
+                          'tiled': partial(run_withdiffusion_tiled_img, restorer=restorer),
+                          'tiled plates': partial(run_withdiffusion_tiled_img, restorer=restorer, first_pass=True)})
+eval_dataset(results_all['direct'],label_data)
+
+eval_dataset(results_all['step'],label_data)
+
+for name in ['tiled', 'tiled plates']:
+    print('--------------')
+    print('%s, latent tiles restored = %.2f, %.1f ms / image'%(name, np.mean(engine.extra[name]), engine.time[name] * 1000))
+    eval_dataset(results_all[name],label_data)
@@ -25,7 +25,7 @@ import test  # import test.py to get mAP after each epoch
 from models.experimental import attempt_load
 from models.yolo import Model
 from utils.autoanchor import check_anchors
-from utils.datasets import create_dataloader_generator, create_dataloader
+from utils.datasets import create_dataloader_generator, create_dataloader, create_dataloader_shards
 from utils.general import labels_to_class_weights, increment_path, labels_to_image_weights, init_seeds, \
     fitness, strip_optimizer, get_latest_run, check_dataset, check_file, check_git_status, check_img_size, \
     check_requirements, print_mutation, set_logging, one_cycle, colorstr
@@ -247,10 +247,18 @@ def train(hyp, opt, device, tb_writer=None):
     #                                        world_size=opt.world_size, workers=opt.workers,
     #                                        image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '), mode='train',bg_image_from='gen')
     
-    dataloader, dataset = create_dataloader_generator(train_path, imgsz, batch_size, gs, opt,
+    if opt.shards:  # pre-generated plates of _plate/synthesis/generate_plate.py --format shards
+        dataloader, dataset = create_dataloader_shards(opt.shards, imgsz, batch_size, gs, opt,
+                                            hyp=hyp, augment=True, rank=rank,
+                                            world_size=opt.world_size, workers=opt.workers,
+                                            quad=opt.quad, prefix=colorstr('train: '))
+    else:
+        dataloader, dataset = create_dataloader_generator(train_path, imgsz, batch_size, gs, opt,
                                             hyp=hyp, augment=True, cache=opt.cache_images, rect=opt.rect, rank=rank,
                                             world_size=opt.world_size, workers=opt.workers,
-                                            image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '), mode='train',plate_style=opt.plate_style)
+                                            image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '), mode='train',plate_style=opt.plate_style,
+                                            replay_pool=opt.replay_pool, replay_refresh=opt.replay_refresh,
+                                            glyph_atlas=False if opt.glyph_atlas == 'off' else opt.glyph_atlas, fast_generator=True)
     #dataloader, dataset = create_dataloader_generator(train_path, imgsz, batch_size, gs, opt,
     #                                        hyp=hyp, augment=True, cache=opt.cache_images, rect=opt.rect, rank=rank,
     #                                        world_size=opt.world_size, workers=opt.workers,
@@ -466,6 +474,12 @@ def train(hyp, opt, device, tb_writer=None):
                     tb_writer.add_scalar(tag, x, epoch)  # tensorboard
                 if wandb_logger.wandb:
                     wandb_logger.log({tag: x})  # W&B
+            if hasattr(dataset, 'replay_metrics'):  # --replay-pool, pool hit rate / generator samples/s of the epoch
+                for tag, x in dataset.replay_metrics().items():
+                    if tb_writer:
+                        tb_writer.add_scalar(tag, x, epoch)  # tensorboard
+                    if wandb_logger.wandb:
+                        wandb_logger.log({tag: x})  # W&B
 
             # Update best mAP
             fi = fitness(np.array(results).reshape(1, -1))  # weighted combination of [P, R, mAP@.5, mAP@.5-.95]
@@ -587,6 +601,10 @@ if __name__ == '__main__':
     parser.add_argument('--freeze', nargs='+', type=int, default=[0], help='Freeze layers: backbone of yolov7=50, first3=0 1 2')
     parser.add_argument('--v5-metric', action='store_true', help='assume maximum recall as 1.0 in AP calculation')
     parser.add_argument('--plate-style', type=str, default='random',  help='license plate style = random, real, realrandom')
+    parser.add_argument('--replay-pool', type=int, default=0, help='generated samples kept per dataloader worker and replayed, 0 = generate every sample')
+    parser.add_argument('--replay-refresh', type=float, default=0.25, help='fraction of the replay pool generated again per epoch')
+    parser.add_argument('--glyph-atlas', type=str, default=None, help='plate_generator glyph atlas .npz, read or written when missing, off = no atlas, None = built in memory')
+    parser.add_argument('--shards', type=str, nargs='*', default=None, help='generate_plate.py shard folders, train on them instead of plate_generator')
     opt = parser.parse_args()
 
     # Set DDP variables
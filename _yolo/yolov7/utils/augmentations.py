@@ -12,6 +12,85 @@ from scipy.ndimage import gaussian_filter
 from skimage.color import rgb2hsv, hsv2rgb
 
 
+class DegradationPlan(object):
+    """
+    Step independent part of one mix_augmentaion.random_parameter() draw for (h, w) images.
+    Built once, then every step is only a mask compare, a blend, a LUT and a resize. Only worth it when
+    the draw degrades several images / steps (q_sample, random=False), mix_aug(random=True) skips it.
+    Args:
+        aug: mix_augmentaion holding the drawn parameters
+        h, w: image size
+    apply(img, step) returns the same image as the step by step mix_aug.
+    """
+    def __init__(self, aug, h, w):
+        self.shape = (h, w)
+        self.flags_rain = aug.flags_rain
+        self.flags_spot_light = aug.flags_spot_light
+        self.flags_gamma = aug.flags_gamma
+        self.flags_pixelate = aug.flags_pixelate
+        self.deresolution = aug.deresolution
+
+        if self.flags_rain:
+            if not (h, w) == tuple(aug.imshape):
+                aug.rain_drops, aug.rain_width = aug.generate_random_lines(aug.imshape, aug.rain_slant)
+                print('self.imshape = %s, imshape = %s.'%(str(aug.imshape),str((h, w))))
+            self.len_rain = len(aug.rain_drops)
+            # index of the first drop covering each pixel, draw backward so the smallest index stays
+            self.rain_index = np.full((h, w), self.len_rain, dtype=np.float32)
+            for idx in range(self.len_rain - 1, -1, -1):
+                rain_drop = aug.rain_drops[idx]
+                cv2.line(self.rain_index, (rain_drop[0], rain_drop[1]), (rain_drop[2], rain_drop[3]), float(idx), aug.rain_width[idx])
+
+        if self.flags_spot_light:
+            self.spotlight_transparency = aug.spotlight_transparency
+            pos = [(aug.spotlignt_position[0][0]*w,aug.spotlignt_position[0][1]*h)]
+            self.spot_light_mask = aug.generate_spot_light_mask(mask_size=(w, h), position=pos, reverse=aug.spotlight_reverse)
+
+        if self.flags_gamma:
+            self.gamma = aug.gamma
+            self.gamma_tables = {}  # built on first use of a step
+
+        if self.flags_pixelate:
+            self.pixelate_blocks = aug.pixelate_blocks
+
+    def gamma_table(self, gamma, max_tables=256):
+        # same table as mix_augmentaion.adjust_gamma, kept per gamma rounded to 1e-9 (one per step value),
+        # at most max_tables of them, continuous steps past that are built and not kept
+        key = round(gamma, 9)
+        if key in self.gamma_tables:
+            return self.gamma_tables[key]
+        table = (((np.arange(0, 256) / 255.0) ** (1.0 / gamma)) * 255).astype("uint8")
+        if len(self.gamma_tables) < max_tables:
+            self.gamma_tables[key] = table
+        return table
+
+    def add_rain(self, img, step, drop_color=(200,200,200)):
+        img = img.copy()
+        img[self.rain_index < int(step*self.len_rain)] = drop_color
+        return img
+
+    def add_spot_light(self, img, step):
+        transparency = 1-(1-self.spotlight_transparency)*step
+        hsv = cv2.cvtColor(np.asarray(img, dtype=np.float32), cv2.COLOR_BGR2HSV)
+        hsv[:, :, 2] = hsv[:, :, 2] * transparency + self.spot_light_mask * (1 - transparency)
+        frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+        frame[frame > 255] = 255
+        frame[frame < 0] = 0
+        return np.asarray(frame, dtype=np.uint8)
+
+    def apply(self, img, step):
+        # img = uint8 [h, w, 3], step = 0~1 (after noiseStepMode mapping)
+        if self.flags_rain:
+            img = self.add_rain(img, step)
+        if self.flags_spot_light:
+            img = self.add_spot_light(img, step)
+        if self.flags_gamma:
+            img = cv2.LUT(img, self.gamma_table(1-(1-self.gamma)*step))
+        if self.flags_pixelate:
+            img = self.deresolution(img, blocks=self.pixelate_blocks, step_ratio=step)
+        return img
+
+
 class mix_augmentaion(object):
     def __init__(self,imshape=(256,256),noiseStepMode='direct'):
         self.imshape=imshape
@@ -71,6 +150,9 @@ class mix_augmentaion(object):
                 #print(int(self.imshape[0]*0.3))
                 pixelate_blocks = np.random.randint(int(self.imshape[0]*0.2),int(self.imshape[0]*0.3))#0.2 : 0.3 hw
             self.pixelate_blocks = pixelate_blocks
+
+        # new parameters, rebuild the DegradationPlan on next mix_aug
+        self.degradation_plan = None
     
 
         
@@ -390,57 +472,35 @@ class mix_augmentaion(object):
         #print(np.min(img))
         img = img.astype(np.uint8)
         height, width, _ = img.shape
-        #self.pixelate_blocks=60
-        #print("Total time taken init_time = {} seconds".format( time.time() - init_time))  # print total computation time
+        if random:
+            # one image of this draw, a DegradationPlan would not be reused
+            return self.mix_aug_once(img, step)
 
-        
-        
-        # add_rain
-        #add_rain_time = time.time()
-        
-        
-        if self.flags_rain:
-            img = self.add_rain_step(img, step_ratio=step, slant = self.rain_slant)
-            #print("Total time taken add_rain_time = {} seconds".format( time.time() - add_rain_time))  # print total computation time
-            # random shift in hsv
-            #shift_hsv_time = time.time()
-            #img = self.convert_to_hsv_and_modify(img)
-            #print("Total time taken shift_hsv_time = {} seconds".format( time.time() - shift_hsv_time))  # print total computation time
+        # rain layer, spot light mask and gamma LUTs only depend on the parameter draw
+        plan = self.get_degradation_plan(height, width)
+        return plan.apply(img, step)
 
-        
-        
-        # add_spot_light
-        #add_spot_light_time = time.time()
-        
+    def mix_aug_once(self, img, step):
+        # step by step degradation without a DegradationPlan, only the rain drops of the step are drawn
+        height, width, _ = img.shape
+        if self.flags_rain:
+            if not (height, width) == tuple(self.imshape):
+                self.rain_drops, self.rain_width = self.generate_random_lines(self.imshape, self.rain_slant)
+            n = int(step*len(self.rain_drops))
+            img = self.rain_process(img, self.rain_drops[:n], (200,200,200), self.rain_width[:n])
         if self.flags_spot_light:
             pos = [(self.spotlignt_position[0][0]*width,self.spotlignt_position[0][1]*height)]
             img = self.add_spot_light_step(img,step_ratio=step,light_position=pos,transparency=self.spotlight_transparency,reverse=self.spotlight_reverse)
-            #print("Total time taken add_spot_light_time = {} seconds".format( time.time() - add_spot_light_time))  # print total computation time
-
-
-            #print(1-(1-self.gamma)*step)
-            #print('dsadsada')
-        
         if self.flags_gamma:
-            # adj gamma
-            #gamma_time = time.time()
-
             img = self.adjust_gamma(img,gamma=1-(1-self.gamma)*step)
-            #img = self.pixelate(img,blocks=self.pixelate_blocks,step_ratio=step)
-            #print("Total time taken gamma_time = {} seconds".format( time.time() - gamma_time))  # print total computation time
-
-        
-        
         if self.flags_pixelate:
-            # deresolution
-            #de_resolution_time = time.time()
             img = self.deresolution(img, blocks=self.pixelate_blocks, step_ratio=step)
-
-            #print("Total time taken mix_aug = {} seconds".format( time.time() - start_time))  # print total computation time
-
-            #img = self.pixelate_cv2(img,blocks=self.pixelate_blocks,step_ratio=step)
-
         return img
+
+    def get_degradation_plan(self, h, w):
+        if self.degradation_plan is None or not self.degradation_plan.shape == (h, w):
+            self.degradation_plan = DegradationPlan(self, h, w)
+        return self.degradation_plan
     
     def torchcuda2npy(self, x):    
         return (x.detach().cpu().numpy().transpose([1,2,0])+1)*0.5
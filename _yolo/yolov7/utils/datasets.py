@@ -34,6 +34,7 @@ from utils.torch_utils import torch_distributed_zero_first
 
 from utils.generator import plate_generator
 from utils.augmentations import mix_augmentaion
+from utils.plate_shards import read_shard_index, stream_samples
 
 import warnings
 
@@ -728,10 +729,13 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
     
     
 def create_dataloader_generator(path, imgsz, batch_size, stride, opt, hyp=None, augment=False, cache=False, pad=0.0, rect=False,
-                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix='', mode='train', bg_image_from='input',plate_style='random'):
+                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix='', mode='train', bg_image_from='input',plate_style='random', glyph_atlas=None,
+                      replay_pool=0, replay_refresh=0.25, fast_generator=False):
+    # replay_pool > 0: LoadImagesAndLabels_replay, pool of replay_pool generated samples per dataloader worker
+    replay = dict(replay_pool=replay_pool, replay_refresh=replay_refresh, world_size=world_size) if replay_pool > 0 else {}
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
     with torch_distributed_zero_first(rank):
-        dataset = LoadImagesAndLabels_generate(path, imgsz, batch_size,
+        dataset = (LoadImagesAndLabels_replay if replay else LoadImagesAndLabels_generate)(path, imgsz, batch_size,
                                       augment=augment,  # augment images
                                       hyp=hyp,  # augmentation hyperparameters
                                       rect=rect,  # rectangular training
@@ -742,7 +746,7 @@ def create_dataloader_generator(path, imgsz, batch_size, stride, opt, hyp=None,
                                       image_weights=image_weights,
                                       prefix=prefix,
                                       mode=mode, bg_image_from=bg_image_from,
-                                      plate_style=plate_style)
+                                      plate_style=plate_style, glyph_atlas=glyph_atlas, fast_generator=fast_generator, **replay)
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
@@ -762,7 +766,8 @@ def create_dataloader_generator(path, imgsz, batch_size, stride, opt, hyp=None,
     
 class LoadImagesAndLabels_generate(Dataset):  # for training
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', mode='train', bg_image_from='input',plate_style='random'):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', mode='train', bg_image_from='input',plate_style='random', glyph_atlas=None,
+                 fast_generator=False):
         self.img_size = img_size
         self.image_files = list(glob.glob(os.path.join(path, '*.[pj][np][g]')))
 
@@ -787,7 +792,9 @@ class LoadImagesAndLabels_generate(Dataset):  # for training
         self.aug_licence.imshape=(img_size,img_size)
         self.aug_licence.random_parameter()
 
-        self.image_generator = plate_generator(augmentor=self.aug_licence)
+        self.image_generator = plate_generator(augmentor=self.aug_licence, atlas_path=glyph_atlas)  # glyph_atlas: .npz of plate_generator.get_glyph_atlas, False = no atlas
+        self.image_generator.fast_composite = fast_generator  # ROI compositor and background / texture pools of plate_generator
+        self.image_generator.fast_background = fast_generator
         self.indices = range(self.__len__())
         self.segments = [ [] for _ in range(self.__len__()) ]
         self.bg_image_from = bg_image_from
@@ -1194,10 +1201,151 @@ class LoadImagesAndLabels_generate(Dataset):  # for training
         return sample_labels, sample_images, sample_masks
 
 
+class LoadImagesAndLabels_replay(LoadImagesAndLabels_generate):  # for training
+    # LoadImagesAndLabels_generate with a pool of generated samples in every dataloader worker, replay_refresh of the
+    # pool is generated again per epoch, the other draws are pool samples under new mosaic / perspective / hsv
+    # augmentation. The pool lives as long as the worker, InfiniteDataLoader (not image_weights) keeps it over epochs.
+    def __init__(self, *args, replay_pool=128, replay_refresh=0.25, world_size=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replay_pool = replay_pool
+        self.replay_refresh = replay_refresh
+        self.world_size = world_size  # DistributedSampler, each rank draws len / world_size per epoch
+        self.pool = []
+        self.getitem_count = 0
+        self.refresh_count = 0
+        self.filled_at = None  # getitem_count when the pool was full
+        # [pool hits, generated, generate seconds, pool size] per worker, shared memory read by replay_metrics
+        self.replay_stats = torch.zeros((64, 4), dtype=torch.float64).share_memory_()
+
+    def __getitem__(self, index):
+        self.getitem_count += 1
+        return super().__getitem__(index)
+
+    def need_generate(self, num_workers):
+        if len(self.pool) < self.replay_pool:
+            return True
+        if self.filled_at is None:
+            self.filled_at = self.getitem_count
+        # replay_refresh * replay_pool samples generated per epoch of this worker, spread over the epoch
+        epoch_len = max(self.__len__() // (self.world_size * num_workers), 1)
+        return self.refresh_count < self.replay_refresh * self.replay_pool * (self.getitem_count - self.filled_at) / epoch_len
+
+    def generate_image(self, index, train=False):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        stats = self.replay_stats[worker_id % len(self.replay_stats)]
+        if self.need_generate(num_workers):
+            start_time = time.time()
+            img, _, _, labels, img_key = super().generate_image(index, train=True)
+            stats[1] += 1
+            stats[2] += time.time() - start_time
+            if len(self.pool) < self.replay_pool:
+                self.pool.append((img, labels, img_key))
+            else:
+                self.pool[random.randrange(self.replay_pool)] = (img, labels, img_key)
+                self.refresh_count += 1
+        else:
+            img, labels, img_key = self.pool[random.randrange(len(self.pool))]
+            stats[0] += 1
+        stats[3] = len(self.pool)
+
+        img = img.copy()  # augment_hsv and the label conversion work in place
+        h,w = img.shape[0:2]
+        if train:
+            return img, (h,w), (h,w), labels.copy(), img_key
+        else:
+            return img, (h,w), (h,w)
+
+    def replay_metrics(self, reset=True):
+        '''
+        Return: {'replay/hit_rate': pool draws / all draws, 'replay/generator_fps': generated samples per second of
+                 generator time (one worker), 'replay/generated': generated samples, 'replay/pool': pooled samples of all
+                 workers}, since the last reset
+        '''
+        hits, generated, seconds, pool = self.replay_stats.sum(0).tolist()
+        if reset:
+            self.replay_stats[:, 0:3] = 0
+        return {'replay/hit_rate': hits / max(hits + generated, 1),
+                'replay/generator_fps': generated / max(seconds, 1e-9),
+                'replay/generated': generated,
+                'replay/pool': pool}
+
+
+def create_dataloader_shards(path, imgsz, batch_size, stride, opt, hyp=None, augment=False, pad=0.0,
+                      rank=-1, world_size=1, workers=8, quad=False, prefix='', shuffle_buffer=256, seed=0):
+    # generate_plate.py --format shards dataset, every dataloader worker of every rank streams its own shards
+    dataset = LoadImagesAndLabels_shards(path, imgsz, batch_size,
+                                      augment=augment,  # augment images
+                                      hyp=hyp,  # augmentation hyperparameters
+                                      stride=int(stride),
+                                      pad=pad,
+                                      prefix=prefix,
+                                      rank=rank, world_size=world_size,
+                                      shuffle_buffer=shuffle_buffer, seed=seed)
+
+    batch_size = min(batch_size, len(dataset))
+    nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
+    # no sampler, the index only counts samples, the shards are split in the dataset
+    dataloader = InfiniteDataLoader(dataset,
+                        batch_size=batch_size,
+                        num_workers=nw,
+                        pin_memory=True,
+                        collate_fn=LoadImagesAndLabels_shards.collate_fn4 if quad else
+                                    LoadImagesAndLabels_shards.collate_fn)
+    return dataloader, dataset
+
+
+class LoadImagesAndLabels_shards(LoadImagesAndLabels_generate):  # for training
+    # samples of generate_plate.py shards instead of plate_generator, mosaic / augmentation of LoadImagesAndLabels_generate
+    def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, stride=32, pad=0.0, prefix='',
+                 rank=-1, world_size=1, shuffle_buffer=256, seed=0):
+        self.img_size = img_size
+        self.shards = read_shard_index(path)
+        self.total = sum(s['count'] for s in self.shards)
+        self.rank = max(rank, 0)
+        self.world_size = world_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.stream = None  # opened in the dataloader worker
+
+        self.augment = augment
+        self.hyp = hyp
+        self.image_weights = False
+        self.rect = False
+        self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.stride = stride
+        self.path = path
+
+        n = self.__len__()
+        self.batch = np.floor(np.arange(n) / batch_size).astype(int)  # batch index of image
+        self.n = n
+        self.indices = range(n)
+        self.segments = [ [] for _ in range(n) ]
+        print('%s%d samples in %d shards, %d per rank' % (prefix, self.total, len(self.shards), n))
+
+    def __len__(self):
+        return self.total // self.world_size
+
+    def next_sample(self):
+        if self.stream is None:
+            worker_info = torch.utils.data.get_worker_info()
+            worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+            self.stream = stream_samples(self.shards, part=self.rank * num_workers + worker_id,
+                                         n_parts=self.world_size * num_workers,
+                                         shuffle_buffer=self.shuffle_buffer, seed=self.seed)
+        return next(self.stream)
+
+    def generate_image(self, index, train=False):
+        # next sample of the stream, index is not used
+        sample = self.next_sample()
+        img = sample['img']
+        h, w = img.shape[0:2]
+        if train:
+            return img, (h,w), (h,w), sample['labels'].copy(), sample['key']
+        else:
+            return img, (h,w), (h,w)
 
-    
-    
-    
 
 # Ancillary functions --------------------------------------------------------------------------------------------------
 def load_image(self, index):
@@ -0,0 +1,181 @@
+import os
+import time
+import cv2
+import numpy as np
+import torch
+import torch.utils.data
+from tqdm import tqdm
+
+
+def letterbox_plate(img, size):
+    '''
+    resize of the plate scripts, long side to size and zero padding to size x size.
+    Return: img (float64 HWC BGR), meta = {'nw', 'nh', 'dw', 'dh', 'w', 'h'} or {} when already size x size
+    '''
+    h, w, c = img.shape
+    if not (h == size and w == size):
+        img = img.copy()
+        scale_x = float(size / w)
+        scale_y = float(size / h)
+        ratio = min(scale_x, scale_y)
+        nw, nh = int(w*ratio), int(h*ratio)
+        new_img = cv2.resize(img, (nw, nh))
+
+        blank = np.zeros((size, size, c))
+        dw, dh = (size-nw)//2, (size-nh)//2
+        blank[dh: dh+nh, dw: dw+nw] = new_img
+        meta = {'nw': nw, 'nh': nh, 'dw': dw, 'dh': dh, 'w': w, 'h': h}
+        return blank, meta
+    else:
+        meta = {}
+        return img, meta
+
+
+META_KEYS = ['nw', 'nh', 'dw', 'dh', 'w', 'h']
+
+
+def stack_meta(meta, batch_size, device=None):
+    '''
+    Input:
+        meta: meta of a batch, collated by the dataloader {'nw': [b], 'nh': [b], ...}
+              or a list of per image meta ({} when the image was not resized)
+    Return:
+        float64 [b, 6(nw, nh, dw, dh, w, h)], (1, 1, 0, 0, 1, 1) for {}
+    '''
+    if isinstance(meta, dict):
+        if len(meta) == 0:
+            meta = [{}] * batch_size
+        else:
+            return torch.stack([torch.as_tensor(meta[k], dtype=torch.float64) for k in META_KEYS], 1).to(device)
+    rows = [[m[k] for k in META_KEYS] if len(m) > 0 else [1, 1, 0, 0, 1, 1] for m in meta]
+    return torch.tensor(rows, dtype=torch.float64, device=device).reshape(-1, 6)
+
+
+def affine_transform_batch(dets, meta):
+    '''
+    affine_transform of a whole batch, all boxes are mapped in one op on their device and
+    copied to the host once.
+    Input:
+        dets = non_max_suppression output, [batch](None or [num_objs, 6(x1, y1, x2, y2, conf, cls)])
+        meta = stacked meta of the batch, see stack_meta
+    Return:
+        [batch](None or numpy [num_objs, 6]), same as affine_transform(dets[i], meta[i])
+    '''
+    keep = [i for i, d in enumerate(dets) if d is not None]
+    output = [None] * len(dets)
+    if len(keep) == 0:
+        return output
+    x = torch.cat([dets[i] for i in keep], 0)
+    meta = stack_meta(meta, len(dets), x.device)
+    count = torch.tensor([dets[i].shape[0] for i in keep], device=x.device)
+    m = meta[torch.repeat_interleave(torch.tensor(keep, device=x.device), count)]
+    # M of cv2.getAffineTransform is diag(w / nw, h / nh), the offset is removed first
+    box = x[:, :4] - m[:, [2, 3, 2, 3]].to(x.dtype)
+    box = box.double() * (m[:, [4, 5, 4, 5]] / m[:, [0, 1, 0, 1]])
+    x = torch.cat([box.to(x.dtype), x[:, 4:]], 1).cpu().numpy()
+    for i, d in zip(keep, np.split(x, np.cumsum(count.tolist())[:-1])):
+        output[i] = d
+    return output
+
+
+class LetterboxImages(torch.utils.data.Dataset):
+    # cv2.imread + letterbox + to RGB CHW float of preproccess_img, run in dataloader workers
+    def __init__(self, img_paths, input_size):
+        self.img_paths = img_paths
+        self.input_size = input_size
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, index):
+        img_path = self.img_paths[index]
+        img = cv2.imread(img_path)
+        img, meta = letterbox_plate(img, self.input_size)
+        img = (img / 255.).astype(np.float32)
+        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x512x512
+        img = np.ascontiguousarray(img)
+        bname = os.path.splitext(os.path.split(img_path)[-1])[0]
+        return torch.from_numpy(img), meta, bname
+
+    @staticmethod
+    def collate_fn(batch):
+        img, meta, bname = zip(*batch)
+        return torch.stack(img, 0), list(meta), list(bname)
+
+
+class EvalEngine(object):
+    '''
+    Batched evaluation of the plate scripts: images are decoded and letterboxed in a
+    worker pool, the next batch is copied to the device while the current one runs,
+    and every config runs on a batch while it is on the device, so a sweep over
+    step values reads the folder once.
+    Input:
+        img_dir: folder of images (or a list of image paths)
+        input_size: letterbox size, same as input_size of preproccess_img
+    Usage:
+        engine = EvalEngine(img_dir, input_size, device)
+        results = engine.run({'t=50': partial(run_withdiffusion_img, times=50), ...}, affine_transform)
+        eval_dataset(results['t=50'], label_data)
+    '''
+    def __init__(self, img_dir, input_size, device, batch_size=8, num_workers=8, exts=('.jpg',)):
+        if isinstance(img_dir, (list, tuple)):
+            img_paths = list(img_dir)
+        else:
+            img_paths = [os.path.join(img_dir, f) for f in sorted(os.listdir(img_dir)) if f.endswith(exts)]
+        self.device = torch.device(device)
+        self.dataset = LetterboxImages(img_paths, input_size)
+        self.loader = torch.utils.data.DataLoader(self.dataset, batch_size=batch_size, shuffle=False,
+                                                  num_workers=num_workers, pin_memory=self.device.type == 'cuda',
+                                                  collate_fn=LetterboxImages.collate_fn)
+        self.time = {}
+        self.extra = {}
+
+    def prefetch(self):
+        # copy of batch i+1 is queued before batch i is returned, it overlaps the model
+        next_batch = None
+        for img, meta, bname in self.loader:
+            batch = (img.to(self.device, non_blocking=True), meta, bname)
+            if next_batch is not None:
+                yield next_batch
+            next_batch = batch
+        if next_batch is not None:
+            yield next_batch
+
+    def sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def run(self, configs, affine_transform=None):
+        '''
+        Input:
+            configs: {name: func(img [b, 3, s, s] on device)}, func returns the non_max_suppression
+                output (one [num_objs, 6] per image), or (output, per image extra) e.g. denoise_fn calls
+            affine_transform: per image back projection of a script, affine_transform([det], meta),
+                affine_transform_batch on the device when None
+        Return:
+            {name: {bname: output}} for eval_dataset, self.time[name] = seconds per image,
+            self.extra[name] = list of per image extra
+        '''
+        results = {name: {} for name in configs}
+        run_time = {name: 0. for name in configs}
+        self.extra = {name: [] for name in configs}
+        with torch.no_grad():
+            for img, meta, bname in tqdm(self.prefetch(), total=len(self.loader), ncols=80):
+                for name, func in configs.items():
+                    self.sync()
+                    start_time = time.time()
+                    ret = func(img)
+                    self.sync()
+                    run_time[name] += time.time() - start_time
+                    if isinstance(ret, tuple):
+                        ret, extra = ret
+                        self.extra[name] += list(extra)
+                    if affine_transform is None:
+                        ret = affine_transform_batch(ret, meta)
+                    else:
+                        ret = [affine_transform([det], meta[i]) if det is not None else None for i, det in enumerate(ret)]
+                    for i, det in enumerate(ret):
+                        if det is not None:
+                            results[name][bname[i]] = det # output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
+        self.time = {name: run_time[name] / max(len(self.dataset), 1) for name in configs}
+        return results
@@ -702,6 +702,96 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def non_max_suppression_batch(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
+                              max_det=300, group_plate=False, plate_class=34):
+    """Runs Non-Maximum Suppression (NMS) on a whole batch with one nms call
+
+    Same candidates, conf and class offsets as non_max_suppression, images are kept apart by a
+    coordinate offset instead of a python loop over the batch, and there is no time_limit.
+    Detections of an image are sorted by conf with ties in candidate order, so max_det keeps
+    the same boxes on every run and device.
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+         with group_plate also a list of (m, 2) long tensors per image, [plate row, char row] for
+         every char inside a plate_class detection, the rules of group_plate / check_bbox in the
+         eval scripts: int pixel boxes, the larger box of the pair must cover the smaller one, a
+         char can be in several plates. Sorted by char row, then plate row.
+    """
+
+    bs = prediction.shape[0]
+    nc = prediction.shape[2] - 5  # number of classes
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes per image into torchvision.ops.nms()
+    multi_label &= nc > 1  # multiple labels per box
+
+    bi, ai = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # candidates of all images
+    x = prediction[bi, ai]
+    if nc == 1:
+        conf = x[:, 4:5]
+    else:
+        conf = x[:, 5:] * x[:, 4:5]  # conf = obj_conf * cls_conf
+    box = xywh2xyxy(x[:, :4])
+
+    if multi_label:
+        i, j = (conf > conf_thres).nonzero(as_tuple=True)
+        x = torch.cat((box[i], conf[i, j, None], j[:, None].float()), 1)
+        image = bi[i]
+    else:  # best class only
+        conf, j = conf.max(1, keepdim=True)
+        keep = conf.view(-1) > conf_thres
+        x = torch.cat((box, conf, j.float()), 1)[keep]
+        image = bi[keep]
+
+    if classes is not None:
+        keep = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, image = x[keep], image[keep]
+
+    # by image, then conf, ties in candidate order, and at most max_nms per image
+    order = torch.sort(x[:, 4], descending=True, stable=True)[1]
+    order = order[torch.sort(image[order], stable=True)[1]]
+    x, image = x[order], image[order]
+    count = torch.bincount(image, minlength=bs)
+    start = torch.cumsum(count, 0) - count
+    keep = (torch.arange(x.shape[0], device=x.device) - start[image]) < max_nms
+    x, image = x[keep], image[keep]
+
+    # Batched NMS, class offset of non_max_suppression and an image offset larger than all boxes
+    c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
+    boxes = (x[:, :4] + c).double()
+    if boxes.shape[0]:
+        boxes = boxes + image[:, None].double() * (boxes.max() - boxes.min() + 1)
+    i = torchvision.ops.nms(boxes, x[:, 4].double(), iou_thres)  # NMS
+    i = i.sort()[0]  # back to image, conf, candidate order
+    image = image[i]
+    count = torch.bincount(image, minlength=bs)
+    start = torch.cumsum(count, 0) - count
+    keep = (torch.arange(i.shape[0], device=x.device) - start[image]) < max_det  # limit detections
+    x, image = x[i[keep]], image[keep]
+    count = torch.bincount(image, minlength=bs)
+    output = list(x.split(count.tolist()))
+
+    if not group_plate:
+        return output
+
+    # chars of each plate inside the same image, check_bbox on int boxes
+    start = torch.cumsum(count, 0) - count
+    is_plate = x[:, 5] == plate_class
+    plate = is_plate.nonzero().view(-1)  # [n, plates] pairs, few plates per batch
+    b = x[:, :4].trunc()
+    p = b[plate]
+    area = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    p_in_b = (b[:, None, 0] <= p[None, :, 0]) & (b[:, None, 1] <= p[None, :, 1])
+    p_in_b &= (b[:, None, 2] >= p[None, :, 2]) & (b[:, None, 3] >= p[None, :, 3])
+    b_in_p = (p[None, :, 0] <= b[:, None, 0]) & (p[None, :, 1] <= b[:, None, 1])
+    b_in_p &= (p[None, :, 2] >= b[:, None, 2]) & (p[None, :, 3] >= b[:, None, 3])
+    inside = torch.where(area[plate][None, :] >= area[:, None], b_in_p, p_in_b)  # larger box covers the smaller
+    inside &= (image[:, None] == image[plate][None, :]) & ~is_plate[:, None]
+    k, q = inside.nonzero(as_tuple=True)
+    pairs = torch.stack((plate[q] - start[image[k]], k - start[image[k]]), 1)
+    return output, list(pairs.split(torch.bincount(image[k], minlength=bs).tolist()))
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
                         labels=(), kpt_label=False, nc=None, nkpt=None):
     """Runs Non-Maximum Suppression (NMS) on inference results
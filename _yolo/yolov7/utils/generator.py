@@ -13,6 +13,10 @@ import math
 import random
 
 
+# label map of a plate (plate_generator.plate_labels), original image 255 = background, 54 = words, 0 = edges
+PLATE_BACKGROUND, PLATE_WORD, PLATE_EDGE = 0, 1, 2
+
+
 
 
 
@@ -130,7 +134,7 @@ def cycle(dl):
 
 
 class plate_generator():
-    def __init__(self,augmentor=None, outputStep=False, image_size=512, max_step=100):
+    def __init__(self,augmentor=None, outputStep=False, image_size=512, max_step=100, load_path=None, bg_path=None, atlas_path=None):
         ### Basic parameters settings
         ### 1cm = 38px
         cm = 38
@@ -160,10 +164,14 @@ class plate_generator():
         self.char_upper_distance = [int(0.232 * plate_height[0]), int(0.236 * plate_height[1])]
         self.dot = [int(0.037 * plate_width[0]), int(0.031 * plate_width[1])]
         
-        self.load_path = ['/data/licence_plate/_plate/synthesis/characters/6_characters/', 
-                          '/data/licence_plate/_plate/synthesis/characters/7_characters/']
-        self.bg_path = ['/data/licence_plate/_plate/synthesis/transparentBG_mask.png', 
-                        '/data/licence_plate/_plate/synthesis/transparentBG2_mask.png']
+        if load_path is None:
+            load_path = ['/data/licence_plate/_plate/synthesis/characters/6_characters/', 
+                         '/data/licence_plate/_plate/synthesis/characters/7_characters/']
+        if bg_path is None:
+            bg_path = ['/data/licence_plate/_plate/synthesis/transparentBG_mask.png', 
+                       '/data/licence_plate/_plate/synthesis/transparentBG2_mask.png']
+        self.load_path = [p.rstrip('/') + '/' for p in load_path]
+        self.bg_path = bg_path
         
         self.classes = ['0','1','2','3','4','5','6','7','8','9',
                 'A','B','C','D','E','F','G','H','J','K','L','M','N','P','Q','R','S','T','U','V','W','X','Y','Z']
@@ -179,9 +187,18 @@ class plate_generator():
 
         self.colours_mode = [(0,0), (1,2), (3,4)]
         self.blank_plate = [cv2.imread(self.bg_path[0]), cv2.imread(self.bg_path[1])]
+        # resized glyphs and label maps of both modes, atlas_path=False: no atlas (None), cv2.resize of every glyph of every plate
+        self.glyph_atlas = self.get_glyph_atlas(atlas_path)
         
         self.aug_adj_shadow=False
         self.negative_sample=False
+        self.fast_composite=False # place plates by their corners and warp only the plate ROI, see place_plates
+        self.fast_background=False # backgrounds and textures of pools, see sample_bg and sample_texture
+        self.bg_pool_size=64
+        self.bg_pool_refresh=0.05 # chance to draw a new pool entry once the pool is full
+        self.bg_low_res=128 # resolution of the random_bg_fast expression, upsampled to image_size
+        self.bg_pool=[]
+        self.texture_pool=[]
         print('self.aug_adj_shadow = %s'%self.aug_adj_shadow)
         print('self.negative_sample = %s'%self.negative_sample)
         
@@ -213,8 +230,8 @@ class plate_generator():
         #_blank = blank_plate[0].copy()
         #img2, sheet2 = self.basic_plate_allrandom(_blank)
         
-        img1, sheet1 = self.basic_plate_allrandom(style=style)
-        img2, sheet2 = self.basic_plate_allrandom(style=style)
+        img1, sheet1 = self.basic_plate_allrandom(style=style, labels=True)
+        img2, sheet2 = self.basic_plate_allrandom(style=style, labels=True)
         
 
         #print("Total time taken blank_time = {} seconds".format( time.time() - blank_time))  # print total computation time
@@ -237,8 +254,8 @@ class plate_generator():
         # adj color
         #adj3_time = time.time()
 
-        img1 = self.adjust_colour__(img1, mode1)
-        img2 = self.adjust_colour__(img2, mode2)
+        img1 = self.plate_palette(mode1)[img1]
+        img2 = self.plate_palette(mode2)[img2]
         #print("Total time taken adj3_time = {} seconds".format( time.time() - adj3_time))  # print total computation time
 
         if self.aug_adj_shadow:
@@ -264,6 +281,146 @@ class plate_generator():
         img2, sheet2 = self.resize_plate(img2, sheet2)
         #print("Total time taken resize_time = {} seconds".format( time.time() - resize_time))  # print total computation time
 
+        if not bg_image is None:
+            rnd = crop_image(bg_image, hwsize = self.image_size)
+        else:
+            #rnd = next(self.coco_images)
+            if self.fast_background:
+                rnd = self.sample_bg(image_size=self.image_size)
+            else:
+                rnd = self.random_bg(image_size=self.image_size)
+
+        if self.fast_composite:
+            nimg, fsheet = self.composite_plates(img1, sheet1, img2, sheet2, rnd)
+        else:
+            nimg, fsheet = self.composite_plates_full_frame(img1, sheet1, img2, sheet2, rnd)
+
+        nimg = self.add_texture(nimg)
+        nimg = self.add_blur(nimg)
+        nimg = self.contrast_brightness(nimg)
+        
+        #print("Total time taken add_noise_time = {} seconds".format( time.time() - add_noise_time))  # print total computation time
+
+        augimg = nimg # no augmentor
+        if self.augmentor:
+            need_aug = np.random.randint(0,99)
+            if step is not None:
+                need_aug = 99
+            if 0.01*need_aug>=self.ratio_augmentation:
+                #add_aug_time = time.time()
+                if step is None:
+                    step = np.random.randint(0,self.max_step-1)
+                
+                if step==0:
+                    augimg = nimg
+                    #rint('dsa')
+                else:
+                    augimg = self.augmentor.mix_aug(copy.deepcopy(nimg), step*(1.0/self.max_step), random=True)
+
+                #print("Total time taken add_aug_time = {} seconds".format( time.time() - add_aug_time))  # print total computation time
+        
+            else:
+                augimg = nimg
+        #print('(augimg-nimg).mean()=%.05f step=%d stepV=%.05f'%((augimg-nimg).mean(),step, step*(1.0/self.max_step) ))
+        #msg = self.get_msg(fsheet)  # Attention! The invald labels are bot be filtered!
+        label = self.get_xywh(fsheet)  # Attention! The invald labels are bot be filtered!
+        #print("Total time taken all = {} seconds".format( time.time() - start_time))  # print total computation time
+        #print(self.augmentor)
+        if self.outputStep:
+            return nimg, augimg, step, label
+        else:
+            return augimg, label
+
+    def sample_placement(self, size_small):
+        ### offset and angles of perspective_transform of one plate, same ranges as composite_plates_full_frame
+        nw=self.image_size
+        nh=self.image_size
+        offset_h = np.random.randint(0+nh//8,nh-size_small[0]-nh//8)
+        offset_w = np.random.randint(0+nw//8,nw-size_small[1]-nw//8)
+        angles = np.random.uniform(-9, 9, size=3)
+        return [offset_w, offset_h], angles
+
+    def plate_homography(self, offset, angles):
+        ### plate pixels -> image: paste at offset on the black image_size canvas, then perspective_transform of the canvas
+        M = self.perspective_matrix(self.image_size, self.image_size, theta_x=angles[0], theta_y=angles[1], theta_z=angles[2])
+        T = np.array([[1, 0, offset[0]],
+                      [0, 1, offset[1]],
+                      [0, 0, 1]], dtype=np.float64)
+        return M.dot(T), M
+
+    def transform_points(self, pts, H):
+        '''
+        Input:
+            pts: [n, 2] x, y
+            H: [3, 3] or [n, 3, 3] homography of each point
+        Return: [n, 2] float64
+        '''
+        pts = np.concatenate([np.asarray(pts, dtype=np.float64), np.ones((len(pts), 1))], 1)
+        post = np.einsum('ij,nj->ni', H, pts) if H.ndim == 2 else np.einsum('nij,nj->ni', H, pts)
+        return post[:, :2] / post[:, 2:]
+
+    def quads_overlap(self, q1, q2):
+        '''
+        Separating axis test of two convex quadrilaterals.
+        Input: q1, q2 = [4, 2] corners in order around the polygon
+        Return: True when they intersect
+        '''
+        edges = np.concatenate([np.roll(q1, -1, 0) - q1, np.roll(q2, -1, 0) - q2], 0)
+        axes = np.stack([-edges[:, 1], edges[:, 0]], 1)  # edge normals of both quads
+        p1 = q1.dot(axes.T)
+        p2 = q2.dot(axes.T)
+        separated = (p1.max(0) < p2.min(0)) | (p2.max(0) < p1.min(0))
+        return not separated.any()
+
+    def place_plates(self, size_small1, size_small2):
+        ### rejection sampling on the 4 transformed corners of each plate, nothing is rendered
+        while True:
+            offset1, angles1 = self.sample_placement(size_small1)
+            offset2, angles2 = self.sample_placement(size_small2)
+            H1, M1 = self.plate_homography(offset1, angles1)
+            H2, M2 = self.plate_homography(offset2, angles2)
+            corners = []
+            for (h, w), H in ((size_small1, H1), (size_small2, H2)):
+                corners.append(self.transform_points([[0, 0], [w, 0], [w, h], [0, h]], H))
+            if not self.quads_overlap(corners[0], corners[1]):
+                return (offset1, M1, H1, corners[0]), (offset2, M2, H2, corners[1])
+
+    def warp_plate_roi(self, dst, iplate, H, corners):
+        '''
+        warpPerspective of the plate into the bounding box of its corners only, alpha composited
+        on dst (the plate is opaque, the alpha is the warped plate area).
+        Input:
+            dst: image_size x image_size x 3 uint8 background, changed in place
+            iplate: h x w x 3 uint8 plate
+            H: plate pixels -> dst, see plate_homography
+            corners: [4, 2] H of the plate corners
+        '''
+        nh, nw = dst.shape[0:2]
+        x0, y0 = np.maximum(np.floor(corners.min(0)).astype(int) - 1, 0)
+        x1, y1 = np.minimum(np.ceil(corners.max(0)).astype(int) + 2, [nw, nh])
+        if x1 <= x0 or y1 <= y0:
+            return dst
+        h, w = iplate.shape[0:2]
+        plate_a = np.concatenate([iplate, np.full((h, w, 1), 255, np.uint8)], 2)
+        H_roi = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64).dot(H)
+        warped = cv2.warpPerspective(plate_a, H_roi, (int(x1 - x0), int(y1 - y0))).astype(np.float32)
+        # warped colour is already premultiplied by the alpha (bilinear with the black border)
+        alpha = warped[:, :, 3:] / 255.
+        roi = dst[y0:y1, x0:x1]
+        roi[:] = np.clip(warped[:, :, :3] + roi * (1 - alpha) + 0.5, 0, 255).astype(np.uint8)
+        return dst
+
+    def composite_plates(self, img1, sheet1, img2, sheet2, bg):
+        ### two plates on bg without overlapping, one ROI warp per plate
+        (offset1, M1, H1, corners1), (offset2, M2, H2, corners2) = self.place_plates(img1.shape[0:2], img2.shape[0:2])
+        nimg = bg.copy()
+        self.warp_plate_roi(nimg, img1, H1, corners1)
+        self.warp_plate_roi(nimg, img2, H2, corners2)
+        fsheet = self.update_log(sheet1, sheet2, offset1, offset2, M1, M2)
+        return nimg, fsheet
+
+    def composite_plates_full_frame(self, img1, sheet1, img2, sheet2, rnd):
+        ### composite_plates of full image_size frames: warp of the black canvas, pixel overlap test, merge
         # put plate on image without overlapping
         #mix_plates_time = time.time()
 
@@ -351,60 +508,10 @@ class plate_generator():
         fsheet = self.update_log(sheet1, sheet2, offset1, offset2, M1, M2)
         #print("Total time taken update_label_time = {} seconds".format( time.time() - update_label_time))  # print total computation time
 
-        # put plate on bg
-        #put_plate_on_bg_time = time.time()
-
-        if not bg_image is None:
-            rnd = crop_image(bg_image, hwsize = self.image_size)
-        else:
-            #rnd = next(self.coco_images)
-            rnd = self.random_bg(image_size=self.image_size)
-        
         #fimg = self.match_contrast_and_brightness(fimg, rnd) #have some bug will change color of words
-        #print("Total time taken put_plate_on_bg_time = {} seconds".format( time.time() - put_plate_on_bg_time))  # print total computation time
 
-        
-        
-        # add noises
-        #add_noise_time = time.time()
-        
-        
         nimg = self.change_bg(fimg, rnd)
-        nimg = self.add_texture(nimg)
-        nimg = self.add_blur(nimg)
-        nimg = self.contrast_brightness(nimg)
-        
-        #print("Total time taken add_noise_time = {} seconds".format( time.time() - add_noise_time))  # print total computation time
-
-        
-        if self.augmentor:
-            need_aug = np.random.randint(0,99)
-            if step is not None:
-                need_aug = 99
-            if 0.01*need_aug>=self.ratio_augmentation:
-                #add_aug_time = time.time()
-                if step is None:
-                    step = np.random.randint(0,self.max_step-1)
-                
-                if step==0:
-                    augimg = nimg
-                    #rint('dsa')
-                else:
-                    augimg = self.augmentor.mix_aug(copy.deepcopy(nimg), step*(1.0/self.max_step), random=True)
-
-                #print("Total time taken add_aug_time = {} seconds".format( time.time() - add_aug_time))  # print total computation time
-        
-            else:
-                augimg = nimg
-        #print('(augimg-nimg).mean()=%.05f step=%d stepV=%.05f'%((augimg-nimg).mean(),step, step*(1.0/self.max_step) ))
-        #msg = self.get_msg(fsheet)  # Attention! The invald labels are bot be filtered!
-        label = self.get_xywh(fsheet)  # Attention! The invald labels are bot be filtered!
-        #print("Total time taken all = {} seconds".format( time.time() - start_time))  # print total computation time
-        #print(self.augmentor)
-        if self.outputStep:
-            return nimg, augimg, step, label
-        else:
-            return augimg, label
+        return nimg, fsheet
     
     def randColor(self):
         return np.array([np.random.random(), np.random.random(), np.random.random()]).reshape((1, 1, 3))
@@ -468,6 +575,115 @@ class plate_generator():
 
         return np.array(img8Bit)
 
+    def random_bg_fast(self, image_size=512, low_res=128, max_nodes=32):
+        '''
+        random_bg with a bounded cost. The expression tree is drawn without evaluating it (same
+        choices as random_bg, only leaves once max_nodes functions are drawn), X, Y and a colour
+        are combined at the root when the tree has none so the result is always low_res x low_res x 3
+        (no reject and rebuild), then it is evaluated once in float32 at low_res and resized to
+        image_size (low_res None = at image_size).
+        Return: uint8 image_size x image_size x 3
+        '''
+        size = image_size if low_res is None else min(low_res, image_size)
+        xArray = np.linspace(0.0, 1.0, size, dtype=np.float32).reshape((1, size, 1))
+        yArray = np.linspace(0.0, 1.0, size, dtype=np.float32).reshape((size, 1, 1))
+        COLOUR, X, Y = 4, 1, 2  # leaves, bits of the axes a subtree covers
+        functions = [(1, np.sin), (1, np.cos), (2, np.add), (2, np.subtract), (2, np.multiply), (2, self.safeDivide)]
+        depthMin = 2
+        depthMax = 10
+        n_nodes = [0]
+
+        def buildTree(depth = 0):
+            # (leaf or (func, args)), axes bits
+            n_leaves = 3 if depth >= depthMin else 0
+            n_funcs = len(functions) if depth < depthMax and n_nodes[0] < max_nodes else 0
+            if n_funcs == 0 and n_leaves == 0:
+                n_leaves = 3
+            idx = np.random.randint(n_leaves + n_funcs)
+            if idx < n_leaves:
+                leaf = [COLOUR, X, Y][idx]
+                return leaf, leaf
+            n_nodes[0] += 1
+            nArgs, func = functions[idx - n_leaves]
+            args = [buildTree(depth + 1) for n in range(nArgs)]
+            axes = 0
+            for _, a in args:
+                axes |= a
+            return (func, [t for t, _ in args]), axes
+
+        tree, axes = buildTree()
+        for leaf in [COLOUR, X, Y]:
+            if not axes & leaf:
+                args = [tree, leaf] if np.random.rand() < 0.5 else [leaf, tree]
+                tree = (functions[np.random.randint(2, len(functions))][1], args)
+
+        def evaluate(node):
+            if node == COLOUR:
+                return self.randColor().astype(np.float32)
+            if node == X:
+                return xArray
+            if node == Y:
+                return yArray
+            func, args = node
+            return func(*[evaluate(a) for a in args])
+
+        with np.errstate(all='ignore'):
+            img = evaluate(tree)
+            img = np.nan_to_num(img, nan=0.0, posinf=1.0, neginf=0.0)
+            img8Bit = np.uint8(np.rint(img.clip(0.0, 1.0) * 255.0))
+        if size != image_size:
+            img8Bit = cv2.resize(img8Bit, (image_size, image_size), interpolation=cv2.INTER_LINEAR)
+        return img8Bit
+
+    def sample_pool(self, pool, make, image_size):
+        ### random crop and flips of a pool entry, a new entry (make()) while the pool is not full or with bg_pool_refresh
+        if len(pool) < self.bg_pool_size:
+            pool.append(make())
+            entry = pool[-1]
+        elif np.random.rand() < self.bg_pool_refresh:
+            pool[np.random.randint(len(pool))] = entry = make()
+        else:
+            entry = pool[np.random.randint(len(pool))]
+        y = np.random.randint(entry.shape[0] - image_size + 1)
+        x = np.random.randint(entry.shape[1] - image_size + 1)
+        crop = entry[y:y + image_size, x:x + image_size]
+        flip = np.random.randint(4)  # none, vertical, horizontal, both
+        crop = crop.copy() if flip == 0 else cv2.flip(crop, [None, 0, 1, -1][flip])
+        if np.random.rand() < 0.5:
+            crop = cv2.transpose(crop)
+        return crop
+
+    def sample_bg(self, image_size=512):
+        ### background of random_bg_fast from the pool, entries are 1.25 x image_size for the random crop
+        pool_size = image_size + image_size // 4
+        return self.sample_pool(self.bg_pool, lambda: self.random_bg_fast(pool_size, low_res=self.bg_low_res), image_size)
+
+    def create_texture_fast(self, size=512, background=230, sigma=4, turbulence=2, noise_sigma=10):
+        '''
+        add_noise(create_texture(create_blank_image(background), sigma), noise_sigma) of add_texture in
+        float32, the octaves are summed coarse to fine (one resize per octave at its own size instead
+        of a float64 resize of every octave to the full size).
+        Return: float32 size x size
+        '''
+        grids = []
+        ratio = size
+        while not ratio == 1:
+            grids.append(max(size // ratio, 1))
+            ratio = (ratio // turbulence) or 1
+        result = np.zeros((1, 1), np.float32)
+        for g in grids:
+            result = cv2.resize(result, (g, g), interpolation=cv2.INTER_LINEAR)
+            result += np.random.normal(0, sigma, (g, g)).astype(np.float32)
+        result = cv2.resize(result, (size, size), interpolation=cv2.INTER_LINEAR)
+        texture = np.clip(result + background, 0, 255).astype(np.uint8).astype(np.float32)
+        texture += np.random.normal(0, noise_sigma, (size, size)).astype(np.float32)
+        return texture.clip(0, 255)
+
+    def sample_texture(self, image_size=512):
+        ### texture of create_texture_fast from the pool, random crop and flips
+        pool_size = image_size + image_size // 4
+        return self.sample_pool(self.texture_pool, lambda: self.create_texture_fast(pool_size), image_size)
+
     
     
     
@@ -629,6 +845,9 @@ class plate_generator():
     
     
     def add_texture(self, dst):
+        if self.fast_background:
+            t_bg = self.sample_texture(dst.shape[0])
+            return (dst + t_bg[:, :, None]) / 2
         texture_bg = self.add_noise(self.create_texture(self.create_blank_image(background=230), sigma=4), sigma=10)
         #print(texture_bg.shape)
         t_bg = np.repeat(texture_bg, 3, axis=-1)
@@ -669,16 +888,14 @@ class plate_generator():
         #print(s2)
 
 
-        for _s in s1:
-            for t in tags:
-                pre = np.array([[_s[t][0]+w1], [_s[t][1]+h1], [1]])
-                post = np.dot(M1, pre)
-                _s[t] = [int(post[0]/post[2]), int(post[1]/post[2])]
-        for _s in s2:
-            for t in tags:
-                pre = np.array([[_s[t][0]+w2], [_s[t][1]+h2], [1]])
-                post = np.dot(M2, pre)
-                _s[t] = [int(post[0]/post[2]), int(post[1]/post[2])]
+        # all corners of both sheets in one transform, M of each corner
+        pts = np.array([_s[t] for _s in s1 for t in tags] + [_s[t] for _s in s2 for t in tags], dtype=np.float64).reshape(-1, 2)
+        pts += np.repeat(np.array([[w1, h1], [w2, h2]], dtype=np.float64), [4 * len(s1), 4 * len(s2)], 0)
+        M = np.repeat(np.stack([M1, M2], 0), [4 * len(s1), 4 * len(s2)], 0)
+        post = self.transform_points(pts, M).astype(int).reshape(-1, 4, 2).tolist()  # astype truncates like int()
+        for _s, p in zip(list(s1) + list(s2), post):
+            for t, xy in zip(tags, p):
+                _s[t] = xy
         #print(s1)
         #print(s2)
 
@@ -826,6 +1043,14 @@ class plate_generator():
 
     
     def perspective_transform(self, img, theta_x=0, theta_y=0, theta_z=0,dx=0, dy=0, dz=0, f=0):
+        h, w, _ = img.shape
+        M = self.perspective_matrix(h, w, theta_x, theta_y, theta_z, dx, dy)
+        dst = cv2.warpPerspective(img, M, (w,h))
+
+        return dst, M
+
+    def perspective_matrix(self, h, w, theta_x=0, theta_y=0, theta_z=0, dx=0, dy=0):
+        ### M of perspective_transform for an h x w image
         radian_x = math.radians(theta_x)
         radian_y = math.radians(theta_y)
         radian_z = math.radians(theta_z)
@@ -836,7 +1061,6 @@ class plate_generator():
         sin_z = math.sin(radian_z)
         cos_z = math.cos(radian_z)
 
-        h, w, _ = img.shape
         d = np.sqrt(h**2 + w**2)
         f = d / (2 * sin_z if sin_z != 0 else 1)
         dz = f
@@ -874,9 +1098,7 @@ class plate_generator():
 
 
         M = A2.dot(T.dot(R.dot(A1)))
-        dst = cv2.warpPerspective(img, M, (w,h))
-
-        return dst, M
+        return M
     
     def check_no_overlap(self, size_big, size_small1, offset1, angles1, size_small2, offset2, angles2):
         # Function to calculate the transformed corners of a small image
@@ -1045,37 +1267,40 @@ class plate_generator():
         ###        4                (Red, White)
         ### original image 255 = background, 54 = words, 0 = edges
 
-        black_mask = (iplate == [0, 0, 0]).all(axis=2)
-        #white_mask = (iplate == [255, 255, 255]).all(axis=2)
-        word_mask = (iplate == [54, 54, 54]).all(axis=2)
-        #print(word_mask==True)
-        #print(black_mask==True)
-        #print(mode)
+        iplate[:,:,:] = self.plate_palette(mode)[self.plate_labels(iplate)]
+        return iplate
+
+    def plate_labels(self, iplate):
+        ### label map of a plate image, PLATE_WORD where 54, PLATE_EDGE where 0, PLATE_BACKGROUND elsewhere
+        labels = np.full(iplate.shape[0:2], PLATE_BACKGROUND, np.uint8)
+        labels[(iplate == [54, 54, 54]).all(axis=2)] = PLATE_WORD
+        labels[(iplate == [0, 0, 0]).all(axis=2)] = PLATE_EDGE
+        return labels
+
+    def plate_palette(self, mode=0):
+        '''
+        BGR colours of the labels of a plate for a colour mode (see adjust_colour__), the random
+        draws are the ones of adjust_colour__, palette[labels] is the recoloured plate.
+        Return: uint8 [3(PLATE_BACKGROUND, PLATE_WORD, PLATE_EDGE), 3]
+        '''
+        palette = np.zeros((3, 3), np.uint8)
         if mode < 3:
             colour = np.random.randint(50, 180, size=3)
             colour2 = np.random.randint(230, 250, size=3)
             diff = 255 - colour2.max()
             colour2 += diff
-            iplate[:,:,:] = colour2
-            iplate[black_mask] = colour
+            palette[PLATE_BACKGROUND] = colour2
+            palette[PLATE_EDGE] = colour
+            palette[PLATE_WORD] = colour2
 
             if mode == 1:
                 green = np.random.randint(50, 101)
-                iplate[word_mask] = [1, green, 1]  # BGR for green word
-                #print(green)
-
+                palette[PLATE_WORD] = [1, green, 1]  # BGR for green word
             elif mode == 2:
                 red = np.random.randint(100, 151)
-                iplate[word_mask] = [1, 1, red]  # BGR for red word
-                #print(red)
-
+                palette[PLATE_WORD] = [1, 1, red]  # BGR for red word
             elif mode == 0:
-                iplate[word_mask] = [54, 54, 54]  # BGR for black word
-                #print(54)
-
-            #print(colour)
-            #print(colour2)
-
+                palette[PLATE_WORD] = [54, 54, 54]  # BGR for black word
 
         else:
             white = np.random.randint(230, 250, size=3)
@@ -1084,29 +1309,80 @@ class plate_generator():
 
             if mode == 3:
                 green = np.random.randint(50, 101)
-                iplate[:,:,:] = [1, green, 1]  # BGR for green background
+                palette[PLATE_BACKGROUND] = [1, green, 1]  # BGR for green background
             elif mode == 4:
                 red = np.random.randint(100, 151)
-                iplate[:,:,:] = [1, 1, red]  # BGR for red background
+                palette[PLATE_BACKGROUND] = [1, 1, red]  # BGR for red background
                 
-            iplate[word_mask] = white  # BGR for white word
-            iplate[black_mask] = colour
-
-        return iplate
+            palette[PLATE_WORD] = white  # BGR for white word
+            palette[PLATE_EDGE] = colour
+
+        return palette
+
+    def get_glyph_atlas(self, atlas_path=None):
+        '''
+        Glyphs of load_path resized to the char_width x char_height (dot x char_height) of both
+        plate modes, with the label maps of the glyphs and of the blank plates, built once here
+        instead of for every plate. With atlas_path (.npz) the atlas is read from it, or written
+        to it when missing, so dataloader workers do not read the png. atlas_path=False turns the
+        atlas off, glyphs are then read and resized for every plate (get_glyph).
+        Return: {'glyph0': [34, h, w, 3], 'glyph_label0': [34, h, w], 'dot0', 'dot_label0',
+                 'blank_label0', ... of mode 1, 'geometry': [2, 3(char_width, char_height, dot)]},
+                None when atlas_path is False
+        '''
+        if atlas_path is False:
+            return None
+        if atlas_path is not None and not str(atlas_path).endswith('.npz'):
+            atlas_path = str(atlas_path) + '.npz'  # the name np.savez writes
+        geometry = np.array([self.char_width, self.char_height, self.dot]).T
+        if atlas_path is not None and os.path.exists(atlas_path):
+            atlas = dict(np.load(atlas_path))
+            if np.array_equal(atlas['geometry'], geometry):
+                self.blank_plate = [atlas['blank0'], atlas['blank1']]
+                return atlas
+            print('glyph atlas %s is of another plate geometry, rebuilt'%atlas_path)
+        atlas = {'geometry': geometry}
+        for mode in range(2):
+            if self.blank_plate[mode] is None:
+                print('no blank plate %s'%self.bg_path[mode])
+                no_blank_plate
+            size = (self.char_width[mode], self.char_height[mode])
+            glyphs = [cv2.resize(self.load_image_from_dict(self.load_path[mode] + c + '.png'), size) for c in self.classes]
+            atlas['glyph%d'%mode] = np.stack(glyphs, 0)
+            atlas['glyph_label%d'%mode] = np.stack([self.plate_labels(g) for g in glyphs], 0)
+            atlas['dot%d'%mode] = cv2.resize(self.load_image_from_dict(self.load_path[mode] + 'dot.png'), (self.dot[mode], self.char_height[mode]))
+            atlas['dot_label%d'%mode] = self.plate_labels(atlas['dot%d'%mode])
+            atlas['blank%d'%mode] = self.blank_plate[mode]
+            atlas['blank_label%d'%mode] = self.plate_labels(self.blank_plate[mode])
+        if atlas_path is not None:
+            np.savez(atlas_path, **atlas)
+        return atlas
+
+    def get_glyph(self, mode, c, labels=False):
+        ### glyph of class c (or 'dot') of a plate mode, image or label map, from the atlas when there is one
+        if self.glyph_atlas is None:
+            name = 'dot' if c == 'dot' else self.classes[c]
+            size = (self.dot[mode] if c == 'dot' else self.char_width[mode], self.char_height[mode])
+            glyph = cv2.resize(self.load_image_from_dict(self.load_path[mode] + name + '.png'), size)
+            return self.plate_labels(glyph) if labels else glyph
+        key = ('dot' if c == 'dot' else 'glyph') + ('_label' if labels else '') + str(mode)
+        return self.glyph_atlas[key] if c == 'dot' else self.glyph_atlas[key][c]
 
-        
-        
     def load_image_from_dict(self,path):
         if path in self.words_image_dict:
             img = self.words_image_dict[path]
         else:
             img = cv2.imread(path)
+            if img is None:
+                print('no glyph %s'%path)
+                no_glyph
             self.words_image_dict[path] = img
         return img
 
         
         
-    def basic_plate_allrandom(self,style='random'):
+    def basic_plate_allrandom(self,style='random',labels=False):
+        ### labels: return the label map of the plate (see plate_labels) instead of the image, recoloured by plate_palette
         blank_plate = self.blank_plate
 
         
@@ -1126,7 +1402,12 @@ class plate_generator():
         plate_nums = np.random.randint(6,8,1)
         #plate_nums = plate_nums = np.random.randint(7,8,1)
         mode = plate_nums[0]-6
-        iplate = blank_plate[mode].copy()
+        if labels and self.glyph_atlas is not None:
+            iplate = self.glyph_atlas['blank_label%d'%mode].copy()
+        elif labels:
+            iplate = self.plate_labels(blank_plate[mode])
+        else:
+            iplate = blank_plate[mode].copy()
         #print(mode)
         if style=='real':
             license_eng = np.random.randint(10,34,size=plate_nums)
@@ -1226,11 +1507,7 @@ class plate_generator():
         oh = 20 + char_upper_distance[mode]
         ow = 20 + char_padding[mode]
         for i in c_list1:
-            ipath = load_path[mode] + classes[i] + '.png'
-
-            #img = cv2.imread(ipath)
-            img = self.load_image_from_dict(ipath)
-            ni = cv2.resize(img,(char_width[mode], char_height[mode]))
+            ni = self.get_glyph(mode, i, labels)
             iplate[oh : oh+char_height[mode], ow : ow+char_width[mode]] = ni
             dic = {}
             dic['Class']=i
@@ -1241,18 +1518,13 @@ class plate_generator():
             sheet.append(dic)
             ow += char_padding[mode] + char_width[mode]
             
-        #cDot = cv2.imread(load_path[mode]+'dot.png')
-        cDot = self.load_image_from_dict(load_path[mode]+'dot.png')
-        iDot = cv2.resize(cDot,(dot[mode], char_height[mode]))
-        h, w, ch = iDot.shape
+        iDot = self.get_glyph(mode, 'dot', labels)
+        h, w = iDot.shape[0:2]
         iplate[oh : oh+h, ow : ow+w] = iDot
         ow += char_padding[mode] + w
 
         for i in c_list2:
-            ipath = load_path[mode] + classes[i] + '.png'
-            #img = cv2.imread(ipath)
-            img = self.load_image_from_dict(ipath)
-            ni = cv2.resize(img,(char_width[mode], char_height[mode]))
+            ni = self.get_glyph(mode, i, labels)
             iplate[oh : oh+char_height[mode], ow : ow+char_width[mode]] = ni
             dic = {}
             dic['Class']=i
@@ -0,0 +1,163 @@
+import torch
+import torchvision
+from utils.general import xywh2xyxy
+
+PLATE_CLASS = 34
+CLASS_NAMES = '0123456789ABCDEFGHJKLMNPQRSTUVWXYZ'
+# style='real' of plate_generator.basic_plate_allrandom, c_list1 + c_list2, L = letter (10-33), D = digit (0-9)
+TAIWAN_FORMATS = ['LLLDDDD', 'LLDDDD', 'DDDDLL', 'LLLDDD', 'DDDLLL']
+
+
+class PlateDecoder(object):
+    '''
+    Plate strings from the raw detect output in one batched pass on the device: plate and
+    char candidates, one nms for the batch (chars class agnostic, each anchor keeps its class
+    probabilities), chars assigned to the smallest plate that holds their center, read top row
+    then bottom row for two row plates, then left to right, and decoded against formats.
+    Input:
+        formats: plate syntax, one string of 'L' / 'D' per format, None for plain argmax.
+                 a plate whose char count matches a format gets the best scoring format,
+                 other plates fall back to argmax
+    Usage:
+        decoder = PlateDecoder()
+        out = decoder(pred)               # pred = model(img)[0], [b, anchors, 5 + nc]
+        strings = decoder.strings(out)    # [b][plates] strings
+        dets = decoder.to_detections(out) # [b](n, 6) for affine_transform_batch / eval_dataset
+    '''
+    def __init__(self, formats=TAIWAN_FORMATS, conf_thres=0.25, iou_thres=0.45, max_chars=10, plate_class=PLATE_CLASS):
+        self.formats = formats if formats is not None else []
+        self.conf_thres = conf_thres
+        self.iou_thres = iou_thres
+        self.plate_class = plate_class
+        self.max_chars = max([max_chars] + [len(f) for f in self.formats])
+        # [formats, max_chars] 0 digit, 1 letter, -1 after the end
+        self.template = torch.full((max(len(self.formats), 1), self.max_chars), -1, dtype=torch.long)
+        for t, f in enumerate(self.formats):
+            for k, c in enumerate(f):
+                self.template[t, k] = 0 if c == 'D' else 1
+        self.template_len = torch.tensor([len(f) for f in self.formats] if len(self.formats) > 0 else [-1])
+        self.char_set = torch.zeros((2, plate_class), dtype=torch.bool)
+        self.char_set[0, :10] = True
+        self.char_set[1, 10:] = True
+
+    def __call__(self, prediction):
+        '''
+        Input:
+            prediction: [b, anchors, 5 + nc] (xywh, obj, cls) of Detect in eval mode
+        Return: dict of tensors, one row per plate
+            'image' [P], 'plate' [P, 4] xyxy, 'score' [P],
+            'chars' [P, max_chars] decoded classes in reading order, -1 padded,
+            'char_boxes' [P, max_chars, 4], 'char_score' [P, max_chars],
+            'n_chars' [P], 'format' [P] index in formats, -1 when decoded by argmax
+        '''
+        device = prediction.device
+        bs = prediction.shape[0]
+        nc = self.plate_class
+        # conf = obj * cls <= obj, only anchors above conf_thres in obj can pass
+        image, anchor = (prediction[..., 4] > self.conf_thres).nonzero(as_tuple=True)
+        x = prediction[image, anchor]
+        plate_conf = x[:, 4] * x[:, 5 + nc]
+        char_conf = x[:, 4] * x[:, 5:5 + nc].max(-1)[0]
+        # an anchor is a plate or a char, whichever class is higher
+        is_plate = plate_conf >= char_conf
+        score = torch.where(is_plate, plate_conf, char_conf)
+        keep = score > self.conf_thres
+        image, anchor, is_plate, score = image[keep], anchor[keep], is_plate[keep], score[keep]
+        box = xywh2xyxy(x[keep, :4])
+
+        # one nms, categories (image, plate or char) kept apart by a coordinate offset
+        boxes = box.double()
+        if boxes.shape[0]:
+            boxes = boxes + (image * 2 + is_plate.long())[:, None].double() * (boxes.max() - boxes.min() + 1)
+        keep = torchvision.ops.nms(boxes, score.double(), self.iou_thres).sort()[0]
+        image, anchor, is_plate, score, box = image[keep], anchor[keep], is_plate[keep], score[keep], box[keep]
+
+        p_image, p_box, p_score = image[is_plate], box[is_plate], score[is_plate]
+        c_image, c_box, c_score, c_anchor = image[~is_plate], box[~is_plate], score[~is_plate], anchor[~is_plate]
+        n_plate = p_box.shape[0]
+
+        # smallest plate of the same image holding the char center
+        cx = (c_box[:, 0] + c_box[:, 2]) / 2
+        cy = (c_box[:, 1] + c_box[:, 3]) / 2
+        inside = (c_image[:, None] == p_image[None, :]) & (p_box[None, :, 0] <= cx[:, None]) & (p_box[None, :, 2] >= cx[:, None])
+        inside &= (p_box[None, :, 1] <= cy[:, None]) & (p_box[None, :, 3] >= cy[:, None])
+        area = (p_box[:, 2] - p_box[:, 0]) * (p_box[:, 3] - p_box[:, 1])
+        area = torch.where(inside, area[None, :], torch.full_like(area, float('inf'))[None, :])
+        has_plate = inside.any(1)
+        plate = area.argmin(1) if n_plate > 0 else torch.zeros_like(c_image)
+        plate, c_box, c_score, c_anchor, c_image, cx, cy = [x[has_plate] for x in (plate, c_box, c_score, c_anchor, c_image, cx, cy)]
+
+        # two rows when the char centers of a plate are more than half a char height apart
+        y_min = torch.full((n_plate,), float('inf'), device=device).scatter_reduce(0, plate, cy, 'amin')
+        y_max = torch.full((n_plate,), -float('inf'), device=device).scatter_reduce(0, plate, cy, 'amax')
+        count = torch.bincount(plate, minlength=n_plate)
+        char_h = torch.zeros(n_plate, device=device).index_add(0, plate, c_box[:, 3] - c_box[:, 1]) / count.clamp(min=1)
+        two_row = (y_max - y_min) > 0.5 * char_h
+        row = (two_row[plate] & (cy > ((y_min + y_max) / 2)[plate])).long()
+
+        # reading order: plate, row, x
+        order = torch.sort(cx, stable=True)[1]
+        order = order[torch.sort(row[order], stable=True)[1]]
+        order = order[torch.sort(plate[order], stable=True)[1]]
+        plate, row, c_box, c_score, c_anchor, c_image = [x[order] for x in (plate, row, c_box, c_score, c_anchor, c_image)]
+        rank = torch.arange(plate.shape[0], device=device) - (torch.cumsum(count, 0) - count)[plate]
+        fit = rank < self.max_chars
+        plate, rank, c_box, c_score, c_anchor, c_image = [x[fit] for x in (plate, rank, c_box, c_score, c_anchor, c_image)]
+        n_chars = torch.bincount(plate, minlength=n_plate)
+
+        # [P, max_chars, nc] class log probabilities in reading order
+        L = self.max_chars
+        logp = torch.zeros((n_plate, L, nc), device=device)
+        logp[plate, rank] = prediction[c_image, c_anchor, 5:5 + nc].float().clamp(min=1e-9).log()
+        mask = torch.zeros((n_plate, L), dtype=torch.bool, device=device)
+        mask[plate, rank] = True
+        argmax = logp.argmax(-1)
+
+        # best class inside digits / letters, [P, L, 2]
+        char_set = self.char_set.to(device)
+        set_logp = torch.where(char_set[None, None], logp[:, :, None, :], torch.full_like(logp[:, :, None, :], -float('inf')))
+        set_val, set_idx = set_logp.max(-1)
+        template = self.template.to(device)
+        t_set = template.clamp(min=0)[None].expand(n_plate, -1, -1)
+        t_val = torch.gather(set_val[:, None].expand(-1, template.shape[0], -1, -1), 3, t_set[..., None])[..., 0]
+        t_val = torch.where(template[None] >= 0, t_val, torch.zeros_like(t_val)).sum(-1)
+        valid = self.template_len.to(device)[None, :] == n_chars[:, None]
+        t_val = torch.where(valid, t_val, torch.full_like(t_val, -float('inf')))
+        fmt = t_val.argmax(1)
+        has_format = valid.any(1)
+        constrained = torch.gather(set_idx, 2, template[fmt].clamp(min=0)[..., None])[..., 0]
+        chars = torch.where(has_format[:, None], constrained, argmax)
+        chars = torch.where(mask, chars, torch.full_like(chars, -1))
+
+        char_boxes = torch.zeros((n_plate, L, 4), device=device, dtype=c_box.dtype)
+        char_boxes[plate, rank] = c_box
+        char_score = torch.zeros((n_plate, L), device=device, dtype=c_score.dtype)
+        char_score[plate, rank] = c_score
+        return {'image': p_image, 'plate': p_box, 'score': p_score, 'chars': chars, 'char_boxes': char_boxes,
+                'char_score': char_score, 'n_chars': n_chars, 'format': torch.where(has_format, fmt, torch.full_like(fmt, -1)),
+                'batch_size': bs}
+
+    def strings(self, out):
+        '''
+        Return: [b][plates] plate strings, the only host copy of the decoding
+        '''
+        strings = [[] for _ in range(out['batch_size'])]
+        for i, chars in zip(out['image'].tolist(), out['chars'].tolist()):
+            strings[i].append(''.join(CLASS_NAMES[c] for c in chars if c >= 0))
+        return strings
+
+    def to_detections(self, out):
+        '''
+        Return: [b](n, 6) [xyxy, conf, cls], plate rows and decoded char rows,
+            the format of non_max_suppression output
+        '''
+        mask = out['chars'] >= 0
+        n_plate = out['plate'].shape[0]
+        plate_rows = torch.cat((out['plate'], out['score'][:, None],
+                                torch.full((n_plate, 1), self.plate_class, device=out['plate'].device, dtype=out['plate'].dtype)), 1)
+        char_rows = torch.cat((out['char_boxes'][mask], out['char_score'][mask][:, None], out['chars'][mask][:, None].to(out['plate'].dtype)), 1)
+        image = torch.cat((out['image'], out['image'][:, None].expand_as(mask)[mask]))
+        rows = torch.cat((plate_rows, char_rows))
+        order = torch.sort(image, stable=True)[1]
+        count = torch.bincount(image, minlength=out['batch_size'])
+        return list(rows[order].split(count.tolist()))
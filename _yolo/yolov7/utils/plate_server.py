@@ -0,0 +1,175 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from utils.eval_engine import letterbox_plate, affine_transform_batch
+from utils.plate_decode import PlateDecoder
+
+
+def load_ema_denoise_fn(unet, load_path, device=None):
+    '''
+    denoise_fn weights of the EMA model of a diffusion Trainer checkpoint (model.pt).
+    Input:
+        unet: Unet built with the training arguments
+        load_path: model.pt of Trainer.save, {'step', 'model', 'ema'}
+    Return: unet with the ema weights, eval mode
+    '''
+    data = torch.load(load_path, map_location='cpu')
+    # ema is DataParallel(GaussianDiffusion), keys are module.denoise_fn.*
+    state_dict = {k.split('denoise_fn.', 1)[1]: v for k, v in data['ema'].items() if 'denoise_fn.' in k}
+    if len(state_dict) == 0:
+        print('no denoise_fn weights in the ema of %s'%load_path)
+        no_denoise_fn_in_ema
+    unet.load_state_dict(state_dict)
+    return unet.to(device).eval()
+
+
+class PlatePipeline(object):
+    '''
+    forward_submodel before -> denoise_fn -> forward_submodel after -> PlateDecoder on a batch,
+    the timestep is per image, t = 0 skips the denoise_fn for that image.
+    Input:
+        model: Model_with_diffusion after create_subnetwork, eval mode
+        denoise_fn: Unet on the latent of model (the ema one, see load_ema_denoise_fn)
+        decoder: PlateDecoder, default PlateDecoder()
+    '''
+    def __init__(self, model, denoise_fn, input_size, device, decoder=None):
+        self.model = model
+        self.denoise_fn = denoise_fn
+        self.input_size = input_size
+        self.device = torch.device(device)
+        self.decoder = decoder if decoder is not None else PlateDecoder()
+
+    def preprocess(self, img):
+        '''
+        Input: img BGR uint8 HWC (cv2.imread)
+        Return: float32 [3, s, s] RGB, meta of letterbox_plate
+        '''
+        img, meta = letterbox_plate(img, self.input_size)
+        img = (img / 255.).astype(np.float32)
+        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x512x512
+        return torch.from_numpy(np.ascontiguousarray(img)), meta
+
+    def __call__(self, img, times, meta):
+        '''
+        Input:
+            img: [b, 3, s, s] float32 (host or device)
+            times: [b] diffusion step of each image, 0 = no diffusion
+            meta: list of b meta of preprocess
+        Return: [b] list of [{'plate': str, 'box': [x1, y1, x2, y2], 'score': float}, ...],
+            boxes in the original image
+        '''
+        img = img.to(self.device, non_blocking=True)
+        times = torch.as_tensor(times, dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            latent, y = self.model.forward_submodel(img, self.model.before_diffusion_model, output_y=True)
+            diffuse = times > 0
+            if bool(diffuse.all()):
+                latent = self.denoise_fn(latent, times - 1)
+            elif bool(diffuse.any()):
+                index = diffuse.nonzero(as_tuple=True)[0]
+                latent = latent.index_copy(0, index, self.denoise_fn(latent[index], times[index] - 1))
+            pred = self.model.forward_submodel(latent, self.model.after_diffusion_model, init_y=y)[0]
+            out = self.decoder(pred)
+        strings = self.decoder.strings(out)
+        plate = torch.cat((out['plate'], out['score'][:, None]), 1)
+        count = torch.bincount(out['image'], minlength=len(meta)).tolist()
+        # plates are sorted by image, one back projection for the batch
+        dets = affine_transform_batch(list(plate.split(count)), meta)
+        result = []
+        for s, det in zip(strings, dets):
+            result.append([{'plate': p, 'box': d[:4].tolist(), 'score': float(d[4])} for p, d in zip(s, det)])
+        return result
+
+
+class PlateServer(object):
+    '''
+    In process server of a PlatePipeline: requests are queued on an asyncio loop and one worker
+    coalesces them into dynamic batches, a batch is closed at max_batch_size images or max_wait
+    seconds after its first request. Letterboxing runs in a thread pool and the batch runs in
+    its own thread, so new requests are queued while the device is busy.
+    Input:
+        pipeline: PlatePipeline
+        times: default diffusion step of a request
+    Usage:
+        server = PlateServer(pipeline, max_batch_size=16, max_wait=0.005)
+        await server.start()
+        plates = await server.infer(cv2.imread(path), times=50)
+        await server.stop()
+    '''
+    def __init__(self, pipeline, max_batch_size=16, max_wait=0.005, times=100, num_workers=4):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.times = times
+        self.preprocess_pool = ThreadPoolExecutor(num_workers)
+        self.device_pool = ThreadPoolExecutor(1)
+        self.queue = None
+        self.worker = None
+        self.batch_sizes = []
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self.serve())
+        return self
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def infer(self, img, times=None):
+        '''
+        Input:
+            img: BGR uint8 HWC image
+            times: diffusion step of this request, server default when None, 0 = no diffusion
+        Return: [{'plate': str, 'box': [x1, y1, x2, y2], 'score': float}, ...]
+        '''
+        loop = asyncio.get_event_loop()
+        x, meta = await loop.run_in_executor(self.preprocess_pool, self.pipeline.preprocess, img)
+        future = loop.create_future()
+        await self.queue.put((x, self.times if times is None else times, meta, future))
+        return await future
+
+    async def next_batch(self):
+        # first request waits without deadline, the rest until max_wait after it
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        while len(batch) < self.max_batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self.next_batch()
+            batch = [r for r in batch if not r[3].cancelled()]
+            if len(batch) == 0:
+                continue
+            img = torch.stack([r[0] for r in batch], 0)
+            times = [r[1] for r in batch]
+            meta = [r[2] for r in batch]
+            self.batch_sizes.append(len(batch))
+            try:
+                result = await loop.run_in_executor(self.device_pool, self.pipeline, img, times, meta)
+            except Exception as e:
+                for r in batch:
+                    if not r[3].done():
+                        r[3].set_exception(e)
+                continue
+            for r, plates in zip(batch, result):
+                if not r[3].done():
+                    r[3].set_result(plates)
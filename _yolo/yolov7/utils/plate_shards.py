@@ -0,0 +1,269 @@
+import glob
+import io
+import json
+import os
+import random
+import tarfile
+import time
+import cv2
+import numpy as np
+import torch
+from utils.generator import plate_generator
+from utils.augmentations import mix_augmentaion
+
+
+# one sample of a shard = key.jpg (training image) + key.labels.npy (float32 [n, 5(cls, x, y, w, h)] of
+# plate_generator.get_xywh) + key.step.txt (degradation step of mix_aug, -1 = none) + key.clean.jpg
+# (the image before mix_aug, optional), WebDataset style tar
+INDEX_FILE = 'index.json'
+
+
+def worker_seed(seed, worker):
+    '''
+    Return: 32 bit seed of the worker, a deterministic stream per (seed, worker)
+    '''
+    return int(np.random.SeedSequence([seed, worker]).generate_state(1)[0])
+
+
+def seed_everything(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+class ShardWriter(object):
+    '''
+    Writes samples to tar shards of at most shard_size samples, name_prefix-00000.tar, ...
+    Usage:
+        writer = ShardWriter('out', 'plates-w000', 1000)
+        writer.write('w000_00000000', {'jpg': bytes, 'labels.npy': bytes, 'step.txt': bytes})
+        shards = writer.close()  # [{'path': 'plates-w000-00000.tar', 'count': 1000}, ...]
+    '''
+    def __init__(self, output_dir, name_prefix, shard_size=1000):
+        self.output_dir = output_dir
+        self.name_prefix = name_prefix
+        self.shard_size = shard_size
+        self.shards = []
+        self.tar = None
+        self.count = 0
+
+    def next_shard(self):
+        self.close_shard()
+        name = '%s-%05d.tar'%(self.name_prefix, len(self.shards))
+        self.tar = tarfile.open(os.path.join(self.output_dir, name), 'w')
+        self.shards.append({'path': name, 'count': 0})
+
+    def close_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+            self.tar = None
+
+    def write(self, key, fields):
+        if self.tar is None or self.shards[-1]['count'] >= self.shard_size:
+            self.next_shard()
+        for ext, data in fields.items():
+            info = tarfile.TarInfo('%s.%s'%(key, ext))
+            info.size = len(data)
+            info.mtime = 0  # same bytes for the same seed
+            self.tar.addfile(info, io.BytesIO(data))
+        self.shards[-1]['count'] += 1
+        self.count += 1
+
+    def close(self):
+        self.close_shard()
+        return self.shards
+
+
+def encode_sample(img, label, step, clean=None, quality=95):
+    '''
+    Input:
+        img: training image (BGR, uint8 or float)
+        label: get_plate label, [[cls, x, y, w, h], ...]
+        step: mix_aug step, None = not augmented
+        clean: image before mix_aug, not stored when None
+    Return: {ext: bytes} of a shard sample
+    '''
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+    fields = {'jpg': cv2.imencode('.jpg', np.clip(img, 0, 255).astype(np.uint8), params)[1].tobytes()}
+    buffer = io.BytesIO()
+    np.save(buffer, np.array(label, dtype=np.float32).reshape(-1, 5))
+    fields['labels.npy'] = buffer.getvalue()
+    fields['step.txt'] = str(-1 if step is None else int(step)).encode()
+    if clean is not None:
+        fields['clean.jpg'] = cv2.imencode('.jpg', np.clip(clean, 0, 255).astype(np.uint8), params)[1].tobytes()
+    return fields
+
+
+def decode_sample(key, fields):
+    '''
+    Return: {'key', 'img' (BGR uint8), 'labels' (float32 [n, 5]), 'step' (int), 'clean' (when stored)}
+    '''
+    sample = {'key': key,
+              'img': cv2.imdecode(np.frombuffer(fields['jpg'], np.uint8), cv2.IMREAD_COLOR),
+              'labels': np.load(io.BytesIO(fields['labels.npy'])),
+              'step': int(fields['step.txt'])}
+    if 'clean.jpg' in fields:
+        sample['clean'] = cv2.imdecode(np.frombuffer(fields['clean.jpg'], np.uint8), cv2.IMREAD_COLOR)
+    return sample
+
+
+def make_generator(image_size=512, augment=True, load_path=None, bg_path=None, atlas_path=None):
+    # plate_generator of generate_plate.py, mix_augmentaion and fast_generator as in train_gendata.py,
+    # outputStep for the clean image and the step
+    augmentor = None
+    if augment:
+        augmentor = mix_augmentaion()
+        augmentor.imshape = (image_size, image_size)
+        augmentor.random_parameter()
+    generator = plate_generator(augmentor=augmentor, outputStep=True, image_size=image_size,
+                                load_path=load_path, bg_path=bg_path, atlas_path=atlas_path)
+    generator.fast_composite = generator.fast_background = True  # as train_gendata.py
+    return generator
+
+
+def list_backgrounds(bg_dir):
+    # background images of LoadImagesAndLabels_generate (bg_image_from='input'), sorted for the seeded draws
+    image_files = sorted(glob.glob(os.path.join(bg_dir, '*.[pj][np][g]')))
+    if len(image_files) == 0:
+        print('no background image in %s'%bg_dir)
+        no_background_image
+    return image_files
+
+
+def write_plate_shards(worker, n, output_dir, seed=0, shard_size=1000, quality=95, save_clean=False,
+                       style='random', file_format='shards', bg_dir=None, **generator_kwargs):
+    '''
+    Worker of generate_plate.py: n samples of plate_generator.get_plate written by the worker itself,
+    as tar shards (file_format='shards') or as %08d.jpg + %08d.txt files numbered from worker_offset.
+    Every sample is composited on a random image of bg_dir as LoadImagesAndLabels_generate does, or on
+    a plate_generator background when bg_dir is None.
+    The worker is seeded with worker_seed(seed, worker), the same (seed, worker) gives the same samples.
+    Return: {'worker', 'shards': [{'path', 'count'}], 'count', 'seconds'}
+    '''
+    start_time = time.time()
+    worker_offset = generator_kwargs.pop('worker_offset', 0)
+    cv2.setNumThreads(1)  # one core per worker
+    torch.set_num_threads(1)
+    seed_everything(worker_seed(seed, worker))
+    generator = make_generator(**generator_kwargs)
+    image_files = list_backgrounds(bg_dir) if bg_dir is not None else None
+    writer = ShardWriter(output_dir, 'plates-w%03d'%worker, shard_size)
+    for i in range(n):
+        bg_image = None if image_files is None else cv2.imread(image_files[np.random.randint(len(image_files))])
+        nimg, img, step, label = generator.get_plate(bg_image=bg_image, style=style)
+        if file_format == 'shards':
+            writer.write('w%03d_%08d'%(worker, i), encode_sample(img, label, step, nimg if save_clean else None, quality))
+        else:
+            base_filename = os.path.join(output_dir, '%08d'%(worker_offset + i))
+            cv2.imwrite(base_filename + '.jpg', np.clip(img, 0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, quality])
+            # label text of generate_plate.py, ',' joined, one object per line
+            with open(base_filename + '.txt', 'w') as file:
+                for sublist in label:
+                    file.write(','.join(map(str, sublist)) + '\n')
+    return {'worker': worker, 'shards': writer.close(), 'count': n, 'seconds': time.time() - start_time}
+
+
+def write_index(output_dir, results, **meta):
+    # index.json of the shards of every worker, read by read_shard_index
+    shards = [s for r in sorted(results, key=lambda r: r['worker']) for s in r['shards']]
+    index = dict(meta, shards=shards, count=sum(s['count'] for s in shards))
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=1)
+    return index
+
+
+def read_shard_index(path):
+    '''
+    Input: folder of generate_plate.py shards (with index.json), its index.json or a list of folders
+    Return: [{'path': absolute tar path, 'count'}, ...]
+    '''
+    if isinstance(path, (list, tuple)):
+        return [s for p in path for s in read_shard_index(p)]
+    if os.path.isdir(path):
+        path = os.path.join(path, INDEX_FILE)
+    if not os.path.exists(path):
+        print('no shard index %s, write the shards with _plate/synthesis/generate_plate.py --format shards'%path)
+        no_shard_index
+    with open(path) as f:
+        index = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+    return [{'path': os.path.join(root, s['path']), 'count': s['count']} for s in index['shards']]
+
+
+def iterate_shard(path, decode=True):
+    # samples of one tar in file order, the fields of a key are consecutive, (key, fields) when not decode
+    key, fields = None, {}
+    with tarfile.open(path, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            name = os.path.basename(member.name)
+            k, ext = name.split('.', 1)
+            if key is not None and k != key:
+                yield decode_sample(key, fields) if decode else (key, fields)
+                fields = {}
+            key = k
+            fields[ext] = tar.extractfile(member).read()
+    if key is not None:
+        yield decode_sample(key, fields) if decode else (key, fields)
+
+
+def split_shards_by_count(shards, n_parts):
+    '''
+    Shards of every reader, the largest shard first to the reader with the fewest samples (ties to
+    the lower reader), the same split in every reader. Sample counts of the readers differ by at most
+    the count of one shard, generate_plate.py shards differ only by the last partial shard of a worker.
+    Return: [n_parts][shards]
+    '''
+    parts = [[] for _ in range(n_parts)]
+    counts = [0] * n_parts
+    for shard in sorted(shards, key=lambda s: (-s['count'], s['path'])):
+        i = counts.index(min(counts))
+        parts[i].append(shard)
+        counts[i] += shard['count']
+    return parts
+
+
+def stream_samples(shards, part=0, n_parts=1, shuffle_buffer=256, seed=0, loop=True):
+    '''
+    Samples of the shards of one reader (dataloader worker x DDP rank), each reader reads its own
+    shards (split_shards_by_count, sample counts of the readers differ by at most one shard), or every
+    n_parts-th sample of all shards when there are fewer shards than readers (all readers then go
+    through the shards in the same order, counts differ by at most one sample). The shard order is
+    shuffled every pass and samples go through a shuffle buffer.
+    Input:
+        shards: read_shard_index output
+        part, n_parts: this reader and the number of readers
+        loop: start a new pass over the shards when done (training), a reader with fewer samples
+              starts its next pass earlier, its samples come up a bit more often per epoch
+    '''
+    rng = random.Random(worker_seed(seed, part))
+    split_shards = len(shards) >= n_parts
+    own = split_shards_by_count(shards, n_parts)[part] if split_shards else list(shards)
+    buffer = []
+    n_pass = 0
+    while True:
+        if split_shards:
+            rng.shuffle(own)
+        else:
+            # same order in every reader, (seed, n_parts, pass) and not part
+            random.Random(int(np.random.SeedSequence([seed, n_parts, n_pass]).generate_state(1)[0])).shuffle(own)
+        n_pass += 1
+        n = 0
+        for shard in own:
+            for key, fields in iterate_shard(shard['path'], decode=False):
+                n += 1
+                if not split_shards and (n - 1) % n_parts != part:
+                    continue
+                sample = decode_sample(key, fields)
+                if len(buffer) < shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                i = rng.randrange(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                yield sample
+        if not loop:
+            break
+    rng.shuffle(buffer)
+    for sample in buffer:
+        yield sample
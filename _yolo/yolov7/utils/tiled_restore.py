@@ -0,0 +1,153 @@
+import math
+import torch
+
+
+def tile_starts(size, tile, overlap, align=8):
+    '''
+    Input:
+        size: length of the image side
+        tile: length of a tile, a multiple of align
+        overlap: minimum length shared by two neighbour tiles
+        align: the stride between tiles is a multiple of align (the downsampling of the Unet),
+            so the tiles see the same pooling grid as the whole image
+    Return: list of tile starts, the first tile starts at 0 and the last one ends at size
+    '''
+    if size <= tile:
+        return [0]
+    stride = max((tile - overlap) // align * align, align)
+    n = math.ceil((size - tile) / stride) + 1
+    return [min(i * stride, size - tile) for i in range(n)]
+
+
+def feather_window(tile_h, tile_w, overlap, device=None):
+    '''
+    Blending weight of a tile, linear ramp over the overlap band on every side and 1 inside.
+    The weights are normalized by their sum over all tiles, so the ramp at the image border
+    does not darken anything.
+    Return: float32 [tile_h, tile_w]
+    '''
+    def ramp(n):
+        i = torch.arange(n, dtype=torch.float32, device=device)
+        return torch.minimum(i + 1, n - i).div(overlap + 1).clamp(max=1.0)
+    return ramp(tile_h)[:, None] * ramp(tile_w)[None, :]
+
+
+def plate_boxes(dets, scale=1.0, plate_class=34):
+    '''
+    Plate boxes of a first yolo pass, to restore only the tiles around them.
+    Input:
+        dets: non_max_suppression_batch output, [b](None or [num_objs, 6(x1, y1, x2, y2, conf, cls)])
+        scale: size of the restored image / size of the yolo input
+    Return: [b] list of [num_plates, 4] boxes in the restored image
+    '''
+    boxes = []
+    for det in dets:
+        if det is None or len(det) == 0:
+            boxes.append(None)
+            continue
+        boxes.append(det[det[:, 5] == plate_class, :4] * scale)
+    return boxes
+
+
+class TiledRestorer(object):
+    '''
+    denoise_fn on overlapping tiles of the input (image or yolo latent) instead of the whole
+    image, tile_batch tiles per denoise_fn call and the seams blended with feather_window, so the
+    Unet activations are bounded by tile_batch x tile x tile whatever the input size.
+    Tiles are blended as a residual (denoise_fn(tile) - tile), a tile which is not restored
+    contributes the input unchanged and restored regions fade into the input at their border.
+    Input:
+        denoise_fn: Unet (x [n, c, tile, tile], t [n]) -> [n, c, tile, tile]
+        tile: tile size in pixels of the input, a multiple of align
+        overlap: pixels shared by neighbour tiles
+        tile_batch: tiles per denoise_fn call
+    Usage:
+        restorer = TiledRestorer(denoise_fn, tile=256, overlap=32)
+        x0 = restorer(img, step)                                  # whole image
+        x0 = restorer(img, step, plate_boxes(dets, scale), 16)    # tiles of the plates only
+    '''
+    def __init__(self, denoise_fn, tile=256, overlap=32, tile_batch=8, align=8):
+        if tile % align != 0 or overlap >= tile:
+            print('tile %d must be a multiple of %d and larger than overlap %d'%(tile, align, overlap))
+            wrong_tile_size
+        self.denoise_fn = denoise_fn
+        self.tile = tile
+        self.overlap = overlap
+        self.tile_batch = tile_batch
+        self.align = align
+        self.weights = {}
+
+    def grid(self, h, w):
+        '''
+        Return: [n, 2(y0, x0)] long tile corners, tile height, tile width
+        '''
+        th, tw = min(self.tile, h), min(self.tile, w)
+        ys = torch.tensor(tile_starts(h, th, self.overlap, self.align))
+        xs = torch.tensor(tile_starts(w, tw, self.overlap, self.align))
+        corners = torch.stack(torch.meshgrid(ys, xs, indexing='ij'), -1).reshape(-1, 2)
+        return corners, th, tw
+
+    def weight(self, h, w, device):
+        # feather window and 1 / sum of the windows over the image, cached per input size
+        key = (h, w, str(device))
+        if key not in self.weights:
+            corners, th, tw = self.grid(h, w)
+            window = feather_window(th, tw, self.overlap, device)
+            total = torch.zeros((h, w), device=device)
+            for y0, x0 in corners.tolist():
+                total[y0:y0 + th, x0:x0 + tw] += window
+            self.weights[key] = (window, 1.0 / total)
+        return self.weights[key]
+
+    def select(self, corners, th, tw, boxes, margin):
+        '''
+        Input:
+            corners: [n, 2] of grid
+            boxes: [b] list of None or [m, 4] x1y1x2y2
+        Return: [k, 3(image, y0, x0)] tiles to restore, all tiles of every image when boxes is None
+        '''
+        if boxes is None:
+            return None
+        selected = []
+        corners_f = corners.float()
+        for i, box in enumerate(boxes):
+            if box is None or len(box) == 0:
+                continue
+            box = box[:, :4].float().cpu()
+            hit = ((box[None, :, 0] - margin < corners_f[:, 1:2] + tw) & (box[None, :, 2] + margin > corners_f[:, 1:2]) &
+                   (box[None, :, 1] - margin < corners_f[:, 0:1] + th) & (box[None, :, 3] + margin > corners_f[:, 0:1])).any(1)
+            tiles = corners[hit]
+            selected.append(torch.cat([torch.full((len(tiles), 1), i, dtype=torch.long), tiles], 1))
+        if len(selected) == 0:
+            return torch.zeros((0, 3), dtype=torch.long)
+        return torch.cat(selected, 0)
+
+    def __call__(self, x, times, boxes=None, margin=0):
+        '''
+        Input:
+            x: [b, c, h, w] input of denoise_fn
+            times: [b] long step of denoise_fn (or an int for the batch)
+            boxes: None to restore every tile, or [b] list of None / [m, 4] x1y1x2y2 boxes in the
+                pixels of x, only the tiles overlapping a box grown by margin are restored
+        Return: [b, c, h, w], self.restored = [b] fraction of the tiles restored per image
+        '''
+        b, c, h, w = x.shape
+        times = torch.as_tensor(times, dtype=torch.long, device=x.device).expand(b)
+        corners, th, tw = self.grid(h, w)
+        window, inv_total = self.weight(h, w, x.device)
+        tiles = self.select(corners, th, tw, boxes, margin)
+        if tiles is None:
+            image = torch.arange(b).repeat_interleave(len(corners))
+            tiles = torch.cat([image[:, None], corners.repeat(b, 1)], 1)
+        self.restored = (torch.bincount(tiles[:, 0], minlength=b).float() / len(corners)).tolist()
+        if len(tiles) == 0:
+            return x
+        delta = torch.zeros_like(x)
+        for chunk in tiles.split(self.tile_batch):
+            chunk = chunk.tolist()
+            crop = torch.stack([x[i, :, y0:y0 + th, x0:x0 + tw] for i, y0, x0 in chunk], 0)
+            step = times[[i for i, _, _ in chunk]]
+            out = (self.denoise_fn(crop, step) - crop) * window
+            for (i, y0, x0), o in zip(chunk, out):
+                delta[i, :, y0:y0 + th, x0:x0 + tw] += o
+        return x + delta * inv_total
@@ -8,7 +8,10 @@ import yaml
 import math
 from tqdm import tqdm
 
-from utils.general import non_max_suppression
+from utils.general import non_max_suppression, non_max_suppression_batch
+from utils.plate_metrics import plate_counts
+from utils.eval_engine import EvalEngine
+from functools import partial
 from augmentations import mix_augmentaion
 import sys
 sys.path.append('/data/licence_plate/Cold-Diffusion-Models/licenceplate_deaug_yolov7_pytorch/')
@@ -23,6 +26,7 @@ conf_thres = 0.5
 iou_thres = 0.5
 diffusion_step=100
 device = 'cuda:2'
+eval_batch_size = 8
 aug_licence = mix_augmentaion()
 
 with open(data) as f:
@@ -249,6 +253,13 @@ def run_withdiffusion(img_path,times=100):
     Return: output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
     '''
     img, meta = preproccess_img(img_path)
+    return run_withdiffusion_img(img,times), meta
+
+def run_withdiffusion_img(img,times=100):
+    '''
+    img: [b, 3, input_size, input_size] on device
+    Return: output = b x [num_objs, 6(x1, y1, x2, y2, conf, cls)]
+    '''
     #b,h,w,c=img.shape
     #print(meta)
     with torch.no_grad():
@@ -266,8 +277,8 @@ def run_withdiffusion(img_path,times=100):
         #print(meta)
 
         ret = model(img_diffusion_output)
-        ret = non_max_suppression(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, labels=[], multi_label=True)
-    return ret, meta
+        ret = non_max_suppression_batch(ret[0], conf_thres=conf_thres, iou_thres=iou_thres, multi_label=True)
+    return ret
 
 def run_aug_withdiffusion(img_path,times=200,ratio=1.0):
     '''
@@ -526,24 +537,8 @@ def get_wer(r, h):
     return result, sid, total
 
 def eval_dataset(results,label_data):
-    correct_plate = {}
-    total_p, correct_p, pred_p = 0, 0, 0
-    for k, v in label_data.items():
-        gt = transfer_label(v)
-        total_p += len(gt)
-        if k in results:
-            r = group_plate(results[k]) # r = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...]}, ...]
-            pred_p += len(r)
-            correct_r = []
-            for _r in r:
-                for idx, bbox in enumerate(gt):
-                    if get_iou(bbox, _r['plate']) >= 0.5:
-                        n_r = {'plate': _r['plate'], 'char': _r['char'], 'idx': idx}
-                        correct_r.append(n_r)
-            num = len(correct_r)
-            if num > 0:
-                correct_plate[k] = correct_r
-                correct_p += num
+    counts = plate_counts(results, label_data) # vectorized, utils/plate_metrics.py
+    total_p, correct_p, pred_p = counts['total_p'], counts['correct_p'], counts['pred_p']
                 
     print("Number of Correctly Detected Plates =", correct_p)
     print("Number of Detected Plates =", pred_p)
@@ -554,21 +549,9 @@ def eval_dataset(results,label_data):
     print("Precision = {:.4f}".format(precision))
     classes = _classes()
 
-    n_perfect = 0  ### number of perfectly recognized plates
-    n_sid = 0  ### number of failed recognized chars in detected
-    n_detected = 0  ### number of chars in detected plates
-
-    for k, v in label_data.items():
-        gt_strs = [s.split(',')[-1] for s in v]
-        if k in correct_plate:
-            objs = correct_plate[k]
-            for obj in objs: # obj = [{'plate': int[x1, y1, x2, y2], 'char':[int[x1, y1, x2, y2, label], ...], 'idx': int(i)}]
-                pred_str = [classes[x[-1]] for x in obj['char']]
-                wer, sid, t = get_wer(list(gt_strs[obj['idx']]), pred_str)
-                n_sid += sid
-                n_detected += t
-                if wer == 0:
-                    n_perfect += 1
+    n_perfect = counts['n_perfect']  ### number of perfectly recognized plates
+    n_sid = counts['n_sid']  ### number of failed recognized chars in detected
+    n_detected = counts['n_detected']  ### number of chars in detected plates
 
 
     print("Characters in Detected Plates = ", n_detected)
@@ -647,18 +630,8 @@ wandb.init(
 )
 
     
-results_diffusion = {}
-for f in tqdm(img_paths, ncols=80):
-    if f.endswith('.jpg'):
-        bname = os.path.splitext(f)[0]
-        img_p = img_dir + f
-        
-        #ret, meta = run(img_p)
-        ret, meta = run_withdiffusion(img_p,times=diffusion_step)
-        
-        if ret[0] is not None:
-            output = affine_transform(ret, meta) # output = [num_objs, 6(x1, y1, x2, y2, conf, cls)]
-            results_diffusion[bname] = output
+engine = EvalEngine(img_dir, input_size, device, batch_size=eval_batch_size)
+results_diffusion = engine.run({'diffusion': partial(run_withdiffusion_img, times=diffusion_step)})['diffusion']
 accuracy_dict = eval_dataset(results_diffusion,label_data)
     
 wandb.log(accuracy_dict)